@@ -0,0 +1,79 @@
+""" This module contains the consumer of the changes captured on the cloud database """
+import os
+import database as db
+import postgres
+
+# Changes applied per round trip
+CHANGES_BATCH_SIZE = int(os.getenv('CDC_BATCH_SIZE', '5000'))
+# Name of the sync cursor holding the (txid, id) of the last applied change,
+# kept as its position and token
+CHANGES_CURSOR = 'cloud_changes_txid'
+
+
+def collapse(changes):
+    """
+    Reduce captured changes to the net operation of every row.
+
+    A row inserted and then updated is an insert, a row deleted after any
+    other change is a delete.
+
+    Args:
+        changes (list): Tuples (id, table, op, row_id, txid) in the order they happened.
+
+    Returns:
+        dict: Row ids keyed by table, then by 'insert', 'update' or 'delete'.
+    """
+    rows = {}
+    for _, table, op, row_id, _ in changes:
+        first, _ = rows.get((table, row_id), (op, op))
+        rows[(table, row_id)] = (first, op)
+    collapsed = {}
+    for (table, row_id), (first, last) in rows.items():
+        if last == 'DELETE':
+            net = 'delete'
+        elif first == 'INSERT':
+            net = 'insert'
+        else:
+            net = 'update'
+        operations = collapsed.setdefault(table, {'insert': [], 'update': [], 'delete': []})
+        operations[net].append(row_id)
+    return collapsed
+
+def drain(apply, wait=0):
+    """
+    Apply every change captured since the last run, batch by batch.
+
+    Once the change log is empty, waits up to `wait` seconds for the capture
+    triggers to announce new changes, and applies those too. The cursor only
+    moves past a batch once `apply` returned, so a batch that failed is read
+    again by the next run, and only the changes of applied batches are dropped.
+    Changes of transactions that were still running are left for a later read,
+    see database.get_changes.
+
+    Args:
+        apply (callable): Takes the collapse() of a batch of changes and raises
+            when any of them could not be written.
+        wait (float): Seconds to wait for new changes once caught up, 0 to return.
+
+    Returns:
+        int: Number of changes applied.
+    """
+    print("START: Applying captured changes")
+    applied = 0
+    cursor = db.get_sync_checkpoint(CHANGES_CURSOR)
+    after = (cursor[0], int(cursor[1])) if cursor is not None else (0, 0)
+    while True:
+        changes = db.get_changes(after, CHANGES_BATCH_SIZE)
+        if len(changes) == 0:
+            if wait <= 0 or not postgres.wait_for_notify('cloud', db.CHANGES_CHANNEL, wait):
+                break
+            wait = 0
+            continue
+        apply(collapse(changes))
+        after = max((change[4], change[0]) for change in changes)
+        if not db.set_sync_cursor(CHANGES_CURSOR, after[0], str(after[1])):
+            raise Exception("The changes cursor could not be stored")
+        applied += len(changes)
+        db.clear_changes([change[0] for change in changes])
+    print(f"SUCCESS: {applied} captured changes applied")
+    return applied
@@ -1,29 +1,187 @@
 """ Contains all hubspot operations"""
+import os
 import re
 import datetime
+import threading
 import pandas as pd
 import postgres as db
+from identity_map import IdentityMap
+
+# High-water marks kept per entity and source in the sync_checkpoints table
+CHECKPOINT_KINDS = ('created', 'updated', 'deleted')
+# Aggregates seeding the marks of an entity and source the first time they are
+# read, the way windows were derived before sync_checkpoints existed
+CHECKPOINT_SEEDS = {
+    ('contacts', 'cloud'): "select max(created) from contacts where type = 'cloud'",
+    ('contacts', 'sso'): "select max(created) from contacts where type = 'sso'",
+    ('contacts', 'serial'): "select max(created) from serials",
+    ('serials', 'legacy'): "select max(created) from serials",
+    ('workspaces', 'cloud'): "select max(created) from workspaces",
+    ('memberships', 'cloud'): "select max(created) from memberships",
+}
+_checkpoints_lock = threading.Lock()
+_checkpoints_ready = threading.Event()
+
+# Keys kept in memory per identity map
+IDENTITY_MAP_SIZE = int(os.getenv('IDENTITY_MAP_SIZE', '100000'))
+
+
+def _analytics_loader(query):
+    return lambda keys: db.lookup('analytics', query, keys)
+
+# HubSpot IDs by email, workspace, serial and membership, shared by every workflow of a run
+contact_ids = IdentityMap(_analytics_loader(
+    'select email,"hubspotID" from contacts where email = ANY(%s)'), IDENTITY_MAP_SIZE)
+workspace_ids = IdentityMap(_analytics_loader(
+    'select workspace,"hubspotID" from workspaces where workspace = ANY(%s)'), IDENTITY_MAP_SIZE)
+serial_ids = IdentityMap(_analytics_loader(
+    'select serial,"hubspotID" from serials where serial = ANY(%s)'), IDENTITY_MAP_SIZE)
+membership_ids = IdentityMap(_analytics_loader(
+    'select member,"hubspotID" from memberships where member = ANY(%s)'), IDENTITY_MAP_SIZE)
+IDENTITY_MAPS = {'contacts': contact_ids, 'workspaces': workspace_ids,
+                 'serials': serial_ids, 'memberships': membership_ids}
+
+
+def _unquoted(emails):
+    """
+    Keep the emails without a single quote, which are never looked up.
+    """
+    return [email for email in emails if email is not None and "'" not in email]
 
 
-def get_contacts():
+def _ensure_checkpoints():
     """
-    Fetch new contacts from the database.
+    Create the sync_checkpoints table once per process.
+    """
+    with _checkpoints_lock:
+        if _checkpoints_ready.is_set():
+            return
+        response = db.analytics_db("ADD",'''
+                CREATE TABLE if not exists sync_checkpoints (
+                    entity character varying,
+                    source character varying,
+                    created timestamp without time zone,
+                    updated timestamp without time zone,
+                    deleted timestamp without time zone,
+                    PRIMARY KEY (entity, source)
+                )
+                ''', None)
+        if response is not None:
+            _checkpoints_ready.set()
+
+def get_checkpoint(entity, source, kind='created'):
+    """
+    Retrieve the high-water mark a workflow's window starts after.
 
-    This function retrieves new contacts from the Users table whose "createdAt" timestamp
-    is greater than the last synchronization timestamp obtained 
-    from the contacts table or triggers a full sync if the table is empty.
+    This is the only place windows come from. The first read of an entity and
+    source seeds its three marks from CHECKPOINT_SEEDS.
+
+    Args:
+        entity (str): One of 'contacts', 'serials', 'workspaces' or 'memberships'.
+        source (str): Where the rows come from, e.g. 'cloud', 'sso' or 'legacy'.
+        kind (str): One of 'created', 'updated' or 'deleted'.
+
+    Returns:
+        datetime: The mark, or None if the entity never synced from this source.
+    """
+    if kind not in CHECKPOINT_KINDS:
+        raise ValueError(f"Unknown checkpoint kind: {kind}")
+    _ensure_checkpoints()
+    query = f"select {kind} from sync_checkpoints where entity = %s and source = %s"
+    checkpoint = db.analytics_db("GET", query, (entity, source))
+    if checkpoint is not None and len(checkpoint) == 0:
+        db.analytics_db("ADD", f"""
+                insert into sync_checkpoints (entity, source, created, updated, deleted)
+                select %s, %s, seed.mark, seed.mark, seed.mark
+                from ({CHECKPOINT_SEEDS[(entity, source)]}) as seed(mark)
+                on conflict (entity, source) do nothing""", (entity, source))
+        checkpoint = db.analytics_db("GET", query, (entity, source))
+    if checkpoint is None or len(checkpoint) == 0:
+        return None
+    return checkpoint[0][0]
+
+def checkpoint_statement(entity, source, kind, positions):
+    """
+    Build the statement advancing a high-water mark to the newest of `positions`.
+
+    Marks never move back. A row created by a 'created' advance starts its
+    updated and deleted marks there too, as the full sync behind it read the
+    current state of every row.
+
+    Args:
+        entity (str): One of 'contacts', 'serials', 'workspaces' or 'memberships'.
+        source (str): Where the rows come from, e.g. 'cloud', 'sso' or 'legacy'.
+        kind (str): One of 'created', 'updated' or 'deleted'.
+        positions (list): Timestamps of the committed rows, or a window's end.
+
+    Returns:
+        tuple: (query, values), to commit with the batch it covers through
+            postgres.analytics_bulk_write or postgres.analytics_transaction.
+    """
+    if kind not in CHECKPOINT_KINDS:
+        raise ValueError(f"Unknown checkpoint kind: {kind}")
+    _ensure_checkpoints()
+    columns = CHECKPOINT_KINDS if kind == 'created' else (kind,)
+    query = f"""insert into sync_checkpoints (entity, source, {', '.join(columns)})
+                select %s, %s, {', '.join('max(position)' for _ in columns)}
+                from unnest(%s::timestamp[]) as position
+                on conflict (entity, source) do update
+                set {kind} = greatest(sync_checkpoints.{kind}, excluded.{kind})"""
+    return (query, (entity, source, [position for position in positions if position is not None]))
+
+def advance_checkpoint(entity, source, kind, positions):
+    """
+    Advance a high-water mark on its own, e.g. once an update window was sent.
+
+    Args:
+        entity (str): One of 'contacts', 'serials', 'workspaces' or 'memberships'.
+        source (str): Where the rows come from, e.g. 'cloud', 'sso' or 'legacy'.
+        kind (str): One of 'created', 'updated' or 'deleted'.
+        positions (list): Timestamps of the committed rows, or a window's end.
 
     Returns:
-        list: A list of new contacts, each represented as a tuple (email, name).
+        bool: True if the mark was stored, None otherwise.
+    """
+    return db.analytics_transaction([checkpoint_statement(entity, source, kind, positions)])
+
+def source_now(database):
+    """
+    Read the clock of a source database, used as the end of update and delete windows.
+
+    Args:
+        database (str): 'cloud' or 'legacy'.
+
+    Returns:
+        datetime: The current time on that database.
+    """
+    if database == 'legacy':
+        rows = db.legacy_db("select now()", None)
+    else:
+        rows = db.cloud_db("select now()", None)
+    return rows[0][0]
+
+
+def iter_contacts(sources=('cloud', 'sso', 'serial')):
+    """
+    Fetch new contacts from the database in chunks.
+
+    This function retrieves new contacts from the Users table whose "createdAt" timestamp
+    is greater than the cloud contacts checkpoint, or triggers a full sync if
+    cloud contacts never synced.
+    A full sync streams the emails and legacy serials scans instead of
+    loading them into memory.
+
+    Args:
+        sources (tuple): Contact types fetched by an incremental sync, e.g. only
+            'serial' when cloud and SSO contacts come from change capture.
+
+    Yields:
+        list: A chunk of new contacts, each represented as a tuple (email, date, type).
     """
-    cloud_users = []
-    serial_users = []
-    sso_users = []
     try:
-        # Fetch the last sync timestamp from the database
-        last_sync_query = 'select max(created) from contacts'
-        last_sync_timestamp = db.analytics_db("GET",last_sync_query, None)
-        if last_sync_timestamp[0][0] is None:
+        # Fetch the cloud contacts checkpoint
+        last_sync = get_checkpoint('contacts', 'cloud')
+        if last_sync is None:
             print("Contacts table empty, start full Sync")
             # create tables if they do not exist
             db.analytics_db("ADD",'''
@@ -43,84 +201,87 @@ def get_contacts():
                     ''', None)
             user_query = """select email, date from emails where email is not null
             group by 1,2 order by date limit 500000"""
-            cloud_users = db.analytics_db("GET",user_query,None)
-            cloud_list = [(re.sub(r"'", r"''", email), date, 'cloud') for email, date in cloud_users]
+            for cloud_users in db.stream_query('analytics', user_query, None):
+                yield [(re.sub(r"'", r"''", email), date, 'cloud') for email, date in cloud_users]
 
             sso_query = """select email, "createdAt" from "ExternalIdentities"
             where email is not null group by 1,2 order by "createdAt" asc """
             sso_users = db.cloud_db(sso_query,None)
-            sso_list = [(email, date, 'sso') for email, date in sso_users]
+            yield [(email, date, 'sso') for email, date in sso_users]
 
             user_licenses = '''select email, max(FROM_UNIXTIME(date)) as date
             from serials where STR_TO_DATE(FROM_UNIXTIME(expirationdate), '%Y-%m-%d') > CURDATE() 
                     AND STR_TO_DATE(FROM_UNIXTIME(update_expirationdate), '%Y-%m-%d') 
                                 > CURDATE() group by 1 '''
-            serial_users = db.legacy_db(user_licenses,None)
-            serial_list = [(email, date, 'serial') for email, date in serial_users]
+            for serial_users in db.stream_query('legacy', user_licenses, None):
+                yield [(email, date, 'serial') for email, date in serial_users]
         else:
             # Fetch new contacts from Users table
             print("Fetching new Contacts")
-            last_sync_query = "select max(created) from contacts where  type = 'cloud'"
-            last_sync_timestamp = db.analytics_db("GET",last_sync_query, None)
-            user_query = f"""select email, max("createdAt") as "createdAt" from "Users" where email
-            is not null and "createdAt" > '{last_sync_timestamp[0][0]}' and email NOT ILIKE '%''%'
-              ESCAPE '#' group by 1  order by "createdAt" asc """
-            cloud_users = db.cloud_db(user_query,None)
-            cloud_list = [(email, date, 'cloud') for email,date in cloud_users]
-            print(f"Cloud Users: {len(cloud_list)}")
-            last_sync_query = "select max(created) from contacts where  type = 'sso'"
-            last_sync_timestamp = db.analytics_db("GET",last_sync_query, None)
-            if last_sync_timestamp[0][0] is None:
-                sso_query = """select email, "createdAt" from "ExternalIdentities"
-                where email is not null and email NOT ILIKE '%''%' ESCAPE '#' group by 1,2 
-                order by "createdAt" asc """
-                sso_users = db.cloud_db(sso_query,None)
-            else:
-                sso_query = f"""select email, "createdAt" from "ExternalIdentities"
-                where email is not null and "createdAt" > '{last_sync_timestamp[0][0]}' 
-                and email NOT ILIKE '%''%' ESCAPE '#' group by 1,2 order by "createdAt" asc """
-                sso_users = db.cloud_db(sso_query,None)
-            sso_list = [(email, date, 'sso') for email, date in sso_users]
-            print(f"SSO Users: {len(sso_users)}")
-            #fetch new users from Serials
-            last_sync_query = "select max(created) from serials"
-            last_sync = db.analytics_db("GET",last_sync_query, None)
-            if last_sync[0][0] is not None:
-                unix_timestamp = int(last_sync[0][0].timestamp())
-                user_licenses = f"""select s.email,FROM_UNIXTIME(s.date) as date from serials s
-                where date > '{unix_timestamp}' and STR_TO_DATE(FROM_UNIXTIME(s.expirationdate), '%Y-%m-%d')
-                  > CURDATE() AND STR_TO_DATE(FROM_UNIXTIME(s.update_expirationdate), '%Y-%m-%d')
-                    > CURDATE() and s.email NOT LIKE '%''%' ESCAPE '\'"""
-                serial_users = db.legacy_db(user_licenses,None)
-            else:
-                user_licenses = """select s.email,FROM_UNIXTIME(s.date) as date from serials s
-                where  STR_TO_DATE(FROM_UNIXTIME(s.expirationdate), '%Y-%m-%d') > CURDATE() 
-                AND STR_TO_DATE(FROM_UNIXTIME(s.update_expirationdate), '%Y-%m-%d') > CURDATE()
-                  and s.email NOT LIKE '%''%' ESCAPE '\'"""
-                serial_users = db.legacy_db(user_licenses,None)
-            serial_list = [(email, date, 'serial') for email, date in serial_users]
-            print(f"Serial Users: {len(serial_users)}")
+
+            def new_cloud_users():
+                user_query = f"""select email, max("createdAt") as "createdAt" from "Users" where email
+                is not null and "createdAt" > '{last_sync}' and email NOT ILIKE '%''%'
+                  ESCAPE '#' group by 1  order by "createdAt" asc """
+                cloud_users = db.cloud_db(user_query,None)
+                return [(email, date, 'cloud') for email,date in cloud_users]
+
+            def new_sso_users():
+                last_sync_timestamp = get_checkpoint('contacts', 'sso')
+                if last_sync_timestamp is None:
+                    sso_query = """select email, "createdAt" from "ExternalIdentities"
+                    where email is not null and email NOT ILIKE '%''%' ESCAPE '#' group by 1,2 
+                    order by "createdAt" asc """
+                    sso_users = db.cloud_db(sso_query,None)
+                else:
+                    sso_query = f"""select email, "createdAt" from "ExternalIdentities"
+                    where email is not null and "createdAt" > '{last_sync_timestamp}' 
+                    and email NOT ILIKE '%''%' ESCAPE '#' group by 1,2 order by "createdAt" asc """
+                    sso_users = db.cloud_db(sso_query,None)
+                return [(email, date, 'sso') for email, date in sso_users]
+
+            def new_serial_users():
+                #fetch new users from Serials
+                serials_sync = get_checkpoint('contacts', 'serial')
+                if serials_sync is not None:
+                    unix_timestamp = int(serials_sync.timestamp())
+                    user_licenses = f"""select s.email,FROM_UNIXTIME(s.date) as date from serials s
+                    where date > '{unix_timestamp}' and STR_TO_DATE(FROM_UNIXTIME(s.expirationdate), '%Y-%m-%d')
+                      > CURDATE() AND STR_TO_DATE(FROM_UNIXTIME(s.update_expirationdate), '%Y-%m-%d')
+                        > CURDATE() and s.email NOT LIKE '%''%' ESCAPE '\'"""
+                    serial_users = db.legacy_db(user_licenses,None)
+                else:
+                    user_licenses = """select s.email,FROM_UNIXTIME(s.date) as date from serials s
+                    where  STR_TO_DATE(FROM_UNIXTIME(s.expirationdate), '%Y-%m-%d') > CURDATE() 
+                    AND STR_TO_DATE(FROM_UNIXTIME(s.update_expirationdate), '%Y-%m-%d') > CURDATE()
+                      and s.email NOT LIKE '%''%' ESCAPE '\'"""
+                    serial_users = db.legacy_db(user_licenses,None)
+                return [(email, date, 'serial') for email, date in serial_users]
+
+            # The cloud, SSO and legacy serials sources do not depend on each other
+            fetch = {'cloud': new_cloud_users, 'sso': new_sso_users, 'serial': new_serial_users}
+            labels = {'cloud': 'Cloud', 'sso': 'SSO', 'serial': 'Serial'}
+            contacts = []
+            for source, users in zip(sources, db.parallel(*[fetch[source] for source in sources])):
+                print(f"{labels[source]} Users: {len(users)}")
+                contacts = contacts+users
             print("SUCCESS: New contacts retrieved from Database")
+            yield contacts
     except Exception as get_exception:
         print(f"Error in Contacts (GET): {get_exception}")
-    return cloud_list+sso_list+serial_list
+        raise
 
-def duplicate_contacts(contacts):
+def get_contacts():
     """
-    Remove duplicate contacts based on email addresses.
-
-    Args:
-        contacts (list): List of new contacts.
+    Fetch new contacts from the database.
 
     Returns:
-        list: Filtered list without duplicate email addresses.
+        list: A list of new contacts, each represented as a tuple (email, date, type).
     """
-    contact_list = ', '.join([f"'{contact[0]}'" for contact in contacts])
-    query = f'select email from contacts where email in ({contact_list})'
-    duplicates = db.analytics_db("GET",query, None)
-    email_list = [email[0] for email in duplicates]
-    filtered_contacts = [contact for contact in contacts if contact[0] not in email_list]
-    return filtered_contacts
+    contacts = []
+    for chunk in iter_contacts():
+        contacts.extend(chunk)
+    return contacts
 
 def invalid_emails(contacts):
     """
@@ -134,11 +295,8 @@ def invalid_emails(contacts):
         bool: True if insertion is successful, False otherwise.
     """
     try:
-        query = 'insert into invalid_contacts ( email) values (%s)'
-        # Iterate through the list of HubSpot contact IDs and insert them into the database
-        for contact in contacts:
-            query = f"insert into invalid_contacts ( email) values ('{str(contact)}')"
-            db.analytics_db("ADD", query, None)
+        rows = [(str(contact),) for contact in contacts]
+        db.analytics_bulk_write('invalid_contacts', ['email'], rows)
     except Exception as get_exception:
         print(f"Error in insertHubspotID (contacts): {get_exception}")  # Handle any exceptions
     print("SUCCESS: Invalid Contacts succesfully added to the DB")
@@ -156,11 +314,13 @@ def insert_contact_ids(hubspotids):
         None
     """
     try:
-        query = 'insert into contacts ("hubspotID", email,type, created) values (%s, %s, %s,%s)'
-        # Iterate through the list of HubSpot contact IDs and insert them into the database
-        for contact in hubspotids:        
-            values = (int(contact[1]), contact[0], contact[3],contact[2])
-            db.analytics_db("UPDATE", query, values)
+        rows = [(int(contact[1]), contact[0], contact[3],contact[2]) for contact in hubspotids]
+        # Upsert all HubSpot contact IDs in one transaction
+        if db.analytics_bulk_write('contacts', ['hubspotID', 'email', 'type', 'created'],
+                                   rows, conflict=['hubspotID']):
+            # An upserted HubSpot ID may have had another email before
+            contact_ids.forget_ids([row[0] for row in rows])
+            contact_ids.update((row[1], row[0]) for row in rows)
     except Exception as get_exception:
         print(f"Error in insertHubspotID (contacts): {get_exception}")  # Handle any exceptions
     print("SUCCESS: Contacts succesfully added to the DB")
@@ -180,26 +340,26 @@ def delete_contacts(contacts):
         contact_list = ', '.join([f"'{contact[0]}'" for contact in contacts])
         db_query = f'delete from contacts where "hubspotID" in ({contact_list})'
         db.analytics_db("DELETE", db_query, None)
+        contact_ids.forget_ids([contact[0] for contact in contacts])
     except Exception as get_exception:
         print(f"Error in deleting HubSpotIDs (GET): {get_exception}")
     return True
 
-def get_serials():
+def iter_serials():
     """
-    Retrieve new serials from the database based on the last synchronization timestamp.
+    Retrieve new serials from the database based on the serials checkpoint.
+    A full sync streams the legacy serials scan in chunks. Read errors are
+    raised, so a failed read does not end like a sync without new serials.
 
-    Returns:
-        list: A list of dictionaries representing the new serials.
+    Yields:
+        tuple: A chunk of new serials and a dictionary mapping their emails to
+        contact HubSpot IDs.
     """
     try:
         print("START: Getting new serials")
-        contacts_dict ={}
-        new_serials = []
-        # Query to retrieve the last sync timestamp from the database
-        last_sync_query = "select max(created) from serials"
-        last_sync = db.analytics_db("GET",last_sync_query, None)
-        if last_sync[0][0] is None:
-            print("Serials table empty, start full Sync")
+        last_sync = get_checkpoint('serials', 'legacy')
+        if last_sync is None:
+            print("Serials never synced, start full Sync")
             db.analytics_db("ADD",'''
                     CREATE TABLE if not exists serials (
                         "hubspotID" bigint PRIMARY KEY,
@@ -230,14 +390,10 @@ def get_serials():
                             order by
                                 s.date asc 
         """
-            new_serials = db.legacy_db(serials_query,None)
-            if len(new_serials)>0:
-                serial_emails = ', '.join([f"'{serial[1]}'" for serial in new_serials])
-                hubspotids = db.analytics_db("GET",f'''
-                        select email,"hubspotID" from contacts where email in ({serial_emails})
-                        ''', None)
+            for new_serials in db.stream_query('legacy', serials_query, None):
                 # Create a dictionary mapping email addresses to hubspot IDs
-                contacts_dict = {email: hubspot_id for email, hubspot_id in hubspotids}
+                contacts_dict = contact_ids.resolve([serial[1] for serial in new_serials])
+                yield (new_serials,contacts_dict)
 
         else:
             # Query to retrieve new serials from the database
@@ -258,42 +414,57 @@ def get_serials():
                             FROM_UNIXTIME(s.date, '%Y-%m-%d %h:%i:%s') as created_long
                                 from
                                     serials s
-                                 where FROM_UNIXTIME(s.date, '%Y-%m-%d %h:%i:%s') > '{last_sync[0][0]}'
+                                 where FROM_UNIXTIME(s.date, '%Y-%m-%d %h:%i:%s') > '{last_sync}'
                                 order by
                                     s.date asc
             """
+            contacts_dict ={}
             new_serials = db.legacy_db(serials_query,None)
             if len(new_serials) ==0 :
                 print("DB: No New Serials")
             else:
-                serial_list = ', '.join([f"'{serial[1]}'" for serial in new_serials])
-                # Query to retrieve contact hubspot ids
-                hubspotids_query = f"""select email,"hubspotID" from contacts 
-                where email in ({serial_list})"""
-                hubspotids = db.analytics_db("GET",hubspotids_query, None)
-                if hubspotids == []:
+                # Create a dictionary mapping email addresses to hubspot IDs
+                contacts_dict = contact_ids.resolve([serial[1] for serial in new_serials])
+                if len(contacts_dict) == 0:
                     print("NOTE: Serial contacts not yet added to hubspot")
-                else:
-                    # Create a dictionary mapping email addresses to hubspot IDs
-                    contacts_dict = {email: hubspot_id for email, hubspot_id in hubspotids}
+            yield (new_serials,contacts_dict)
     except Exception as get_exception:
         print(f"Error in Serials (GET): {get_exception}")
+        raise
+
+def get_serials():
+    """
+    Retrieve new serials from the database based on the last synchronization timestamp.
+
+    Returns:
+        tuple: A list of new serials and a dictionary mapping their emails to
+        contact HubSpot IDs.
+    """
+    new_serials = []
+    contacts_dict = {}
+    for serials, contacts in iter_serials():
+        new_serials.extend(serials)
+        contacts_dict.update(contacts)
     return (new_serials,contacts_dict)
 
 def get_updated_serials():
     """
-    Retrieve updated serials from the database based on the last synchronization timestamp.
+    Retrieve serials updated since the serials update checkpoint.
     Run this before updating associations because they both rely on the updated column
 
     Returns:
-        list: A list of dictionaries representing the updated serials.
+        tuple: The updated serials, and the end of their window to advance the
+        checkpoint to once they were sent, or None when there is no window.
     """
     print("START: Getting updated serials")
     final = []
+    until = None
     try:
-        # Query to retrieve the minimum updated timestamp from the database
-        query = "select max(created) from serials"
-        last_sync = db.analytics_db( "GET",query, None)
+        last_sync = get_checkpoint('serials', 'legacy', 'updated')
+        if last_sync is None:
+            print("No Serials to be updated")
+            return (final, until)
+        until = source_now('legacy')
         # Query to retrieve updated serials from the database
         query = f"""
                     select  s.serial,
@@ -311,21 +482,16 @@ def get_updated_serials():
                     FROM_UNIXTIME(s.date, '%Y-%m-%d %h:%i:%s') as created_long
         from
             serials s
-            where last_updated_on > '{last_sync[0][0]}'
+            where last_updated_on > '{last_sync}' and last_updated_on <= '{until}'
             and 'deletedAt' is  null
         """
         updated_serials = db.legacy_db( query, None)
         print("SUCCESS: Updated serials retrieved from DB")
-        serial_list = ', '.join([f"'{serial[0]}'" for serial in updated_serials])
-        if serial_list =="":
+        if len(updated_serials) == 0:
             print("No New Serials")
         else:
-            # Query to retrieve contact hubspot ids
-            hubspotids_query = f"""select serial,"hubspotID" from serials
-            where serial in ({serial_list})"""
-            hubspotids = db.analytics_db("GET",hubspotids_query, None)
-        # Create a dictionary mapping email addresses to hubspot IDs
-            hubspot_dict = {serial: hubspot_id for serial, hubspot_id in hubspotids}
+            # Create a dictionary mapping serials to hubspot IDs
+            hubspot_dict = serial_ids.resolve([serial[0] for serial in updated_serials])
             # Join the two lists based on email addresses
             for serial in updated_serials:
                 serialid = serial[0]  # Assuming email is at index 1 in the new_serials tuples
@@ -334,7 +500,8 @@ def get_updated_serials():
                     final.append((*serial, hubspot_id))
     except Exception as get_exception:
         print(f"Error in Serials (UPDATED): {get_exception}")
-    return final
+        raise
+    return (final, until)
 
 def insert_serial_ids(hubspotids):
     """
@@ -348,12 +515,11 @@ def insert_serial_ids(hubspotids):
     """
     print("START: Inserting new serial HubSpot IDs")
     try:
-        # Define the SQL query for inserting data
-        query = 'insert into serials ("hubspotID", serial, created) values (%s, %s, %s)'
-        # Iterate over the provided HubSpot IDs
-        for serial in hubspotids:
-            values = (int(serial[0]), serial[1], serial[2])
-            db.analytics_db("UPDATE", query, values)
+        rows = [(int(serial[0]), serial[1], serial[2]) for serial in hubspotids]
+        # Upsert all serial HubSpot IDs in one transaction
+        if db.analytics_bulk_write('serials', ['hubspotID', 'serial', 'created'],
+                                   rows, conflict=['hubspotID']):
+            serial_ids.update((row[1], row[0]) for row in rows)
         print("SUCCESS: New serial HubSpot IDs inserted")
     except Exception as get_exception:
         print(f"Error in insertHubspotID (serials): {get_exception}")
@@ -371,23 +537,30 @@ def delete_serial_ids():
     print("START: Deleting serials on DB")
     hubspot_ids = []
     try:
-        query = "select max(created) from serials"
-        last_sync = db.analytics_db( "GET",query, None)
+        last_sync = get_checkpoint('serials', 'legacy', 'deleted')
+        if last_sync is None:
+            print("No serials to be deleted")
+            return hubspot_ids
+        until = source_now('legacy')
         query = f"""
                     select  s.serial  from
             serials s
-            where "deletedAt" > '{last_sync[0][0]}'
+            where "deletedAt" > '{last_sync}' and "deletedAt" <= '{until}'
         """
         deleted_serials = db.legacy_db( query, None)
+        checkpoint = checkpoint_statement('serials', 'legacy', 'deleted', [until])
         if len(deleted_serials)>0:
             # Query to retrieve HubSpot IDs for the provided serials
             serial_list = ', '.join([f"'{serial[0]}'" for serial in deleted_serials])
             hubspot_query = f'select "hubspotID" from serials where serial in ({serial_list})'
             hubspot_ids = db.analytics_db("GET", hubspot_query, None)
+            # The window is closed in the transaction deleting its serials
             query = f'delete from serials where serial in ({serial_list})'
-            db.analytics_db("DELETE", query, None)
+            db.analytics_transaction([(query, None), checkpoint])
+            serial_ids.forget([serial[0] for serial in deleted_serials])
             print("SUCCESS: Serial IDs deleted from the database")
         else:
+            db.analytics_transaction([checkpoint])
             print("No serials to be deleted")
     except Exception as get_exception:
         print(f"Error in Serials (DELETE): {get_exception}")
@@ -415,24 +588,21 @@ def get_workspaces(subscriptions=None,customers_list=None):
                 'subscription_id','created', 'customer','ended_at',
                 'plan_id','plan','quantity','status',
                 'trial_start','trial_end','current_period_end','email','priority','payment_menthod','auto_renew'])
-            # Create a comma-separated string of workspace customer IDs for the next query
-            customers_string = ', '.join([f"'{customer}'" for customer in customers_list])
             # Query to retrieve customer IDs from the payments database
-            query = f"""
+            query = """
                         SELECT 
                             id as payments_id, 
                             external_id
                         FROM customers 
-                        WHERE external_id IN ({customers_string})
+                        WHERE external_id = ANY(%s)
                         """
-            workspace_customers = db.payments_db(query, None)
+            workspace_customers = db.lookup('payments', query, customers_list)
             workspace_customers_df = pd.DataFrame(workspace_customers, 
                                                   columns=['payments_id', 'external_id'])
 
             print(f"workspace_customers:{len(workspace_customers)}")
 
-            payments_string = ', '.join([f"'{id}'" for id,customer in workspace_customers])
-            query = f"""
+            query = """
                         SELECT 
                             id, 
                             name,
@@ -440,10 +610,10 @@ def get_workspaces(subscriptions=None,customers_list=None):
                             "createdAt",
                             "customerId"
                         FROM "Organizations" 
-                        WHERE "customerId" in ({payments_string})
+                        WHERE "customerId" = ANY(%s)
                         ORDER BY "createdAt" ASC
                         """
-            workspaces = db.cloud_db(query, None)
+            workspaces = db.lookup('cloud', query, [id for id,customer in workspace_customers])
             workspaces_df = pd.DataFrame(workspaces, columns=
                         ['id', 'name', 'identifier', 'createdAt', 'customerId'])
             # Perform the joins
@@ -461,10 +631,8 @@ def get_workspaces(subscriptions=None,customers_list=None):
             print(f"Error in Workspaces (GET): {get_exception}")
     else:
         try:
-            # Query to retrieve the last updated memberships from the analytics database
-            query = "SELECT MAX(created) FROM workspaces"
-            last_sync = db.analytics_db("GET", query, None)
-            if last_sync[0][0] is None:
+            last_sync = get_checkpoint('workspaces', 'cloud')
+            if last_sync is None:
                 print(""" WORKSPACES TABLE EMPTY: PLEASE RUN -- 
                 `python main.py create_all_workspaces` -- TO TRIGGER A FULL SYNC""")
             else:
@@ -477,39 +645,51 @@ def get_workspaces(subscriptions=None,customers_list=None):
                                 "createdAt",
                                 "customerId"
                             FROM "Organizations" 
-                            WHERE "createdAt" > '{last_sync[0][0]}' and "deletedAt" is null
+                            WHERE "createdAt" > '{last_sync}' and "deletedAt" is null
                             ORDER BY "createdAt" ASC 
                             """
                 workspaces = db.cloud_db(query, None)
-                if len(workspaces) > 0:
-                    # Create a comma-separated string of workspace customer IDs for the next query
-                    workspaces_list = ', '.join([f"'{workspace[4]}'" for workspace in workspaces 
-                                                 if workspace[4] is not None])
-                    # Query to retrieve customer IDs from the payments database
-                    query = f"""
-                                SELECT 
-                                    id, 
-                                    external_id
-                                FROM customers 
-                                WHERE id IN ({workspaces_list})
-                                """
-                    workspace_customers = db.payments_db(query, None)
-
-                    # Create a dictionary mapping payment IDs to external IDs
-                    customers_dict = {id: external_id for id, external_id in workspace_customers}
-
-                    # Join workspace data and customer IDs based on payment IDs
-                    for workspace in workspaces:
-                        payments_id = workspace[4]
-                        customer_id = customers_dict.get(payments_id, None)
-                        if customer_id is not None:
-                            final_workspaces.append((*workspace, customer_id))
+                final_workspaces = join_workspace_customers(workspaces)
         except Exception as get_exception:
             # Handle exceptions and print an error message
             print(f"Error in Workspaces (GET): {get_exception}")
         print(f"final_workspaces:{len(final_workspaces)}")
     return final_workspaces
 
+def join_workspace_customers(workspaces):
+    """
+    Add the Stripe customer ID to Organizations rows, dropping the rows without one.
+
+    Args:
+        workspaces (list): Tuples (id, name, identifier, createdAt, customerId).
+
+    Returns:
+        list: The workspace tuples with the Stripe customer ID appended.
+    """
+    final_workspaces = []
+    if len(workspaces) > 0:
+        # Query to retrieve customer IDs from the payments database
+        query = """
+                    SELECT 
+                        id, 
+                        external_id
+                    FROM customers 
+                    WHERE id = ANY(%s)
+                    """
+        workspace_customers = db.lookup('payments', query,
+                                        [workspace[4] for workspace in workspaces])
+
+        # Create a dictionary mapping payment IDs to external IDs
+        customers_dict = {id: external_id for id, external_id in workspace_customers}
+
+        # Join workspace data and customer IDs based on payment IDs
+        for workspace in workspaces:
+            payments_id = workspace[4]
+            customer_id = customers_dict.get(payments_id, None)
+            if customer_id is not None:
+                final_workspaces.append((*workspace, customer_id))
+    return final_workspaces
+
 def get_workspace_hubspot_id(customer):
     """
     Retrieve HubSpot ID associated with a specific customer's workspace.
@@ -524,6 +704,134 @@ def get_workspace_hubspot_id(customer):
     hubspotid = db.analytics_db("GET",query, None)
     return hubspotid
 
+def get_workspace_hubspot_ids(customers):
+    """
+    Retrieve the HubSpot IDs of the workspaces billed to the given Stripe customers.
+
+    Args:
+        customers (list): Stripe customer IDs.
+
+    Returns:
+        list: List of tuples (customer, hubspotID).
+    """
+    query = """select customer,"hubspotID" from workspaces where customer = ANY(%s)"""
+    return db.lookup('analytics', query, customers)
+
+def get_sync_checkpoint(name):
+    """
+    Retrieve the position and token a sync or backfill stopped at.
+
+    Args:
+        name (str): Name of the sync, e.g. 'stripe_backfill'.
+
+    Returns:
+        tuple: (position, token), or None if nothing was stored.
+    """
+    db.analytics_db("ADD",'''
+            CREATE TABLE if not exists sync_cursors (
+                name character varying PRIMARY KEY,
+                position bigint,
+                token character varying,
+                updated timestamp without time zone
+            )
+            ''', None)
+    db.analytics_db("ADD", "ALTER TABLE sync_cursors ADD COLUMN IF NOT EXISTS token character varying",
+                    None)
+    query = "select position, token from sync_cursors where name = %s"
+    checkpoint = db.analytics_db("GET", query, (name,))
+    if checkpoint is None or len(checkpoint) == 0:
+        return None
+    return checkpoint[0]
+
+def get_sync_cursor(name):
+    """
+    Retrieve the position an incremental sync stopped at.
+
+    Args:
+        name (str): Name of the sync, e.g. 'stripe_events'.
+
+    Returns:
+        int: The stored position, or None if the sync never ran.
+    """
+    checkpoint = get_sync_checkpoint(name)
+    if checkpoint is None:
+        return None
+    return checkpoint[0]
+
+def set_sync_cursor(name, position, token=None):
+    """
+    Store the position an incremental sync has processed up to.
+
+    Args:
+        name (str): Name of the sync, e.g. 'stripe_events'.
+        position (int): Position to resume from on the next run.
+        token (str): Opaque resume token, e.g. a Stripe pagination cursor.
+
+    Returns:
+        bool: True if the position was stored, None otherwise.
+    """
+    query = """insert into sync_cursors (name, position, token, updated)
+               values (%s, %s, %s, now())
+               on conflict (name) do update set position = excluded.position,
+               token = excluded.token, updated = excluded.updated"""
+    return db.analytics_db("UPDATE", query, (name, position, token))
+
+def clear_sync_cursor(name):
+    """
+    Forget a stored position, e.g. once a backfill has completed.
+
+    Args:
+        name (str): Name of the sync, e.g. 'stripe_backfill'.
+
+    Returns:
+        None
+    """
+    db.analytics_db("DELETE", "delete from sync_cursors where name = %s", (name,))
+
+def get_cached_customers(customer_ids, ttl):
+    """
+    Retrieve cached Stripe customers fetched less than `ttl` seconds ago,
+    and mark them as recently used.
+
+    Args:
+        customer_ids (list): Stripe customer IDs.
+        ttl (int): Maximum age of a cached customer in seconds.
+
+    Returns:
+        list: List of tuples (id, email) for the cached customers.
+    """
+    db.analytics_db("ADD",'''
+            CREATE TABLE if not exists stripe_customers (
+                id character varying PRIMARY KEY,
+                email character varying,
+                fetched timestamp with time zone,
+                used timestamp with time zone
+            )
+            ''', None)
+    query = """update stripe_customers set used = now() where id = ANY(%s)
+               and fetched > now() - %s * interval '1 second' returning id, email"""
+    return db.lookup('analytics', query, customer_ids, (ttl,))
+
+def cache_customers(customers, max_size):
+    """
+    Store fetched Stripe customers, evicting the least recently used ones
+    once the cache holds more than `max_size` customers.
+
+    Args:
+        customers (list): List of tuples (id, email).
+        max_size (int): Maximum number of cached customers.
+
+    Returns:
+        None
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    rows = [(customer_id, email, now, now) for customer_id, email in customers]
+    db.analytics_bulk_write('stripe_customers', ['id', 'email', 'fetched', 'used'],
+                            rows, conflict=['id'])
+    db.analytics_db("DELETE", """delete from stripe_customers where id in (
+                        select id from stripe_customers order by used desc offset %s)""",
+                    (max_size,))
+
 def add_contact_hubspot_id(workspaces):
     """
     Add HubSpot ID to the workspace data.
@@ -536,14 +844,8 @@ def add_contact_hubspot_id(workspaces):
     """
     print("START: Getting contact associations")
     final_workspaces = []
-    contacts_list =  ', '.join([f"'{workspace[3]}'" for workspace in workspaces 
-                                if workspace[3] is not None])
-    query = f"""select email,"hubspotID" from contacts where email in ({contacts_list}) and  email NOT ILIKE '%''%'
-              ESCAPE '#'"""
-    hubspot_ids = db.analytics_db("GET",query, None)
-
-    # Create a dictionary mapping payment IDs to external IDs
-    contacts_dict = {email: hubspot_id for email, hubspot_id in hubspot_ids}
+    # Create a dictionary mapping emails to contact HubSpot IDs
+    contacts_dict = contact_ids.resolve(_unquoted([workspace[3] for workspace in workspaces]))
 
     # Join workspace data and customer IDs based on payment IDs
     for workspace in workspaces:
@@ -562,13 +864,11 @@ def insert_workspace_ids(hubspotids):
         hubspotids (list): A list of tuples containing HubSpot ID, SketchID, and created date.
 
     Returns:
-        None
+        bool: True if the IDs were stored, None otherwise.
     """
     print("START: Inserting new Workspaces HubSpot IDs")
     try:
-        # Define the SQL query for inserting data
-        query = """insert into workspaces ("hubspotID", workspace,customer, created) 
-        values (%s, %s,%s, %s)"""
+        rows = []
         # Iterate over the provided HubSpot IDs
         for workspace in hubspotids:
             # Remove trailing zeros from fractional seconds
@@ -582,12 +882,16 @@ def insert_workspace_ids(hubspotids):
                 date = timestamp_datetime.strftime('%Y-%m-%d %H:%M:%S')
             else:
                 date =workspace[2]
-            values = (int(workspace[0]), workspace[1], workspace[4], date)
-            db.analytics_db("UPDATE", query, values)
-        print("SUCCESS: New Workspace HubSpot IDs inserted")
+            rows.append((int(workspace[0]), workspace[1], workspace[4], date))
+        # Upsert all workspace HubSpot IDs in one transaction
+        if db.analytics_bulk_write('workspaces', ['hubspotID', 'workspace', 'customer', 'created'],
+                                   rows, conflict=['hubspotID']):
+            workspace_ids.update((row[1], row[0]) for row in rows)
+            print("SUCCESS: New Workspace HubSpot IDs inserted")
+            return True
     except Exception as get_exception:
         print(f"Error in insertHubspotID (Workspaces): {get_exception}")
-    return True
+    return None
 
 def delete_workspace_ids(query=None):
     """
@@ -601,14 +905,13 @@ def delete_workspace_ids(query=None):
     workspace_list = []
     if query is None:
         try:
-            query = "select max(created) from workspaces"
-            last_sync = db.analytics_db( "GET",query, None)
-            if last_sync[0][0] is not None:
+            last_sync = get_checkpoint('workspaces', 'cloud', 'deleted')
+            if last_sync is not None:
                 query = f"""
                                     SELECT 
                                         id
                                     FROM "Organizations" 
-                                    WHERE "deletedAt" > '{last_sync[0][0]}' 
+                                    WHERE "deletedAt" > '{last_sync}' 
                                     """
                 workspaces = db.cloud_db(query, None)
                 if len(workspaces) > 0:
@@ -626,6 +929,7 @@ def delete_workspace_ids(query=None):
         if len(hubspot_ids) > 0:
             query = f'delete from workspaces where workspace in ({workspace_list})'
             db.analytics_db("DELETE", query, None)
+            workspace_ids.forget_ids([hubspot_id[0] for hubspot_id in hubspot_ids])
             print("SUCCESS: Workspace IDs deleted from the database")
         else:
             print("No workspaces to be deleted")
@@ -641,22 +945,21 @@ def get_memberships():
     contacts_dict = []
     workspaces_dict = []
     new_memberships = []
-    # Query to retrieve the last created membership
-    query = "select max(created) from memberships"
-    last_sync = db.analytics_db("GET",query, None)
-    if last_sync[0][0] is None:
-        print("Memberships table empty, Running full sync")
+    last_sync = get_checkpoint('memberships', 'cloud')
+    if last_sync is None:
+        print("Memberships never synced, Running full sync")
         try:
-            query = 'select workspace,"hubspotID" from workspaces'
-            workspaces = db.analytics_db("GET",query, None)
+            # Stored workspaces and memberships are read together
+            workspaces, memberships = db.parallel(
+                lambda: db.analytics_db("GET", 'select workspace,"hubspotID" from workspaces', None),
+                lambda: db.analytics_db("GET", 'select member from memberships', None))
+            workspace_ids.update(workspaces)
             if len(workspaces)>0:
-                query = 'select member from memberships'
-                memberships = db.analytics_db("GET",query, None)
-                memberships_list = ', '.join([f"'{member[0]}'" for member in memberships])
+                # Stored memberships are skipped here rather than bound as one unbounded array
+                stored = set(str(member[0]) for member in memberships)
 
-                workspaces_list = ', '.join([f"'{workspace[0]}'" for workspace in workspaces])
                 # Query to retrieve new memberships from the database
-                query = f"""
+                query = """
                 SELECT 
                     om.id, 
                     om."UserId", 
@@ -676,10 +979,12 @@ def get_memberships():
                     u.email 
                     FROM "OrganizationMemberships" om
                     LEFT JOIN "Users" u on (u.id = om."UserId")
-                    where om."OrganizationId" in ({workspaces_list}) and role != 'guest' and  om.id not in ({memberships_list})
+                    where om."OrganizationId" = ANY(%s) and role != 'guest'
                     order by om."createdAt" asc 
                 """
-                new_memberships = db.cloud_db( query, None)
+                new_memberships = [member for member in
+                                   db.lookup('cloud', query, [workspace[0] for workspace in workspaces])
+                                   if str(member[0]) not in stored]
                 print(f"Memberships: {len(new_memberships)}")
                 # Create a dictionary mapping workspace ids to hubspot IDs
                 workspaces_dict = {workspace: hubspot_id for workspace, hubspot_id in workspaces}
@@ -689,19 +994,13 @@ def get_memberships():
                     email = member[7]
                     if email is not None:
                         email_list_str.append(email.replace("'", ""))
-                email_list = ', '.join([f"'{member}'" for member in email_list_str])
-                if email_list =="":
+                if len(email_list_str) == 0:
                     print("DB: No New Memberships")
                 else:
-                    # Query to retrieve contact hubspot ids
-                    hubspotids_query = f"""select email,"hubspotID" from contacts
-                            where email in ({email_list}) and email NOT ILIKE '%''%' ESCAPE '#'"""
-                    hubspotids = db.analytics_db("GET",hubspotids_query, None)
-                    if hubspotids == []:
+                    # Create a dictionary mapping email addresses to hubspot IDs
+                    contacts_dict = contact_ids.resolve(_unquoted(email_list_str))
+                    if len(contacts_dict) == 0:
                         print("NOTE: Membership contacts not yet added to hubspot")
-                    else:
-                        # Create a dictionary mapping email addresses to hubspot IDs
-                        contacts_dict = {email: hubspot_id for email, hubspot_id in hubspotids}
             else:
                 print("""WORKSPACES TABLE EMPTY: PLEASE RUN -- 
                 `python main.py create_all_workspaces`
@@ -731,49 +1030,53 @@ def get_memberships():
                 u.email 
                 FROM "OrganizationMemberships" om
                 LEFT JOIN "Users" u on (u.id = om."UserId")
-                where om."createdAt" > '{last_sync[0][0]}'
+                where om."createdAt" > '{last_sync}'
                 order by om."createdAt" asc 
             """
             new_memberships = db.cloud_db( query, None)
-            #get workspace hubspot ids
-            workspaces_list = ', '.join([f"'{member[2]}'" for member in new_memberships])
-            if workspaces_list =="":
-                print("DB: No New Memberships")
-            else:
-                # Query to retrieve workspace hubspot ids
-                hubspotids_query = f"""select workspace,"hubspotID" from workspaces 
-                                                where workspace in ({workspaces_list})"""
-                hubspotids = db.analytics_db("GET",hubspotids_query, None)
-                if hubspotids == []:
-                    print("NOTE: workspaces not yet added to hubspot")
-                else:
-                    # Create a dictionary mapping workspace ids to hubspot IDs
-                    workspaces_dict = {workspace: hubspot_id for workspace, hubspot_id 
-                                       in hubspotids}
-                # Query to retrieve contact hubspot ids
-            email_list_str = []
-            for member in new_memberships:
-                email = member[7]
-                if email is not None:
-                    email_list_str.append(email.replace("'", ""))
-            email_list = ', '.join([f"'{member}'" for member in email_list_str])
-            if email_list =="":
-                print("DB: No New Memberships")
-            else:
-                # Query to retrieve contact hubspot ids
-                hubspotids_query = f"""select email,"hubspotID" from contacts where email in
-                  ({email_list})
-                and email NOT ILIKE '%''%' ESCAPE '#' """
-                hubspotids = db.analytics_db("GET",hubspotids_query, None)
-                if hubspotids == []:
-                    print("NOTE: Membership contacts not yet added to hubspot")
-                else:
-                    # Create a dictionary mapping email addresses to hubspot IDs
-                    contacts_dict = {email: hubspot_id for email, hubspot_id in hubspotids}
+            contacts_dict, workspaces_dict = membership_hubspot_ids(new_memberships)
         except Exception as get_exception:
             print(f"Error in Memberships (GET): {get_exception}")
     return (new_memberships,contacts_dict,workspaces_dict)
 
+def membership_hubspot_ids(new_memberships):
+    """
+    Look up the contact and workspace HubSpot IDs of new memberships.
+
+    Args:
+        new_memberships (list): Membership tuples as returned by get_memberships.
+
+    Returns:
+        tuple: Dictionaries mapping emails and workspace ids to HubSpot IDs.
+    """
+    contacts_dict = {}
+    workspaces_dict = {}
+    email_list_str = []
+    for member in new_memberships:
+        email = member[7]
+        if email is not None:
+            email_list_str.append(email.replace("'", ""))
+    # Both lookups only depend on the new memberships, run them together
+    workspaces_found, contacts_found = db.parallel(
+        lambda: workspace_ids.resolve([member[2] for member in new_memberships]),
+        lambda: contact_ids.resolve(_unquoted(email_list_str)))
+    #get workspace hubspot ids
+    if len(new_memberships) == 0:
+        print("DB: No New Memberships")
+    elif len(workspaces_found) == 0:
+        print("NOTE: workspaces not yet added to hubspot")
+    else:
+        # Create a dictionary mapping workspace ids to hubspot IDs
+        workspaces_dict = workspaces_found
+    if len(email_list_str) == 0:
+        print("DB: No New Memberships")
+    elif len(contacts_found) == 0:
+        print("NOTE: Membership contacts not yet added to hubspot")
+    else:
+        # Create a dictionary mapping email addresses to hubspot IDs
+        contacts_dict = contacts_found
+    return (contacts_dict, workspaces_dict)
+
 def insert_membership_ids(hubspotids):
     """
     Insert new HubSpot IDs for memberships into the database.
@@ -786,30 +1089,30 @@ def insert_membership_ids(hubspotids):
     """
     print("START: Inserting new Memberships HubSpot IDs")
     try:
-        # Define the SQL query for inserting data
-        query = 'insert into memberships ("hubspotID", member, created) values (%s, %s, %s)'
-        # Iterate over the provided HubSpot IDs
-        for membership in hubspotids:
-            values = (int(membership[0]), membership[1], membership[2])
-            db.analytics_db("UPDATE", query, values)
+        rows = [(int(membership[0]), membership[1], membership[2]) for membership in hubspotids]
+        # Upsert all membership HubSpot IDs in one transaction
+        if db.analytics_bulk_write('memberships', ['hubspotID', 'member', 'created'],
+                                   rows, conflict=['hubspotID']):
+            membership_ids.update((row[1], row[0]) for row in rows)
         print("SUCCESS: New Memberships HubSpot IDs inserted")
     except Exception as get_exception:
         print(f"Error in insertHubspotID (Memberships): {get_exception}")
 
 def get_updated_memberships():
     """
-    Retrieves updated organization memberships from the database.
+    Retrieves organization memberships updated since the memberships update checkpoint.
 
     Returns:
-        list: A list of updated organization memberships.
+        tuple: The updated memberships, and the end of their window to advance
+        the checkpoint to once they were sent, or None when there is no window.
     """
     print("START: Get updated memberships")
     final =[]
+    until = None
     try:
-        # Query to retrieve the last updated memberships
-        query = "select max(created) from memberships"
-        last_sync = db.analytics_db("GET",query, None)
-        if last_sync[0][0] is not None:
+        last_sync = get_checkpoint('memberships', 'cloud', 'updated')
+        if last_sync is not None:
+            until = source_now('cloud')
             # Query to retrieve updated memberships from the database
             query = f"""
             SELECT 
@@ -831,18 +1134,13 @@ def get_updated_memberships():
                 u.email 
                 FROM "OrganizationMemberships" om
                 LEFT JOIN "Users" u on (u.id = om."UserId")
-                where om."updatedAt" > '{last_sync[0][0]}'
+                where om."updatedAt" > '{last_sync}' and om."updatedAt" <= '{until}'
             """
             memberships = db.cloud_db( query, None)
 
-            memberships_list = ', '.join([f"'{member[0]}'" for member in memberships])
-            if memberships_list !="":
-                # Query to retrieve members hubspot ids
-                hubspotids_query = f"""select member,"hubspotID" from memberships 
-                                        where member in ({memberships_list})"""
-                hubspotids = db.analytics_db("GET",hubspotids_query, None)
-            # Create a dictionary mapping sketchids  to hubspot IDs
-                hubspot_dict = {member: hubspot_id for member, hubspot_id in hubspotids}
+            if len(memberships) > 0:
+                # Create a dictionary mapping sketchids  to hubspot IDs
+                hubspot_dict = membership_ids.resolve([member[0] for member in memberships])
                 # Join the two lists based on sketchids
                 for member in memberships:
                     sketchid = member[0]  # Assuming email is at index 1 in the new_serials tuples
@@ -854,7 +1152,8 @@ def get_updated_memberships():
 
     except Exception as get_exception:
         print(f"Error in Serials (UPDATED): {get_exception}")
-    return final
+        raise
+    return (final, until)
 
 def delete_memberships(payload):
     """
@@ -886,6 +1185,7 @@ def delete_memberships(payload):
                 if len(hubspot_ids) > 0:
                     query = f'delete from memberships where member in ({memberships_list})'
                     db.analytics_db("DELETE", query, None)
+                    membership_ids.forget([member[0] for member in memberships])
                     print("SUCCESS: Memberships IDs deleted from the database")
                 else:
                     print("No Memberships to be deleted")
@@ -979,15 +1279,16 @@ def memberships_associations():
         query = """SELECT "hubspotID", member as id FROM memberships 
                                     WHERE created > '2023-12-17' """
         memberships = db.analytics_db("GET", query, None)
-        memberships_list = ', '.join([f"'{member[1]}'" for member in memberships])
         # Query to fetch membership data from another database
-        analytics_query = f"""SELECT mem.id, u.email, mem."OrganizationId"
+        analytics_query = """SELECT mem.id, u.email, mem."OrganizationId"
                             FROM cloud."OrganizationMemberships" mem
                             LEFT JOIN cloud."Users" u ON mem."UserId" = u.id
-                            WHERE mem.id IN ({memberships_list}) AND u.email 
-                            NOT ILIKE '%''%' ESCAPE '#'"""
-        memberships_data = db.analytics_db("GET", analytics_query, None)
+                            WHERE mem.id = ANY(%s) AND u.email 
+                            NOT ILIKE '%%''%%' ESCAPE '#'"""
+        memberships_data = db.lookup('analytics', analytics_query,
+                                     [member[1] for member in memberships])
         memberships_all_dict = {member[1]: member[0] for member in memberships}
+        membership_ids.update((member[1], member[0]) for member in memberships)
 
         # Join membership data and IDs based on payment IDs
         for member in memberships_data:
@@ -996,19 +1297,10 @@ def memberships_associations():
             if hub_id is not None:
                 membership_all.append((*member, hub_id))
 
-        # Create a string of emails for query use
-        email_list = ', '.join([f"'{email[1]}'" for email in memberships_data])
-        query = f"""SELECT email, "hubspotID" FROM contacts WHERE email IN ({email_list})"""
-        hubspot_email = db.analytics_db("GET", query, None)
-        # Create a string of workspaces for query use
-        workspace_list = ', '.join([f"'{org[2]}'" for org in memberships_data])
-        query = f"""SELECT workspace, "hubspotID" FROM workspaces 
-                                WHERE workspace IN ({workspace_list})"""
-        hubspot_workspace = db.analytics_db("GET", query, None)
-
-        # Create dictionaries to map emails and workspaces to IDs
-        memberships_email_dict = {member[0]: member[1] for member in hubspot_email}
-        memberships_workspace_dict = {member[0]: member[1] for member in hubspot_workspace}
+        # Look up contact IDs by email and workspace IDs together
+        memberships_email_dict, memberships_workspace_dict = db.parallel(
+            lambda: contact_ids.resolve([email[1] for email in memberships_data]),
+            lambda: workspace_ids.resolve([org[2] for org in memberships_data]))
 
         # Join membership data and customer IDs based on emails
         for member in membership_all:
@@ -1027,4 +1319,345 @@ def memberships_associations():
         print(f"Error in Workspaces (ASSOCIATE): {get_exception}")
     
     # Return the completed associations
-    return membership_workspace
\ No newline at end of file
+    return membership_workspace
+
+
+# Cloud tables whose row changes are captured, with the operations recorded and
+# the columns whose updates are recorded; None records every update. Deleted
+# users and identities are not captured: their email may still belong to
+# another user, identity or legacy serial, and contacts were never deleted by
+# the polling syncs either, so their HubSpot contacts are kept
+CAPTURED_TABLES = {
+    'Users': ('INSERT OR UPDATE', ['email']),
+    'ExternalIdentities': ('INSERT OR UPDATE', ['email']),
+    'Organizations': ('INSERT OR DELETE OR UPDATE', ['deletedAt']),
+    'OrganizationMemberships': ('INSERT OR DELETE OR UPDATE', None),
+}
+# Channel notified by the capture triggers whenever changes are recorded
+CHANGES_CHANNEL = 'hubspot_changes'
+# Captured memberships whose contact or workspace has no HubSpot ID yet
+WAITING_MEMBERSHIPS_TABLE = """
+    CREATE TABLE if not exists waiting_memberships (
+        member character varying PRIMARY KEY,
+        since timestamp with time zone
+    )
+"""
+# Memberships of given ids, in the shape returned by get_memberships
+MEMBERSHIPS_BY_ID_QUERY = """
+    SELECT 
+        om.id, 
+        om."UserId", 
+        om."OrganizationId", 
+        om.role, 
+        case 
+            when om."isPrimary" = True
+            then 'yes'
+            else 'no'
+            end as "isPrimary",
+        case 
+            when om."isContributor" = True
+            then 'yes'
+            else 'no'
+            end as "isContributor", 
+        om."createdAt", 
+        u.email 
+        FROM "OrganizationMemberships" om
+        LEFT JOIN "Users" u on (u.id = om."UserId")
+        where om.id = ANY(%s)
+        order by om."createdAt" asc 
+"""
+
+def install_change_capture():
+    """
+    Install the triggers recording the row changes of CAPTURED_TABLES on the cloud database.
+
+    Every captured insert, update and delete is appended to the hubspot_changes
+    table and announced on CHANGES_CHANNEL, including deletes that leave no
+    "deletedAt" behind. Running it again replaces the triggers.
+
+    Returns:
+        bool: True if the triggers were installed, None otherwise.
+    """
+    print("START: Installing change capture on the cloud DB")
+    statements = [('''
+            CREATE TABLE if not exists hubspot_changes (
+                id bigserial PRIMARY KEY,
+                "table" character varying,
+                op character varying,
+                row_id character varying,
+                changed timestamp with time zone default now(),
+                txid bigint default txid_current()
+            )
+            ''', None), ('''
+            ALTER TABLE hubspot_changes ADD COLUMN IF NOT EXISTS txid bigint default txid_current()
+            ''', None), ('''
+            CREATE INDEX if not exists hubspot_changes_txid ON hubspot_changes (txid, id)
+            ''', None), (f'''
+            CREATE OR REPLACE FUNCTION hubspot_capture_change() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    INSERT INTO hubspot_changes ("table", op, row_id)
+                    VALUES (TG_TABLE_NAME, TG_OP, OLD.id);
+                ELSE
+                    INSERT INTO hubspot_changes ("table", op, row_id)
+                    VALUES (TG_TABLE_NAME, TG_OP, NEW.id);
+                END IF;
+                PERFORM pg_notify('{CHANGES_CHANNEL}', TG_TABLE_NAME);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            ''', None)]
+    for table, (events, columns) in CAPTURED_TABLES.items():
+        if columns is not None:
+            events += ' OF ' + ', '.join(f'"{column}"' for column in columns)
+        statements.append((f'DROP TRIGGER IF EXISTS hubspot_capture ON "{table}"', None))
+        statements.append((f'''CREATE TRIGGER hubspot_capture AFTER {events} ON "{table}"
+                               FOR EACH ROW EXECUTE FUNCTION hubspot_capture_change()''', None))
+    response = db.transaction('cloud', statements)
+    if response is not None:
+        print("SUCCESS: Change capture installed")
+    return response
+
+def get_changes(after, limit):
+    """
+    Retrieve the captured changes recorded after a position.
+
+    Ids are taken when a change is written, not when it commits, so a change
+    can show up after ones with a higher id. Only changes of transactions
+    older than every transaction still running are read, and they are paged
+    by (txid, id): a change that commits later belongs to a transaction that
+    was running, so it always comes after the position.
+
+    Args:
+        after (tuple): (txid, id) of the last change already applied, (0, 0) for all of them.
+        limit (int): Maximum number of changes.
+
+    Returns:
+        list: Tuples (id, table, op, row_id, txid) in the order the changes happened.
+    """
+    query = """select id, "table", op, row_id, txid from (
+                   select id, "table", op, row_id, txid from hubspot_changes
+                   where (txid, id) > (%s, %s)
+                   and txid < txid_snapshot_xmin(txid_current_snapshot())
+                   order by txid, id limit %s) changes
+               order by id"""
+    return db.cloud_db(query, (after[0], after[1], limit)) or []
+
+def clear_changes(change_ids):
+    """
+    Drop the captured changes that were applied.
+
+    Args:
+        change_ids (list): Ids of the applied changes.
+
+    Returns:
+        bool: True if the changes were dropped, None otherwise.
+    """
+    return db.transaction('cloud', [("delete from hubspot_changes where id = ANY(%s)",
+                                     (change_ids,))])
+
+def get_contacts_by_ids(user_ids, identity_ids):
+    """
+    Retrieve the contacts of captured Users and ExternalIdentities rows.
+
+    Args:
+        user_ids (list): Ids of inserted Users, or Users whose email changed.
+        identity_ids (list): Ids of inserted ExternalIdentities, or ones whose email changed.
+
+    Returns:
+        list: A list of contacts, each represented as a tuple (email, date, type).
+    """
+    user_query = """select email, "createdAt" from "Users" where id = ANY(%s)
+    and email is not null and email NOT ILIKE '%%''%%' ESCAPE '#' """
+    sso_query = """select email, "createdAt" from "ExternalIdentities" where id = ANY(%s)
+    and email is not null and email NOT ILIKE '%%''%%' ESCAPE '#' """
+    cloud_users, sso_users = db.parallel(lambda: db.lookup('cloud', user_query, user_ids),
+                                         lambda: db.lookup('cloud', sso_query, identity_ids))
+    return ([(email, date, 'cloud') for email, date in cloud_users]
+            + [(email, date, 'sso') for email, date in sso_users])
+
+def get_workspaces_by_ids(organization_ids):
+    """
+    Retrieve captured Organizations that are live and not stored yet.
+
+    Args:
+        organization_ids (list): Ids of inserted or restored Organizations.
+
+    Returns:
+        list: Workspace tuples in the shape returned by get_workspaces.
+    """
+    query = """SELECT id, name, identifier, "createdAt", "customerId"
+               FROM "Organizations" WHERE id = ANY(%s) and "deletedAt" is null
+               ORDER BY "createdAt" ASC"""
+    workspaces, stored = db.parallel(
+        lambda: db.lookup('cloud', query, organization_ids),
+        lambda: db.lookup('analytics', 'select workspace from workspaces where workspace = ANY(%s)',
+                          organization_ids))
+    stored = set(str(workspace[0]) for workspace in stored)
+    return join_workspace_customers([workspace for workspace in workspaces
+                                     if str(workspace[0]) not in stored])
+
+def get_soft_deleted_workspaces(organization_ids):
+    """
+    Keep the captured Organizations whose "deletedAt" is set.
+
+    Args:
+        organization_ids (list): Ids of Organizations whose "deletedAt" changed.
+
+    Returns:
+        list: The ids of the deleted Organizations.
+    """
+    query = """SELECT id FROM "Organizations" WHERE id = ANY(%s) and "deletedAt" is not null"""
+    return [workspace[0] for workspace in db.lookup('cloud', query, organization_ids)]
+
+def get_memberships_by_ids(member_ids):
+    """
+    Retrieve captured memberships that are not stored yet.
+
+    Args:
+        member_ids (list): Ids of inserted OrganizationMemberships.
+
+    Returns:
+        tuple: The new memberships and the dictionaries mapping their emails and
+        workspace ids to HubSpot IDs, as returned by get_memberships.
+    """
+    memberships, stored = db.parallel(
+        lambda: db.lookup('cloud', MEMBERSHIPS_BY_ID_QUERY, member_ids),
+        lambda: db.lookup('analytics', 'select member from memberships where member = ANY(%s)',
+                          member_ids))
+    stored = set(str(member[0]) for member in stored)
+    new_memberships = [member for member in memberships if str(member[0]) not in stored]
+    contacts_dict, workspaces_dict = membership_hubspot_ids(new_memberships)
+    return (new_memberships, contacts_dict, workspaces_dict)
+
+def get_waiting_memberships(max_wait):
+    """
+    Retrieve the captured memberships waiting for their contact or workspace.
+
+    Args:
+        max_wait (int): Seconds after which a membership is created anyway.
+
+    Returns:
+        tuple: The ids of the waiting memberships, and the ids of those
+        waiting for longer than `max_wait`.
+    """
+    db.analytics_db("ADD", WAITING_MEMBERSHIPS_TABLE, None)
+    query = """select member, since < now() - %s * interval '1 second'
+               from waiting_memberships"""
+    rows = db.analytics_db("GET", query, (max_wait,))
+    if rows is None:
+        raise Exception("Waiting memberships could not be read")
+    return ([member for member, _ in rows], [member for member, overdue in rows if overdue])
+
+def hold_memberships(checked_ids, waiting_ids):
+    """
+    Record which of the checked memberships still wait for their contact or workspace.
+
+    Args:
+        checked_ids (list): Ids of the memberships that were checked.
+        waiting_ids (list): Ids of the ones still waiting, they keep their first wait time.
+
+    Returns:
+        bool: True if the waiting memberships were stored, None otherwise.
+    """
+    waiting = [str(member) for member in waiting_ids]
+    waiting_set = set(waiting)
+    done = [str(member) for member in checked_ids if str(member) not in waiting_set]
+    return db.analytics_transaction([
+        (WAITING_MEMBERSHIPS_TABLE, None),
+        ("delete from waiting_memberships where member = ANY(%s)", (db.pg_array(done),)),
+        ("""insert into waiting_memberships (member, since)
+            select unnest(%s::character varying[]), now() on conflict (member) do nothing""",
+         (db.pg_array(waiting),)),
+    ])
+
+def get_updated_memberships_by_ids(member_ids):
+    """
+    Retrieve captured memberships that are already stored, with their HubSpot IDs.
+
+    Args:
+        member_ids (list): Ids of updated OrganizationMemberships.
+
+    Returns:
+        list: Memberships in the shape returned by get_updated_memberships.
+    """
+    memberships, hubspot_dict = db.parallel(
+        lambda: db.lookup('cloud', MEMBERSHIPS_BY_ID_QUERY, member_ids),
+        lambda: membership_ids.resolve(member_ids))
+    hubspot_dict = {str(member): hubspot_id for member, hubspot_id in hubspot_dict.items()}
+    final = []
+    for member in memberships:
+        hubspot_id = hubspot_dict.get(str(member[0]), None)
+        if hubspot_id is not None:
+            final.append((*member, hubspot_id))
+    return final
+
+def get_deleted_membership_hubspot_ids(member_ids):
+    """
+    Retrieve the HubSpot IDs of stored memberships, to delete them in HubSpot.
+
+    Args:
+        member_ids (list): Ids of deleted OrganizationMemberships.
+
+    Returns:
+        list: Tuples (hubspotID,) of the stored memberships.
+    """
+    query = 'select "hubspotID" from memberships where member = ANY(%s)'
+    return db.lookup('analytics', query, member_ids)
+
+def delete_memberships_by_ids(member_ids):
+    """
+    Delete stored memberships, once they were deleted in HubSpot.
+
+    Args:
+        member_ids (list): Ids of deleted OrganizationMemberships.
+
+    Returns:
+        list: Tuples (hubspotID,) of the deleted memberships.
+    """
+    membership_ids.forget(member_ids)
+    query = 'delete from memberships where member = ANY(%s) returning "hubspotID"'
+    return db.lookup('analytics', query, member_ids)
+
+def get_deleted_workspace_hubspot_ids(organization_ids):
+    """
+    Retrieve the HubSpot IDs of stored workspaces, to delete them in HubSpot.
+
+    Args:
+        organization_ids (list): Ids of deleted Organizations.
+
+    Returns:
+        list: Tuples (hubspotID,) of the stored workspaces.
+    """
+    query = 'select "hubspotID" from workspaces where workspace = ANY(%s)'
+    return db.lookup('analytics', query, organization_ids)
+
+def get_workspace_members(organization_ids):
+    """
+    Retrieve the memberships of deleted workspaces still in the cloud DB.
+
+    Hard deleted Organizations take their memberships along, those arrive as
+    their own deletes.
+
+    Args:
+        organization_ids (list): Ids of deleted Organizations.
+
+    Returns:
+        list: The ids of their OrganizationMemberships.
+    """
+    query = 'SELECT id FROM "OrganizationMemberships" WHERE "OrganizationId" = ANY(%s)'
+    return [member[0] for member in db.lookup('cloud', query, organization_ids)]
+
+def delete_workspaces_by_ids(deleted_ids):
+    """
+    Delete stored workspaces, once they were deleted in HubSpot.
+
+    Args:
+        deleted_ids (list): Ids of deleted Organizations.
+
+    Returns:
+        list: Tuples (hubspotID,) of the deleted workspaces.
+    """
+    workspace_ids.forget(deleted_ids)
+    query = 'delete from workspaces where workspace = ANY(%s) returning "hubspotID"'
+    return db.lookup('analytics', query, deleted_ids)
@@ -0,0 +1,277 @@
+""" Local stand-in for the HubSpot API, used for offline load testing
+
+Serves the endpoints used by hubspot_api.py: contacts and custom objects
+batch create/update/upsert/archive, and associations v4 default batch create.
+Point the client at it with HUBSPOT_BASE_URL, e.g.
+
+    python fake_hubspot.py --port 8090 --latency 0.05 --throttle-rate 0.01
+    HUBSPOT_BASE_URL=http://localhost:8090 python main.py
+"""
+import re
+import json
+import time
+import random
+import argparse
+import datetime
+import itertools
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+OBJECTS_PATH = re.compile(
+    r"^/crm/v3/objects/(?P<object_type>[^/]+)/batch/(?P<action>create|update|upsert|archive)$")
+ASSOCIATIONS_PATH = re.compile(
+    r"^/crm/v4/associations/(?P<from_type>[^/]+)/(?P<to_type>[^/]+)/batch/associate/default$")
+EMAIL_PATTERN = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+class FakeHubSpot:
+    """
+    In-memory HubSpot portal with configurable latency and failure injection.
+
+    Args:
+        latency (float): Seconds added to every request.
+        rate_limit (int): Requests allowed per rate-limit interval, 429 above it.
+        interval (float): Length of the rate-limit interval in seconds.
+        throttle_rate (float): Probability of answering any request with a 429.
+        failure_rate (float): Probability of rejecting a batch with a 400 that
+            names no record.
+    """
+
+    def __init__(self, latency=0.0, rate_limit=190, interval=10.0,
+                 throttle_rate=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.interval = interval
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.objects = {}
+        self.emails = {}
+        self.associations = {}
+        self.ids = itertools.count(1)
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _rate_limit_headers(self):
+        """
+        Count a request against the current window and build the rate-limit headers.
+        """
+        now = time.monotonic()
+        if now - self.window_start >= self.interval:
+            self.window_start = now
+            self.window_count = 0
+        self.window_count += 1
+        remaining = max(self.rate_limit - self.window_count, 0)
+        headers = {
+            'X-HubSpot-RateLimit-Max': str(self.rate_limit),
+            'X-HubSpot-RateLimit-Remaining': str(remaining),
+            'X-HubSpot-RateLimit-Interval-Milliseconds': str(int(self.interval * 1000)),
+        }
+        if self.window_count > self.rate_limit:
+            retry_after = self.interval - (now - self.window_start)
+            headers['Retry-After'] = str(max(int(retry_after + 0.999), 1))
+        return headers
+
+    def _record(self, object_type, object_id, properties):
+        stored = self.objects.setdefault(object_type, {})
+        record = stored.setdefault(object_id, {"createdAt": _now(), "properties": {}})
+        record["properties"].update({key: None if value is None else str(value)
+                                     for key, value in properties.items()})
+        record["properties"]["hs_object_id"] = object_id
+        record["updatedAt"] = _now()
+        return {"id": object_id, "properties": dict(record["properties"]),
+                "createdAt": record["createdAt"], "updatedAt": record["updatedAt"],
+                "archived": False}
+
+    @staticmethod
+    def _batch(results, started):
+        return {"status": "COMPLETE", "results": results,
+                "startedAt": started, "completedAt": _now()}
+
+    @staticmethod
+    def _error(category, message):
+        return {"status": "error", "category": category, "message": message,
+                "correlationId": "00000000-0000-0000-0000-000000000000"}
+
+    def _invalid_emails(self, object_type, inputs):
+        if object_type != 'contacts':
+            return None
+        invalid = [item.get("properties", {}).get("email") or item.get("id") or ""
+                   for item in inputs
+                   if not EMAIL_PATTERN.match(item.get("properties", {}).get("email")
+                                              or item.get("id") or "")]
+        if len(invalid) == 0:
+            return None
+        messages = [{"isValid": False, "message": f"Email address {email} is invalid",
+                     "error": "INVALID_EMAIL", "name": "email"} for email in invalid]
+        return (400, self._error("VALIDATION_ERROR",
+                                 f"Property values were not valid: {json.dumps(messages)}"))
+
+    def _objects(self, object_type, action, inputs, started):
+        invalid = self._invalid_emails(object_type, inputs)
+        if invalid is not None and action in ('create', 'upsert'):
+            return invalid
+        if action == 'archive':
+            for item in inputs:
+                self.objects.get(object_type, {}).pop(str(item.get("id")), None)
+            return (204, None)
+        if action == 'create' and object_type == 'contacts':
+            for item in inputs:
+                email = item.get("properties", {}).get("email", "").lower()
+                if email in self.emails:
+                    return (409, self._error(
+                        "CONFLICT", f"Contact already exists. Existing ID: {self.emails[email]}"))
+        results = []
+        for item in inputs:
+            properties = item.get("properties", {})
+            if action == 'update':
+                # Unknown IDs are created rather than rejected
+                object_id = str(item.get("id"))
+            elif action == 'upsert':
+                email = str(item.get("id")).lower()
+                object_id = self.emails.get(email) or str(next(self.ids))
+                properties = dict(properties, email=email)
+            else:
+                object_id = str(next(self.ids))
+            if object_type == 'contacts' and properties.get("email"):
+                properties = dict(properties, email=properties["email"].lower())
+                self.emails[properties["email"]] = object_id
+            results.append(self._record(object_type, object_id, properties))
+        return (201 if action == 'create' else 200, self._batch(results, started))
+
+    def _associate(self, from_type, to_type, inputs, started):
+        pairs = self.associations.setdefault((from_type, to_type), set())
+        results = []
+        for item in inputs:
+            from_id = str(item.get("from", {}).get("id"))
+            to_id = str(item.get("to", {}).get("id"))
+            pairs.add((from_id, to_id))
+            results.append({"from": {"id": from_id}, "to": {"id": to_id},
+                            "associationSpec": {"associationCategory": "HUBSPOT_DEFINED",
+                                                "associationTypeId": 1}})
+        return (200, self._batch(results, started))
+
+    def handle(self, method, path, body):
+        """
+        Answer one request.
+
+        Returns:
+            tuple: (status code, JSON payload or None, response headers)
+        """
+        started = _now()
+        time.sleep(self.latency)
+        with self.lock:
+            headers = self._rate_limit_headers()
+            if 'Retry-After' in headers or random.random() < self.throttle_rate:
+                headers.setdefault('Retry-After', '1')
+                status, payload = (429, dict(self._error(
+                    "RATE_LIMITS", "You have reached your ten_secondly_rolling limit."),
+                    policyName="TEN_SECONDLY_ROLLING"))
+            elif method == 'GET' and path == '/__stats':
+                status, payload = (200, {
+                    "requests": self.stats,
+                    "objects": {key: len(value) for key, value in self.objects.items()},
+                    "associations": {f"{key[0]}->{key[1]}": len(value)
+                                     for key, value in self.associations.items()}})
+            elif method != 'POST':
+                status, payload = (404, self._error("OBJECT_NOT_FOUND", "Not found"))
+            elif random.random() < self.failure_rate:
+                status, payload = (400, self._error("VALIDATION_ERROR", "Injected failure"))
+            else:
+                inputs = (body or {}).get("inputs", [])
+                objects = OBJECTS_PATH.match(path)
+                associations = ASSOCIATIONS_PATH.match(path)
+                if objects is not None:
+                    status, payload = self._objects(objects.group('object_type'),
+                                                    objects.group('action'), inputs, started)
+                elif associations is not None:
+                    status, payload = self._associate(associations.group('from_type'),
+                                                      associations.group('to_type'),
+                                                      inputs, started)
+                else:
+                    status, payload = (404, self._error("OBJECT_NOT_FOUND", "Not found"))
+            self.stats[str(status)] = self.stats.get(str(status), 0) + 1
+        return (status, payload, headers)
+
+def _handler(portal):
+    class Handler(BaseHTTPRequestHandler):
+        """
+        HTTP front end of a FakeHubSpot portal.
+        """
+        protocol_version = "HTTP/1.1"
+
+        def _respond(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length > 0 else b''
+            body = json.loads(raw) if raw else None
+            status, payload, headers = portal.handle(self.command, self.path.split('?')[0], body)
+            data = b'' if payload is None else json.dumps(payload).encode()
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Type', 'application/json;charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = _respond
+        do_POST = _respond
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            pass
+    return Handler
+
+def serve(host='127.0.0.1', port=8090, **options):
+    """
+    Start a fake HubSpot server on a background thread.
+
+    Args:
+        host (str): Interface to listen on.
+        port (int): Port to listen on, 0 picks a free port.
+        **options: FakeHubSpot options (latency, rate_limit, interval,
+            throttle_rate, failure_rate).
+
+    Returns:
+        tuple: (ThreadingHTTPServer, FakeHubSpot)
+    """
+    portal = FakeHubSpot(**options)
+    server = ThreadingHTTPServer((host, port), _handler(portal))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (server, portal)
+
+def main():
+    """
+    Run the fake HubSpot server until interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Local HubSpot API stand-in")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds added to every request")
+    parser.add_argument('--rate-limit', type=int, default=190,
+                        help="requests allowed per interval before answering 429")
+    parser.add_argument('--interval', type=float, default=10.0,
+                        help="rate-limit interval in seconds")
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="probability of a random 429")
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help="probability of a random 400")
+    args = parser.parse_args()
+    server, portal = serve(args.host, args.port, latency=args.latency,
+                           rate_limit=args.rate_limit, interval=args.interval,
+                           throttle_rate=args.throttle_rate, failure_rate=args.failure_rate)
+    print(f"Fake HubSpot listening on http://{args.host}:{server.server_port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(json.dumps(portal.stats))
+
+if __name__ == "__main__":
+    main()
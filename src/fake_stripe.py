@@ -0,0 +1,304 @@
+""" Local stand-in for the Stripe API, used for offline load testing
+
+Serves paginated subscriptions, customers and subscription events from a
+seeded synthetic dataset, enough for the calls made by stripe_api.py.
+POST /__mutate?count=N changes N random subscriptions and records their
+customer.subscription.updated events. Point the client at it with
+STRIPE_API_BASE, e.g.
+
+    python fake_stripe.py --port 12111 --customers 20000 --latency 0.05
+    STRIPE_API_BASE=http://localhost:12111 python main.py create_all_workspaces
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PLANS = [
+    ('plan_business_yearly', 'Business Plan / Yearly', 'year'),
+    ('plan_business_yearly_10', 'Business Plan / Yearly (10% discount)', 'year'),
+    ('plan_standard_monthly', 'Standard Plan / Monthly', 'month'),
+    ('plan_standard_yearly', 'Standard Plan / Yearly', 'year'),
+]
+STATUSES = ['active', 'active', 'active', 'trialing', 'trialing', 'past_due', 'canceled']
+CUSTOMER_PATH = re.compile(r"^/v1/customers/(?P<customer>[^/]+)$")
+
+
+def _error(status, message, code=None):
+    error = {"type": "invalid_request_error", "message": message}
+    if code is not None:
+        error["code"] = code
+    return (status, {"error": error})
+
+class FakeStripe:
+    """
+    In-memory Stripe account seeded with synthetic customers and subscriptions.
+
+    Args:
+        customers (int): Number of customers to generate, one subscription each.
+        seed (int): Seed of the synthetic dataset.
+        latency (float): Seconds added to every request.
+        rate_limit (int): Requests allowed per second, 429 above it.
+    """
+
+    def __init__(self, customers=1000, seed=1, latency=0.0, rate_limit=100):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.customers = {}
+        self.subscriptions = []
+        self.events = []
+        self.rng = random.Random(seed)
+        self._seed(customers)
+
+    def _event(self, event_type, subscription, created):
+        self.events.append({
+            "id": f"evt_{len(self.events):010d}", "object": "event", "type": event_type,
+            "created": created, "data": {"object": dict(subscription)}})
+
+    def _seed(self, count):
+        rng = self.rng
+        start = 1672531200 # 2023-01-01
+        for n in range(count):
+            created = start + n * 600 + rng.randint(0, 599)
+            customer_id = f"cus_{n:08d}"
+            self.customers[customer_id] = {
+                "id": customer_id, "object": "customer", "created": created,
+                "email": f"billing{n}@example.com"}
+            plan_id, nickname, interval = rng.choice(PLANS)
+            status = rng.choice(STATUSES)
+            trialing = status == 'trialing'
+            self.subscriptions.append({
+                "id": f"sub_{n:08d}", "object": "subscription", "customer": customer_id,
+                "created": created,
+                "ended_at": created + 86400 * 30 if status == 'canceled' else None,
+                "plan": {"id": plan_id, "object": "plan", "nickname": nickname,
+                         "interval": interval},
+                "quantity": rng.randint(1, 50), "status": status,
+                "trial_start": created if trialing else None,
+                "trial_end": created + 86400 * 30 if trialing else None,
+                "current_period_end": created + 86400 * (365 if interval == 'year' else 30),
+                "collection_method": rng.choice(['charge_automatically', 'send_invoice']),
+                "cancel_at_period_end": rng.random() < 0.2})
+        # Stripe lists newest first
+        self.subscriptions.sort(key=lambda subscription: subscription["created"], reverse=True)
+        self.subscription_ranks = {subscription["id"]: n
+                                   for n, subscription in enumerate(self.subscriptions)}
+        for subscription in reversed(self.subscriptions):
+            self._event('customer.subscription.created', subscription, subscription["created"])
+
+    def mutate(self, count):
+        """
+        Change random subscriptions and record a customer.subscription.updated event for each.
+
+        Args:
+            count (int): Number of subscriptions to change.
+
+        Returns:
+            int: Number of events recorded.
+        """
+        with self.lock:
+            return self._mutate(count)
+
+    def _mutate(self, count):
+        now = int(time.time())
+        changed = self.rng.sample(self.subscriptions, min(count, len(self.subscriptions)))
+        for subscription in changed:
+            subscription["quantity"] = self.rng.randint(1, 50)
+            subscription["cancel_at_period_end"] = self.rng.random() < 0.2
+            subscription["status"] = self.rng.choice(STATUSES)
+            self._event('customer.subscription.updated', subscription, now)
+        return len(changed)
+
+    def _throttled(self):
+        now = time.monotonic()
+        if now - self.window_start >= 1:
+            self.window_start = now
+            self.window_count = 0
+        self.window_count += 1
+        return self.window_count > self.rate_limit
+
+    @staticmethod
+    def _expand(params):
+        return {value for key, value in params if key.startswith('expand')}
+
+    @staticmethod
+    def _created_matches(created, query):
+        if 'created[gte]' in query and created < int(query['created[gte]']):
+            return False
+        if 'created[gt]' in query and created <= int(query['created[gt]']):
+            return False
+        if 'created[lte]' in query and created > int(query['created[lte]']):
+            return False
+        if 'created[lt]' in query and created >= int(query['created[lt]']):
+            return False
+        return True
+
+    @staticmethod
+    def _page(matches, query, url, ranks):
+        """
+        Cut one page out of a newest-first list, following Stripe's cursor parameters.
+
+        `ranks` maps every object ID to its place in the unfiltered listing, so
+        a cursor object that no longer matches the filters still works.
+        """
+        limit = min(int(query.get('limit', 10)), 100)
+        if 'starting_after' in query:
+            if query['starting_after'] not in ranks:
+                return _error(400, f"No such object: '{query['starting_after']}'")
+            after = ranks[query['starting_after']]
+            matches = [item for item in matches if ranks[item["id"]] > after]
+        return (200, {"object": "list", "url": url,
+                      "has_more": len(matches) > limit,
+                      "data": [dict(item) for item in matches[:limit]]})
+
+    def _list_subscriptions(self, params):
+        query = dict(params)
+        status = query.get('status')
+        matches = []
+        for subscription in self.subscriptions:
+            if status is None and subscription["status"] == 'canceled':
+                continue
+            if status not in (None, 'all') and subscription["status"] != status:
+                continue
+            if 'customer' in query and subscription["customer"] != query['customer']:
+                continue
+            if not self._created_matches(subscription["created"], query):
+                continue
+            matches.append(subscription)
+        status, payload = self._page(matches, query, "/v1/subscriptions", self.subscription_ranks)
+        if status == 200 and 'data.customer' in self._expand(params):
+            for subscription in payload["data"]:
+                subscription["customer"] = dict(self.customers[subscription["customer"]])
+        return (status, payload)
+
+    def _list_events(self, params):
+        query = dict(params)
+        event_type = query.get('type', '*')
+        matches = []
+        for event in reversed(self.events):
+            if event_type.endswith('*'):
+                if not event["type"].startswith(event_type[:-1]):
+                    continue
+            elif event["type"] != event_type:
+                continue
+            if not self._created_matches(event["created"], query):
+                continue
+            matches.append(event)
+        ranks = {event["id"]: -n for n, event in enumerate(self.events)}
+        return self._page(matches, query, "/v1/events", ranks)
+
+    def handle(self, method, path, params):
+        """
+        Answer one request.
+
+        Returns:
+            tuple: (status code, JSON payload)
+        """
+        time.sleep(self.latency)
+        with self.lock:
+            customer = CUSTOMER_PATH.match(path)
+            if self._throttled():
+                status, payload = _error(429, "Too many requests in a period of time.",
+                                         "rate_limit")
+            elif path == '/__stats':
+                status, payload = (200, {"requests": self.stats, "events": len(self.events)})
+            elif method == 'POST' and path == '/__mutate':
+                status, payload = (200, {"events": self._mutate(int(dict(params).get('count', 1)))})
+            elif method != 'GET':
+                status, payload = _error(405, "Only read requests are supported")
+            elif path == '/v1/subscriptions':
+                status, payload = self._list_subscriptions(params)
+            elif path == '/v1/events':
+                status, payload = self._list_events(params)
+            elif customer is not None and customer.group('customer') in self.customers:
+                status, payload = (200, dict(self.customers[customer.group('customer')]))
+            elif customer is not None:
+                status, payload = _error(404, f"No such customer: '{customer.group('customer')}'",
+                                         "resource_missing")
+            else:
+                status, payload = _error(404, f"Unrecognized request URL (GET: {path})")
+            key = f"{path.split('/')[2] if path.startswith('/v1/') else path} {status}"
+            self.stats[key] = self.stats.get(key, 0) + 1
+        return (status, payload)
+
+def _handler(account):
+    class Handler(BaseHTTPRequestHandler):
+        """
+        HTTP front end of a FakeStripe account.
+        """
+        protocol_version = "HTTP/1.1"
+
+        def _respond(self):
+            url = urlsplit(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            form = self.rfile.read(length).decode() if length > 0 else ''
+            params = parse_qsl(url.query) + parse_qsl(form)
+            status, payload = account.handle(self.command, url.path, params)
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Request-Id', f"req_{random.getrandbits(48):012x}")
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = _respond
+        do_POST = _respond
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            pass
+    return Handler
+
+def serve(host='127.0.0.1', port=12111, **options):
+    """
+    Start a fake Stripe server on a background thread.
+
+    Args:
+        host (str): Interface to listen on.
+        port (int): Port to listen on, 0 picks a free port.
+        **options: FakeStripe options (customers, seed, latency, rate_limit).
+
+    Returns:
+        tuple: (ThreadingHTTPServer, FakeStripe)
+    """
+    account = FakeStripe(**options)
+    server = ThreadingHTTPServer((host, port), _handler(account))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return (server, account)
+
+def main():
+    """
+    Run the fake Stripe server until interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Local Stripe API stand-in")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--customers', type=int, default=1000,
+                        help="customers (and subscriptions) to generate")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds added to every request")
+    parser.add_argument('--rate-limit', type=int, default=100,
+                        help="requests allowed per second before answering 429")
+    args = parser.parse_args()
+    server, account = serve(args.host, args.port, customers=args.customers, seed=args.seed,
+                            latency=args.latency, rate_limit=args.rate_limit)
+    print(f"Fake Stripe listening on http://{args.host}:{server.server_port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(json.dumps(account.stats))
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,15 @@
 """ This module contains all API funtions to Hubspot """
 import os
 import re
+import time
+import random
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from importlib.metadata import version
+from urllib.parse import urlparse
+from urllib3 import Retry
+from urllib3.exceptions import MaxRetryError, ResponseError
 from hubspot import HubSpot
 from hubspot.crm.contacts import (BatchInputSimplePublicObjectId,
                     BatchInputSimplePublicObjectInputForCreate,SimplePublicObjectInput)
@@ -9,6 +17,7 @@ from hubspot.crm.contacts.exceptions import ApiException
 from hubspot.crm.associations.v4 import BatchInputPublicDefaultAssociationMultiPost
 from dotenv import load_dotenv, find_dotenv
 import database as db # Import your database functions module
+from rate_limiter import TokenBucket
 
 # Load environment variables from a .env file
 load_dotenv(find_dotenv())
@@ -20,23 +29,505 @@ membership_schema = os.getenv('MEMBERSHIPS_DEV')
 serial_schema = os.getenv('SERIALS_DEV')
 contact_schema = os.getenv('CONTACTS_DEV')
 
+# HTTP settings shared by every HubSpot request of a run
+# Point the client at another host, e.g. the local fake_hubspot.py server
+HUBSPOT_BASE_URL = os.getenv('HUBSPOT_BASE_URL')
+HUBSPOT_POOL_SIZE = int(os.getenv('HUBSPOT_POOL_SIZE', '10'))
+HUBSPOT_CONNECT_TIMEOUT = float(os.getenv('HUBSPOT_CONNECT_TIMEOUT', '10'))
+HUBSPOT_READ_TIMEOUT = float(os.getenv('HUBSPOT_READ_TIMEOUT', '60'))
+HUBSPOT_RETRIES = int(os.getenv('HUBSPOT_RETRIES', '3'))
+# POST endpoints that can be sent twice without creating anything twice
+IDEMPOTENT_POSTS = re.compile(r"/(batch/(read|update|upsert|archive|associate/default)|search)$")
+
+# Concurrent batches, and the request budget they all share
+HUBSPOT_WORKERS = int(os.getenv('HUBSPOT_WORKERS', '4'))
+HUBSPOT_RATE_LIMIT = int(os.getenv('HUBSPOT_RATE_LIMIT', '90'))
+HUBSPOT_RATE_INTERVAL = float(os.getenv('HUBSPOT_RATE_INTERVAL', '10'))
+HUBSPOT_RATE_BURST = int(os.getenv('HUBSPOT_RATE_BURST', '10'))
+# Slow down when HubSpot reports fewer requests than this left in the interval
+HUBSPOT_RATE_HEADROOM = int(os.getenv('HUBSPOT_RATE_HEADROOM', '10'))
+# Retries of throttled (429) requests, with exponential backoff from this base
+HUBSPOT_429_RETRIES = int(os.getenv('HUBSPOT_429_RETRIES', '5'))
+HUBSPOT_BACKOFF_BASE = float(os.getenv('HUBSPOT_BACKOFF_BASE', '1'))
+rate_limiter = TokenBucket(HUBSPOT_RATE_LIMIT, HUBSPOT_RATE_INTERVAL, HUBSPOT_RATE_BURST,
+                           HUBSPOT_RATE_HEADROOM)
+# Associations written per associations v4 batch call
+HUBSPOT_ASSOCIATION_BATCH_SIZE = int(os.getenv('HUBSPOT_ASSOCIATION_BATCH_SIZE', '1000'))
+
+_client = None
+_apis = {}
+_client_lock = threading.Lock()
+
+
+def _observe_rate_limit(headers):
+    """
+    Feed HubSpot's rate-limit response headers to the shared rate limiter.
+    """
+    if headers is None:
+        return
+    remaining = headers.get('X-HubSpot-RateLimit-Remaining')
+    interval = headers.get('X-HubSpot-RateLimit-Interval-Milliseconds')
+    if remaining is not None and interval is not None:
+        rate_limiter.observe(int(remaining), int(interval) / 1000)
+
+def _backoff_delay(headers, attempt):
+    """
+    Seconds to wait before retrying a throttled request.
 
-def create_contacts(contacts):
+    Uses Retry-After when HubSpot sends it, exponential backoff otherwise,
+    plus up to 50% random jitter so workers do not retry in lockstep.
     """
-    Create contacts in HubSpot.
+    delay = HUBSPOT_BACKOFF_BASE * 2 ** attempt
+    if headers is not None and headers.get('Retry-After') is not None:
+        try:
+            delay = float(headers.get('Retry-After'))
+        except ValueError:
+            pass
+    return delay * random.uniform(1, 1.5)
+
+def _rate_limited(request):
+    """
+    Wrap an SDK REST request so every call takes a token from the shared bucket,
+    adapts to HubSpot's rate-limit headers and retries 429 responses.
+    """
+    def limited_request(*args, **kwargs):
+        attempt = 0
+        while True:
+            rate_limiter.acquire()
+            try:
+                response = request(*args, **kwargs)
+            except Exception as error:
+                headers = getattr(error, 'headers', None)
+                _observe_rate_limit(headers)
+                if getattr(error, 'status', None) != 429 or attempt >= HUBSPOT_429_RETRIES:
+                    raise
+                delay = _backoff_delay(headers, attempt)
+                print(f"HubSpot rate limit hit, retrying in {delay:.1f}s")
+                rate_limiter.pause(delay)
+                attempt += 1
+                continue
+            _observe_rate_limit(response.getheaders())
+            return response
+    return limited_request
+
+def _with_timeout(request):
+    """
+    Wrap an SDK REST request so calls without their own timeout use the
+    configured connect and read timeouts. The generated SDK passes
+    `_request_timeout=None` explicitly, which overrides any pool default.
+    """
+    def timed_request(*args, **kwargs):
+        if kwargs.get('_request_timeout') is None:
+            kwargs['_request_timeout'] = (HUBSPOT_CONNECT_TIMEOUT, HUBSPOT_READ_TIMEOUT)
+        return request(*args, **kwargs)
+    return timed_request
+
+def throttled_seconds():
+    """
+    Return the time spent waiting on HubSpot rate limits so far.
+
+    Returns:
+        float: Seconds spent waiting for the rate limiter, summed over all workers.
+    """
+    return rate_limiter.throttled
+
+class _Retry(Retry):
+    """
+    Retry policy of the shared HubSpot connection pools.
+
+    Every HubSpot batch call is a POST, so POST is retried too, but only on
+    the IDEMPOTENT_POSTS endpoints. A batch create that timed out or got a 5xx
+    may still have been applied, so it is only retried when the connection
+    could not be made. Once retries run out the last error response is
+    returned, so the SDK raises it as an ApiException with its status.
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if method == 'POST' and not IDEMPOTENT_POSTS.search(urlparse(url or '').path):
+            if response is not None:
+                raise MaxRetryError(_pool, url, ResponseError(f"{response.status} on {url}"))
+            # Without a method, urllib3 only retries errors raised before the request was sent
+            method = None
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+def _api_factory(api_client_package, api_name, config):
+    """
+    Build each HubSpot SDK API once and reuse it for the whole run.
+
+    The SDK otherwise creates a new ApiClient, and with it a new connection
+    pool, every time an API such as `crm.contacts.batch_api` is accessed.
+
+    Args:
+        api_client_package (module): The SDK package, e.g. hubspot.crm.contacts.
+        api_name (str): The API class name, e.g. "BatchApi".
+        config (dict): The HubSpot client configuration.
+
+    Returns:
+        The shared API instance.
+    """
+    key = (api_client_package.__name__, api_name)
+    with _client_lock:
+        if key not in _apis:
+            configuration = api_client_package.Configuration()
+            configuration.access_token = config.get("access_token")
+            configuration.retries = config.get("retry")
+            configuration.connection_pool_maxsize = HUBSPOT_POOL_SIZE
+            if HUBSPOT_BASE_URL:
+                configuration.host = HUBSPOT_BASE_URL.rstrip('/')
+            api_client = api_client_package.ApiClient(configuration=configuration)
+            api_client.user_agent = f"hubspot-api-client-python; {version('hubspot-api-client')}"
+            api_client.rest_client.request = _rate_limited(
+                _with_timeout(api_client.rest_client.request))
+            _apis[key] = getattr(api_client_package, api_name)(api_client=api_client)
+        return _apis[key]
+
+def get_client():
+    """
+    Return the HubSpot client shared by every function in this module.
+
+    The client is created on first use and keeps its HTTP connections
+    alive between batches and workflows.
+
+    Returns:
+        HubSpot: The shared client.
+    """
+    global _client # pylint: disable=global-statement
+    with _client_lock:
+        if _client is None:
+            retry = _Retry(total=HUBSPOT_RETRIES, backoff_factor=0.5,
+                           status_forcelist=(502, 503, 504),
+                           allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'POST'},
+                           raise_on_status=False)
+            _client = HubSpot(access_token=token, retry=retry, api_factory=_api_factory)
+        return _client
+
+def run_batches(batches, send_batch):
+    """
+    Send batches to HubSpot concurrently on HUBSPOT_WORKERS threads.
+
+    Requests from all workers share the module rate limiter.
+
+    Args:
+        batches (list): The batches to send.
+        send_batch (callable): Called as send_batch(number, batch) for every batch,
+            numbered from 1.
+
+    Returns:
+        list: The value returned by send_batch for each batch, in batch order.
+    """
+    with ThreadPoolExecutor(max_workers=HUBSPOT_WORKERS) as executor:
+        futures = [executor.submit(send_batch, i, batch)
+                   for i, batch in enumerate(batches, start=1)]
+        return [future.result() for future in futures]
+
+
+class AssociationBuffer:
+    """
+    Collects default associations and writes them in full-size batch calls.
+
+    Pairs are grouped by (from object type, to object type). A group is sent as
+    soon as it holds HUBSPOT_ASSOCIATION_BATCH_SIZE pairs, and whatever is left
+    is sent by flush(). A batch that fails stays queued, so flush() sends it
+    again. Safe to fill from concurrent batch workers.
+    """
+
+    def __init__(self, batch_size=HUBSPOT_ASSOCIATION_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, from_object_type, from_id, to_object_type, to_id):
+        """
+        Queue an association, skipping pairs with a missing ID.
+        """
+        if from_id is None or to_id is None:
+            return
+        key = (from_object_type, to_object_type)
+        full = None
+        with self.lock:
+            pairs = self.pending.setdefault(key, [])
+            pairs.append((from_id, to_id))
+            if len(pairs) >= self.batch_size:
+                full = self.pending.pop(key)
+        if full is not None and not self._send(key, full):
+            self._requeue(key, full)
+
+    def flush(self, attempts=2):
+        """
+        Send every queued association, resending failed batches.
+
+        Args:
+            attempts (int): How many times a batch is sent before it is given up.
+
+        Returns:
+            list: The associations that still failed, as the (from object type,
+                from ID, to object type, to ID) arguments of add(). They stay
+                queued, so a later flush() retries them.
+        """
+        for _ in range(attempts):
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+            for key, pairs in pending.items():
+                for i in range(0, len(pairs), self.batch_size):
+                    batch = pairs[i:i + self.batch_size]
+                    if not self._send(key, batch):
+                        self._requeue(key, batch)
+            if len(self.pending) == 0:
+                break
+        with self.lock:
+            return [(key[0], from_id, key[1], to_id)
+                    for key, pairs in self.pending.items() for from_id, to_id in pairs]
+
+    def _requeue(self, key, pairs):
+        with self.lock:
+            self.pending.setdefault(key, []).extend(pairs)
+
+    @staticmethod
+    def _send(key, pairs):
+        from_object_type, to_object_type = key
+        inputs = [{"from": {"id": str(from_id)}, "to": {"id": str(to_id)}}
+                  for from_id, to_id in pairs]
+        try:
+            associations = BatchInputPublicDefaultAssociationMultiPost(inputs=inputs)
+            api_response = get_client().crm.associations.v4.batch_api.create_default(
+                from_object_type=from_object_type, to_object_type=to_object_type,
+                batch_input_public_default_association_multi_post=associations)
+            if api_response.status != "COMPLETE":
+                print(f"Error: Associating {from_object_type} -> {to_object_type}")
+                return False
+        except Exception as e:
+            print(f"Exception when calling batch_api->Associate: {getattr(e, 'status', e)}\n")
+            return False
+        return True
+
+
+class CoalescingBuffer:
+    """
+    Holds the rows of one HubSpot write path across workflow runs and sends
+    them in full batches, or once the oldest row has waited `max_delay` seconds.
+
+    Rows are keyed, so a row read again by a later run before it was sent
+    replaces the pending one instead of being sent twice. Lookup dictionaries
+    travelling with the rows, e.g. contact HubSpot IDs by email, are merged.
+    With the default `max_delay` of 0 every add() is sent straight away.
+    Rows whose send raised are queued again, ahead of the newer rows.
+
+    A mark added with the rows, e.g. the end of the window they were read
+    from, is passed to `on_sent` once those rows and every row queued before
+    them were sent.
+    """
+
+    def __init__(self, send, key, batch_size=100, max_delay=0, on_sent=None):
+        self.send = send
+        self.key = key
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.on_sent = on_sent
+        self.pending = {}
+        self.lookups = []
+        self.marks = []
+        self.sending = {}
+        self.lock = threading.Lock()
+
+    def add(self, rows, *lookups, mark=None):
+        """
+        Queue rows with their lookup dictionaries, then send what is ready.
+
+        Args:
+            rows (list): The rows to queue.
+            *lookups (dict): Lookup dictionaries for the rows.
+            mark: Passed to `on_sent` once the rows were sent, None for no mark.
+
+        Returns:
+            int: Number of rows sent.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for row in rows:
+                key = self.key(row)
+                added = self.pending[key][1] if key in self.pending else now
+                self.pending[key] = (row, added)
+            for n, lookup in enumerate(lookups):
+                if n < len(self.lookups):
+                    self.lookups[n].update(lookup)
+                else:
+                    self.lookups.append(dict(lookup))
+            if mark is not None:
+                self.marks.append((mark, now))
+        sent = self.flush()
+        self._release_marks()
+        return sent
+
+    def flush(self, force=False):
+        """
+        Send the full batches, or every pending row once the oldest is overdue
+        or when forced.
+
+        Returns:
+            int: Number of rows sent.
+        """
+        with self.lock:
+            if len(self.pending) == 0:
+                return 0
+            oldest = next(iter(self.pending.values()))[1]
+            if force or time.monotonic() - oldest >= self.max_delay:
+                count = len(self.pending)
+            else:
+                count = len(self.pending) // self.batch_size * self.batch_size
+            if count == 0:
+                return 0
+            keys = list(self.pending)[:count]
+            taken = {key: self.pending.pop(key) for key in keys}
+            lookups = self.lookups
+            if len(self.pending) == 0:
+                self.lookups = []
+            else:
+                self.lookups = [dict(lookup) for lookup in lookups]
+            batch = object()
+            self.sending[batch] = min(added for _, added in taken.values())
+        try:
+            self.send([row for row, _ in taken.values()], *lookups)
+        except Exception:
+            self._requeue(taken, lookups, batch)
+            raise
+        with self.lock:
+            del self.sending[batch]
+        self._release_marks()
+        return len(taken)
+
+    def _release_marks(self):
+        with self.lock:
+            # Rows keep the time they were first queued, unsent ones hold back later marks
+            unsent = [added for _, added in self.pending.values()] + list(self.sending.values())
+            oldest = min(unsent, default=None)
+            released = [mark for mark, marked in self.marks if oldest is None or marked < oldest]
+            self.marks = [(mark, marked) for mark, marked in self.marks
+                          if oldest is not None and marked >= oldest]
+        if len(released) > 0 and self.on_sent is not None:
+            self.on_sent(released[-1])
+
+    def _requeue(self, taken, lookups, batch):
+        with self.lock:
+            del self.sending[batch]
+            # A row read again since it was taken is newer, keep that one
+            pending = {key: entry for key, entry in taken.items() if key not in self.pending}
+            pending.update(self.pending)
+            self.pending = pending
+            for n, lookup in enumerate(lookups):
+                if n < len(self.lookups):
+                    self.lookups[n] = {**lookup, **self.lookups[n]}
+                else:
+                    self.lookups.append(dict(lookup))
+
+
+def _contact_email(contact):
+    """
+    Return a contact's email the way it is sent to and reported by HubSpot.
+    """
+    return re.sub(r"'", r"''", contact[0]).lower()
+
+def _isolate_invalid_contacts(contacts, send):
+    """
+    Send contacts, isolating the rows HubSpot rejects as invalid.
+
+    When a 400 names invalid email addresses, those contacts are stripped and
+    the remainder is resubmitted. When it reports invalid emails that match no
+    contact as sent, the batch is bisected recursively until only the rejected
+    contacts are left. Any other 400, e.g. a property or schema error, says
+    nothing about the contacts and is raised like every other error, so the
+    batch can be retried instead of being marked invalid.
+
+    Args:
+        contacts (list): The contacts to send.
+        send (callable): Sends a list of contacts and returns their HubSpot records.
+
+    Returns:
+        tuple: (HubSpot records of the accepted contacts, rejected contacts)
+    """
+    try:
+        return (send(contacts), [])
+    except Exception as error:
+        if getattr(error, 'status', None) != 400:
+            raise
+        email_pattern = r"""Email address (.*?) is invalid"""
+        named = {email.lower() for email in re.findall(email_pattern, str(error))}
+        if 'INVALID_EMAIL' not in str(error) and len(named) == 0:
+            raise
+        offenders = [contact for contact in contacts if _contact_email(contact) in named]
+        if len(offenders) > 0:
+            remainder = [contact for contact in contacts if _contact_email(contact) not in named]
+            records, rejected = (_isolate_invalid_contacts(remainder, send)
+                                 if len(remainder) > 0 else ([], []))
+            return (records, offenders + rejected)
+        if len(contacts) == 1:
+            return ([], contacts)
+        middle = len(contacts) // 2
+        left = _isolate_invalid_contacts(contacts[:middle], send)
+        right = _isolate_invalid_contacts(contacts[middle:], send)
+        return (left[0] + right[0], left[1] + right[1])
+
+
+def _error_text(error):
+    """
+    Flatten one error of a multi-status batch response into text.
+
+    Args:
+        error (StandardError): An entry of the response's errors list.
+
+    Returns:
+        str: The error's category, message and the messages of its details.
+    """
+    details = [f"{getattr(detail, 'code', '')} {getattr(detail, 'message', '')}"
+               for detail in getattr(error, 'errors', None) or []]
+    return " ".join([str(getattr(error, 'category', '')), str(getattr(error, 'message', ''))]
+                    + details)
+
+def _batch_upsert(api_client, object_type, inputs):
+    """
+    Call HubSpot's batch upsert endpoint for an object type.
+
+    hubspot-api-client 8.1 has no upsert method, so the request goes through
+    the shared contacts ApiClient and keeps its connections and rate limiting.
+
+    Args:
+        api_client (HubSpot): The shared HubSpot client.
+        object_type (str): The object type, e.g. "contacts".
+        inputs (list): Upsert inputs with "idProperty", "id" and "properties".
+
+    Returns:
+        BatchResponseSimplePublicObject: The upserted objects, with an errors
+            list when HubSpot answered 207.
+    """
+    batch_api = api_client.crm.contacts.batch_api
+    return batch_api.api_client.call_api(
+        f"/crm/v3/objects/{object_type}/batch/upsert", "POST",
+        header_params={"Accept": "application/json", "Content-Type": "application/json"},
+        body={"inputs": inputs},
+        response_types_map={200: "BatchResponseSimplePublicObject",
+                            207: "BatchResponseSimplePublicObjectWithErrors"},
+        auth_settings=["oauth2"],
+        _return_http_data_only=True)
+
+def upsert_contacts(contacts):
+    """
+    Create or update contacts in HubSpot, keyed on email.
+
+    Existing contacts are matched by email instead of failing the batch with
+    a 409, so every contact is written in a single round trip.
 
     Args:
         contacts (list): A list of tuples containing contact information.
-            Each tuple should have the format (email, firstname).
+            Each tuple should have the format (email, created, type).
 
     Returns:
-        list: A list of tuples with the original email and the contact HubSpot ID .
+        list: ([], failed contacts, invalid emails, rejected contacts).
+            Failed contacts were in a batch that errored and can be retried.
     """
-    print("START: adding contacts to hubspot...")
-    api_client = HubSpot(access_token=token)
-    invalid_email_list = []
-    conflict_contacts = []
-    batch_with_invalid_contacts = []
+    print("START: upserting contacts to hubspot...")
+    api_client = get_client()
+    invalid_contacts = []
 
     # List to store batches of contacts
     contact_batches = []
@@ -45,41 +536,46 @@ def create_contacts(contacts):
         batch = contacts[i:i + 100]
         contact_batches.append(batch)
 
-    # Format emails within batches
-    i=0
-    for batch in contact_batches:
-        i=i+1
+    def upsert(batch):
+        # HubSpot stores emails in lower case, match the results on that
+        batch_dict = {_contact_email(contact): contact for contact in batch}
+        inputs = [{"idProperty": "email", "id": email, "properties": {"email": email}}
+                  for email in batch_dict]
+        api_response = _batch_upsert(api_client, "contacts", inputs)
+        # A 207 reports the rows HubSpot did not write next to the ones it did
+        errors = getattr(api_response, 'errors', None) or []
+        if len(errors) > 0:
+            message = "; ".join(_error_text(error) for error in errors)
+            # Invalid emails are isolated like a 400, anything else fails the batch
+            status = 400 if 'INVALID_EMAIL' in message else 207
+            raise ApiException(status=status, reason=message)
         hubspot_records = []
+        for result in api_response.results:
+            email = result.properties.get("email", "N/A")
+            contact = batch_dict.get(email.lower())
+            if contact is not None:
+                hubspot_records.append((email, result.id, contact[1], contact[2]))
+        return hubspot_records
+
+    def send_batch(i, batch):
+        rejected = []
         try:
-
-            json = [{"properties": {"email":re.sub(r"'", r"''", email)}} for email, *_ in batch ]
-            payload = BatchInputSimplePublicObjectId(json)
-            api_response = api_client.crm.contacts.batch_api.create(
-            batch_input_simple_public_object_input_for_create=payload)
-            # Iterate over the results list and create (id, email) tuples for each item
-            length = len(api_response.results)
-            for n in range(length):
-                hubspot_id = api_response.results[n].id # Get the 'results' list from the dictionary
-                email = api_response.results[n].properties.get("email", "N/A")
-                created = batch[n][1]
-                hubspot_records = hubspot_records+[(email,hubspot_id,created,batch[n][2])]
+            hubspot_records, rejected = _isolate_invalid_contacts(batch, upsert)
             db.insert_contact_ids(hubspot_records)
             print(f"Contacts -> {(i/len(contact_batches))*100}%")
         except Exception as e:
-            error = str(e)
-            status_code = f"{error[1]}{error[2]}{error[3]}"
-            if status_code == "400":
-                email_pattern = r"""Email address (.*?) is invalid"""
-                # Extracting the email address
-                invalid_emails = re.findall(email_pattern, error)
-                invalid_email_list = invalid_email_list+invalid_emails
-                batch_with_invalid_contacts = batch_with_invalid_contacts+batch
-            if status_code == "409":
-                conflict_contacts = conflict_contacts+batch
-            print(f"Exception when creating contacts Batch {i}, ERROR: {status_code},")
-            continue
-    print("END: Contacts Added...")
-    return ([],conflict_contacts,invalid_email_list,batch_with_invalid_contacts)
+            status_code = getattr(e, 'status', None)
+            print(f"Exception when upserting contacts Batch {i}, ERROR: {status_code},")
+            return (rejected, batch)
+        return (rejected, [])
+
+    failed_contacts = []
+    for rejected, failed in run_batches(contact_batches, send_batch):
+        invalid_contacts = invalid_contacts+rejected
+        failed_contacts = failed_contacts+failed
+    invalid_email_list = [contact[0] for contact in invalid_contacts]
+    print("END: Contacts Upserted...")
+    return ([],failed_contacts,invalid_email_list,invalid_contacts)
 
 def delete_contacts(contacts):
     """
@@ -92,8 +588,7 @@ def delete_contacts(contacts):
         None: if the delete operation was successful, Error otherwise.
     """
     print("START: Deleting Contacts .....")
-    api_client = HubSpot()
-    api_client.access_token = token
+    api_client = get_client()
 
     # List to store batches of contacts
     contact_batches = []
@@ -131,11 +626,11 @@ def create_serials(payload):
 
     Returns:
         list: A list of tuples with serial information including the HubSpot ID and
-        the creation date.
+        the creation date. Failed batches and associations that could not be
+        created are raised once the other batches were stored.
     """
     print("START: Adding new serials to HubSpot")
-    api_client = HubSpot()
-    api_client.access_token = token
+    api_client = get_client()
     # Batch size
     batch_size = 100
 
@@ -147,9 +642,10 @@ def create_serials(payload):
     for i in range(0, len(serials), batch_size):
         batch = serials[i:i + batch_size]
         serial_batches.append(batch)
-    i=0
-    for batch in serial_batches:
-        contact_associations = []
+
+    associations = AssociationBuffer()
+
+    def send_batch(i, batch):
         hubspot_records = []
         try:
             json = [{"properties":
@@ -161,7 +657,6 @@ def create_serials(payload):
                         f"https://bcadmin.prod.sketchsrv.com/license_details.php?id={serial[3]}",
                         "sketch_id": serial[3]
                         }} for serial in batch ]
-            i=i+1
             payload = BatchInputSimplePublicObjectInputForCreate(json)
             api_response = api_client.crm.objects.batch_api.create(
                     object_type=serial_schema,
@@ -173,29 +668,31 @@ def create_serials(payload):
                 created = batch[n-1][7]
                 hubspot_records = hubspot_records+[(hubspot_id,serial,created)]
                 # Append the serial information including HubSpot ID and creation date to the list
-                contact = contacts_dict.get(api_response.results[n].properties.get("email", "N/A")
-                                            , None)
-                contact_associations = contact_associations +[
-                    {"from":{"id":hubspot_id},"to":{"id":str(contact)}}]
+                contact = contacts_dict.get(
+                    api_response.results[n].properties.get("billing_email", "N/A"), None)
+                associations.add(serial_schema, hubspot_id, contact_schema, contact)
             print(f"Serials -> {(i/len(serial_batches))*100}%")
         except Exception as e:
             error = str(e)
             print(error)
             print(f"{error[1]}{error[2]}{error[3]}")
-            continue
+            return None
 
         db.insert_serial_ids(hubspot_records)
+        return hubspot_records
 
-        # create associations for the newly added serials
-        associations = BatchInputPublicDefaultAssociationMultiPost(inputs=contact_associations)
-        try:
-            api_response = api_client.crm.associations.v4.batch_api.create_default(
-                from_object_type=serial_schema, to_object_type=contact_schema,
-                batch_input_public_default_association_multi_post=associations)
-            if api_response.status != "COMPLETE":
-                print("Error: Assoiciating contacts")
-        except ApiException as error:
-            print(f"Exception when calling batch_api->Associate: {error}/n")
+    hubspot_records = []
+    results = run_batches(serial_batches, send_batch)
+    for records in results:
+        if records is not None:
+            hubspot_records = hubspot_records+records
+    # create associations for the newly added serials
+    failed = associations.flush()
+    if len(failed) > 0:
+        raise Exception(f"{len(failed)} serial associations could not be created")
+    # The created mark only moves once every batch of the window was created
+    if results.count(None) > 0:
+        raise Exception(f"{results.count(None)} of {len(serial_batches)} serial batches failed")
     print("SUCCESS: Serials added to HubSpot")
     return hubspot_records
 
@@ -208,11 +705,10 @@ def update_serials(serials):
         containing serial details like (serial_number, email, created_timestamp).
 
     Returns:
-        True
+        True, failed batches are raised once every batch was sent.
     """
     print("START: Updating serials to hubspot")
-    api_client = HubSpot()
-    api_client.access_token = token
+    api_client = get_client()
     # Batch size
     batch_size = 100
 
@@ -223,8 +719,7 @@ def update_serials(serials):
         batch = serials[i:i + batch_size]
         serial_batches.append(batch)
 
-    i=0
-    for batch in serial_batches:
+    def send_batch(i, batch):
         try:
             json = [{"id":serial[8],"properties": {"serial": serial[0],"email": serial[1],
                                 "status": serial[6],
@@ -233,13 +728,17 @@ def update_serials(serials):
             api_client.crm.objects.batch_api.update(
                  object_type=serial_schema,
             batch_input_simple_public_object_batch_input=payload)
-            i=i+1
             print(f"Serials -> {(i/len(serial_batches))*100}%")
         except Exception as e:
             error = str(e)
             print(error)
             print(f"{error[1]}{error[2]}{error[3]}")
-            continue
+            return False
+        return True
+
+    failed = run_batches(serial_batches, send_batch).count(False)
+    if failed > 0:
+        raise Exception(f"{failed} of {len(serial_batches)} serial update batches failed")
     print("SUCCESS: Serials updated on Hubspot")
     return True
 
@@ -254,8 +753,7 @@ def delete_serials(serials):
         bool: True if the delete operation was successful, False otherwise.
     """
     print("START: Deleting serials on Hubspot")
-    api_client = HubSpot()
-    api_client.access_token = token
+    api_client = get_client()
     # Batch size
     batch_size = 100
 
@@ -296,7 +794,7 @@ def create_workspaces(workspaces):
         list: List of tuples containing HubSpot ID, SketchID, workspace name, and email.
     """
     print("START: Adding Workspaces to HubSpot...")
-    api_client = HubSpot(access_token=token)
+    api_client = get_client()
     batch_size = 100
     workspace_batches = []
     error_batch = []
@@ -306,9 +804,8 @@ def create_workspaces(workspaces):
         batch = workspaces[i:i + batch_size]
         workspace_batches.append(batch)
 
-    i = 0
-    for batch in workspace_batches:
-        i += 1
+    def send_batch(i, batch):
+        records = []
         try:
             # Prepare JSON payload for workspace creation
             json = [{
@@ -345,7 +842,7 @@ def create_workspaces(workspaces):
                 workspace = api_response.results[n].properties.get("sketch_id", "N/A")
                 email = api_response.results[n].properties.get("billing_email", "N/A")
                 customer_id = batch[n][3]
-                hubspot_records.append((hubspot_id, workspace, str(batch[n][15]),
+                records.append((hubspot_id, workspace, str(batch[n][15]),
                                         email,customer_id))
             print(f"Workspaces -> {(i/len(workspace_batches))*100}%")
 
@@ -354,8 +851,10 @@ def create_workspaces(workspaces):
             print(f"Exception when creating Workspace batch {i}")
             print(error)
             error_batch.append(batch)
-            continue
+        return records
 
+    for records in run_batches(workspace_batches, send_batch):
+        hubspot_records.extend(records)
     print("Success: Workspaces Added...")
     return hubspot_records
 
@@ -367,48 +866,19 @@ def workspaces_associate(workspaces,repair=False):
         workspaces (list): List of workspace data.
 
     Returns:
-        bool: True if associations are successful, False otherwise.
+        bool: True, associations that could not be created are raised.
     """
-    api_client = HubSpot(access_token=token)
-    batch_size = 1000
-    workspace_batches = []
-
-    for i in range(0, len(workspaces), batch_size):
-        batch = workspaces[i:i + batch_size]
-        workspace_batches.append(batch)
-
-    for batch in workspace_batches:
-        try:
-            # Prepare HubSpot associations for workspaces and contacts
-            if repair is True:
-                hubspot_associations = [{
-                "from": {"id": workspace[0]},
-                "to": {"id": workspace[4]}
-            } for workspace in batch]
-            else:
-                hubspot_associations = [{
-                    "from": {"id": workspace[0]},
-                    "to": {"id": workspace[5]}
-                } for workspace in batch]
-            # Create associations for the newly added workspaces
-            associations = BatchInputPublicDefaultAssociationMultiPost(inputs=hubspot_associations)
-            api_response = api_client.crm.associations.v4.batch_api.create_default(
-                from_object_type=workspace_schema,
-                to_object_type=contact_schema,
-                batch_input_public_default_association_multi_post=associations
-            )
-
-            if api_response.status != "COMPLETE":
-                print("Error: creating workspace Associations")
-            else:
-                print(api_response.status)
-
-        except Exception as e:
-            error = str(e)
-            status_code = f"{error[1]}{error[2]}{error[3]}"
-            print(f"Exception when calling batch_api->Associate: {status_code}\n")
-            continue
-
+    associations = AssociationBuffer()
+    for workspace in workspaces:
+        # Prepare HubSpot associations for workspaces and contacts
+        if repair is True:
+            associations.add(workspace_schema, workspace[0], contact_schema, workspace[4])
+        else:
+            associations.add(workspace_schema, workspace[0], contact_schema, workspace[5])
+    # Create associations for the newly added workspaces
+    failed = associations.flush()
+    if len(failed) > 0:
+        raise Exception(f"{len(failed)} workspace associations could not be created")
     return True
 
 def update_workspace(payload, hubspotid):
@@ -422,8 +892,7 @@ def update_workspace(payload, hubspotid):
     Returns:
         None
     """
-    api_client = HubSpot()
-    api_client.access_token = token
+    api_client = get_client()
     # Create a SimplePublicObjectInput instance
     object_input = SimplePublicObjectInput(properties=payload)
 
@@ -438,6 +907,48 @@ def update_workspace(payload, hubspotid):
     except ApiException as error:
         print(f"Exception when updating Workspaces: {error}\n")
 
+def update_workspaces(payload):
+    """
+    Update workspace details in HubSpot CRM in batches.
+
+    Args:
+        payload (list): List of tuples (hubspotid, properties), where properties is a
+            dictionary of updated workspace details, as sent by update_workspace.
+
+    Returns:
+        bool: True if every batch was updated, False otherwise.
+    """
+    print("START: Updating workspaces on HubSpot")
+    api_client = get_client()
+    batch_size = 100
+    workspace_batches = []
+
+    for i in range(0, len(payload), batch_size):
+        batch = payload[i:i + batch_size]
+        workspace_batches.append(batch)
+
+    def send_batch(i, batch):
+        try:
+            json = [{"id": str(hubspotid), "properties": properties}
+                    for hubspotid, properties in batch]
+            batch_input = BatchInputSimplePublicObjectId(inputs=json)
+            api_client.crm.objects.batch_api.update(
+                 object_type=workspace_schema,
+                 batch_input_simple_public_object_batch_input=batch_input
+            )
+            print(f"Workspaces -> {(i / len(workspace_batches)) * 100}%")
+            return True
+        except Exception as e:
+            print(f"Exception when updating Workspace batch {i}")
+            print(str(e))
+            return False
+
+    if not all(run_batches(workspace_batches, send_batch)):
+        print("Some Workspace batches were not updated")
+        return False
+    print("SUCCESS: Workspaces updated on HubSpot")
+    return True
+
 def delete_workspaces(payload):
     """
     Delete workspaces in HubSpot CRM.
@@ -450,11 +961,11 @@ def delete_workspaces(payload):
     """
     print("START: Deleting workspaces on HubSpot")
 
-    api_client = HubSpot()
-    api_client.access_token = token
+    api_client = get_client()
     workspaces = payload[0]
     batch_size = 100
     workspace_batches = []
+    failed = 0
 
     for i in range(0, len(workspaces), batch_size):
         batch = workspaces[i:i + batch_size]
@@ -475,8 +986,12 @@ def delete_workspaces(payload):
         except Exception as e:
             error = str(e)
             print(error)
+            failed += 1
             continue
 
+    if failed > 0:
+        print(f"{failed} Workspace batches were not deleted")
+        return False
     print("SUCCESS: Deleted workspaces on HubSpot")
     return True
 
@@ -489,12 +1004,11 @@ def create_memberships(payload):
         data and dictionaries for contacts and workspaces mapping.
 
     Returns:
-        list: A list of tuples containing HubSpot object IDs, corresponding sketch IDs, 
-        and creation dates.
+        bool: True if every batch was created and stored with its associations,
+            False otherwise.
     """
     print("START: Adding new memberships to HubSpot")
-    api_client = HubSpot(access_token=token)
-    api_client.access_token = token
+    api_client = get_client()
     batch_size = 100
     membership_batches = []
     error_batch = []
@@ -505,11 +1019,10 @@ def create_memberships(payload):
         batch = memberships[i:i + batch_size]
         membership_batches.append(batch)
 
+    associations = AssociationBuffer()
     i = 0
     for batch in membership_batches:
         hubspot_records = []
-        workspaces_associations = []
-        contacts_associations = []
         try:
             json = [{"properties": {
                         "workspace_membership_name": f"{membership[7]}_{membership[2]}",
@@ -536,27 +1049,9 @@ def create_memberships(payload):
                 name = (api_response.results[n-1].properties.get(
                     "workspace_membership_name", "N/A")).split('_')
                 organization = workspaces_dict.get(int(name[-1]))
-                if len(contacts_dict) > 0:
-                    contact = contacts_dict.get(email, None)  
-                    contacts_associations.append({"from": {"id": hubspot_id}, 
-                                              "to": {"id": str(contact)}}) 
-                    associations = BatchInputPublicDefaultAssociationMultiPost(inputs=contacts_associations)
-                    api_client.crm.associations.v4.batch_api.create_default(
-                        from_object_type=membership_schema, to_object_type=contact_schema,
-                        batch_input_public_default_association_multi_post=associations
-                                                    )
-                else:
-                    contact = None
-                
-                workspaces_associations.append({"from": {"id": hubspot_id}, 
-                                                "to": {"id": str(organization)}})
-
-            associations = BatchInputPublicDefaultAssociationMultiPost(
-                inputs=workspaces_associations)
-            api_client.crm.associations.v4.batch_api.create_default(
-                from_object_type=membership_schema, to_object_type=workspace_schema,
-                batch_input_public_default_association_multi_post=associations
-            )
+                contact = contacts_dict.get(email, None)
+                associations.add(membership_schema, hubspot_id, contact_schema, contact)
+                associations.add(membership_schema, hubspot_id, workspace_schema, organization)
 
             db.insert_membership_ids(hubspot_records)
             print(f"Memberships -> {(i / len(membership_batches)) * 100}%")
@@ -569,6 +1064,14 @@ def create_memberships(payload):
             error_batch.append(batch)
             continue
 
+    # Create the contact and workspace associations of all new memberships
+    failed = associations.flush()
+    if len(failed) > 0:
+        print(f"Error: {len(failed)} associations could not be created")
+        return False
+    if len(error_batch) > 0:
+        print(f"{len(error_batch)} Membership batches were not created")
+        return False
     print("SUCCESS: Memberships added to HubSpot")
     return True
 
@@ -580,67 +1083,16 @@ def memberships_association(memberships):
         memberships (list): List of membership data.
 
     Returns:
-        bool: True if memberships are successfully added to HubSpot.
+        bool: True, associations that could not be created are raised.
     """
-    # HubSpot API client initialization
-    api_client = HubSpot(access_token=token)
-    api_client.access_token = token
-
-    # Batch size for processing memberships
-    batch_size = 1000
-
-    # Lists to store batches, errors, and associations
-    membership_batches = []
-    error_batch = []
-    workspaces_associations = []
-    contacts_associations = []
-
-    # Splitting memberships into batches
-    for i in range(0, len(memberships), batch_size):
-        batch = memberships[i:i + batch_size]
-        membership_batches.append(batch)
-
-    i = 0
-    # Processing each batch of memberships
-    for batch in membership_batches:
-        try:
-            # Creating associations for workspaces and contacts
-            workspaces_associations = [{
-                "from": {"id": workspace[3]},
-                "to": {"id": workspace[5]}
-            } for workspace in batch]
-
-            contacts_associations = [{
-                "from": {"id": workspace[3]},
-                "to": {"id": workspace[4]}
-            } for workspace in batch]
-
-            # Creating associations for workspaces
-            associations_workspace = BatchInputPublicDefaultAssociationMultiPost(inputs=contacts_associations)
-            api_client.crm.associations.v4.batch_api.create_default(
-                from_object_type=membership_schema, to_object_type=contact_schema,
-                batch_input_public_default_association_multi_post=associations_workspace
-            )
-
-            # Creating associations for contacts
-            associations_contact = BatchInputPublicDefaultAssociationMultiPost(
-                inputs=workspaces_associations)
-            api_client.crm.associations.v4.batch_api.create_default(
-                from_object_type=membership_schema, to_object_type=workspace_schema,
-                batch_input_public_default_association_multi_post=associations_contact
-            )
-
-            # Incrementing count and printing progress
-            i += 1
-            print(f"Memberships -> {(i / len(membership_batches)) * 100}%")
-
-        except Exception as e:
-            # Handling exceptions and logging errors
-            error = str(e)
-            print(f"Exception when creating Membership batch {i}")
-            print(error)
-            error_batch.append(batch)
-            continue
+    associations = AssociationBuffer()
+    for membership in memberships:
+        # Creating associations for contacts and workspaces
+        associations.add(membership_schema, membership[3], contact_schema, membership[4])
+        associations.add(membership_schema, membership[3], workspace_schema, membership[5])
+    failed = associations.flush()
+    if len(failed) > 0:
+        raise Exception(f"{len(failed)} membership associations could not be created")
 
     # Printing success message and returning True upon completion
     print("SUCCESS: Memberships added to HubSpot")
@@ -656,11 +1108,10 @@ def update_memberships(payload):
         containing membership details like (sketchid, email, created_timestamp).
 
     Returns:
-        bool: True if the update operation was successful, False otherwise.
+        bool: True, failed batches are raised once every batch was sent.
     """
     print("START: Updating memberships on Hubspot")
-    api_client = HubSpot(access_token=token)
-    api_client.access_token = token
+    api_client = get_client()
     batch_size = 100
     memberships_batches = []
 
@@ -668,8 +1119,7 @@ def update_memberships(payload):
         batch = payload[i:i + batch_size]
         memberships_batches.append(batch)
 
-    i = 0
-    for batch in memberships_batches:
+    def send_batch(i, batch):
         try:
             json = [{"id":membership[8],"properties": {
                         "workspace_membership_name": f"{membership[7]}_{membership[2]}",
@@ -680,18 +1130,22 @@ def update_memberships(payload):
                         "is_contributor": membership[5],
                         "primary_membership": membership[4]
                     }}  for membership in batch]
-            payload = BatchInputSimplePublicObjectId(inputs=json)
+            batch_input = BatchInputSimplePublicObjectId(inputs=json)
             api_client.crm.objects.batch_api.update(
                  object_type=membership_schema,
-                 batch_input_simple_public_object_batch_input=payload
+                 batch_input_simple_public_object_batch_input=batch_input
             )
-            i += 1
             print(f"Memberships -> {(i / len(memberships_batches)) * 100}%")
         except Exception as e:
             error = str(e)
             print(error)
             print(f"{error[1]}{error[2]}{error[3]}")
-            continue
+            return False
+        return True
+
+    failed = run_batches(memberships_batches, send_batch).count(False)
+    if failed > 0:
+        raise Exception(f"{failed} of {len(memberships_batches)} membership update batches failed")
 
     print("SUCCESS: Memberships updated on Hubspot")
     return True
@@ -708,8 +1162,7 @@ def delete_memberships(payload):
     """
     print("START: Deleting memberships on Hubspot")
 
-    api_client = HubSpot()
-    api_client.access_token = token
+    api_client = get_client()
     workspaces = payload[0]
     # Batch size
     batch_size = 100
@@ -721,19 +1174,23 @@ def delete_memberships(payload):
     for i in range(0, len(workspaces), batch_size):
         batch = workspaces[i:i + batch_size]
         workspace_batches.append(batch)
-    i=0
+    failed = 0
     for batch in workspace_batches:
         try:
             json = [ {"id": workspace[0]} for workspace in batch]
             payload = BatchInputSimplePublicObjectId(inputs=json)
-        # Delete a serial object in HubSpot
+        # Delete a membership object in HubSpot
             api_client.crm.objects.batch_api.archive(
                 batch_input_simple_public_object_id=payload,
-                object_type=workspace_schema
+                object_type=membership_schema
             )
         except Exception as e:
             error = str(e)
             print(error)
+            failed += 1
             continue
-    print("SUCCESS: Deleted workspaces on Hubspot")
+    if failed > 0:
+        print(f"{failed} Membership batches were not deleted")
+        return False
+    print("SUCCESS: Deleted memberships on Hubspot")
     return True
\ No newline at end of file
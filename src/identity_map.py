@@ -0,0 +1,114 @@
+""" This module contains the in-process map of synced objects to their HubSpot IDs """
+import threading
+from collections import OrderedDict
+
+
+class IdentityMap:
+    """
+    Bounded, thread-safe map of object keys (emails, workspace, serial or
+    membership ids) to HubSpot IDs, shared by the workflows of a process.
+
+    Keys missing from memory are loaded together with `load` and kept. Once
+    more than `max_size` keys are held the least recently used are evicted.
+    Keys without a HubSpot ID are not remembered, as they may be created later.
+    Keys are compared as strings, so an id read as an integer from one
+    database and as text from another is the same key.
+    """
+
+    def __init__(self, load, max_size=100000):
+        self.load = load
+        self.max_size = max_size
+        self.ids = OrderedDict()
+        # Keys by HubSpot ID, so deleted or reassigned HubSpot IDs are dropped without a scan
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def resolve(self, keys):
+        """
+        Return the HubSpot IDs of `keys`, loading only the ones not in memory.
+
+        Args:
+            keys (list): The keys to resolve; None is skipped.
+
+        Returns:
+            dict: HubSpot IDs keyed by the requested keys that have one.
+        """
+        found = {}
+        missing = []
+        with self.lock:
+            for key in dict.fromkeys(key for key in keys if key is not None):
+                if str(key) in self.ids:
+                    self.ids.move_to_end(str(key))
+                    found[key] = self.ids[str(key)]
+                    self.hits += 1
+                else:
+                    missing.append(key)
+                    self.misses += 1
+        if len(missing) > 0:
+            loaded = self.update(self.load(missing))
+            for key in missing:
+                if str(key) in loaded:
+                    found[key] = loaded[str(key)]
+        return found
+
+    def update(self, rows):
+        """
+        Remember new or changed mappings, e.g. once they were written to the database.
+
+        Args:
+            rows (list): Tuples (key, hubspotID).
+
+        Returns:
+            dict: The given HubSpot IDs keyed by the string of their key.
+        """
+        rows = {str(key): hubspot_id for key, hubspot_id in rows or []}
+        with self.lock:
+            for key, hubspot_id in rows.items():
+                self._drop(key)
+                self.ids[key] = hubspot_id
+                self.keys.setdefault(str(hubspot_id), set()).add(key)
+            while len(self.ids) > self.max_size:
+                self._drop(next(iter(self.ids)))
+        return rows
+
+    def forget(self, keys):
+        """
+        Drop the mappings of deleted objects.
+
+        Args:
+            keys (list): The keys to drop.
+        """
+        with self.lock:
+            for key in keys:
+                self._drop(str(key))
+
+    def forget_ids(self, hubspot_ids):
+        """
+        Drop the mappings pointing to deleted HubSpot objects.
+
+        Args:
+            hubspot_ids (list): The HubSpot IDs to drop.
+        """
+        with self.lock:
+            for hubspot_id in hubspot_ids:
+                for key in self.keys.pop(str(hubspot_id), ()):
+                    del self.ids[key]
+
+    def _drop(self, key):
+        if key not in self.ids:
+            return
+        hubspot_id = str(self.ids.pop(key))
+        keys = self.keys[hubspot_id]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self.keys[hubspot_id]
+
+    def hit_ratio(self):
+        """
+        Return the share of resolved keys that were found in memory.
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return self.hits / total if total > 0 else 0.0
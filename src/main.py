@@ -1,41 +1,121 @@
-""" run workflows sequentially """
+""" run workflows concurrently, in the order of their dependencies """
+import os
 import sys
+import signal
+import threading
 import database as db # Import your database functions module
 import hubspot_api as hubspot # Import your HubSpot functions module
 import stripe_api as stripe # Import your Stripe functions module
+import postgres # Import the database connection pools
+import scheduler # Import the workflow scheduler
+import cdc # Import the change data capture consumer
 
 REQUEST_DELAY = 0.1  # Delay between API requests in seconds
+WORKFLOW_WORKERS = int(os.getenv('WORKFLOW_WORKERS', '4'))  # Workflows run at the same time
+# Default seconds between two runs of each workflow in daemon mode,
+# overridden by WORKFLOW_INTERVAL_<NAME>; 0 disables a workflow
+DAEMON_INTERVALS = {
+    'contacts': 60,
+    'update_serials': 3600,
+    'add_serials': 3600,
+    'workspaces': 300,
+    'sync_subscriptions': 300,
+    'update_memberships': 900,
+    'add_memberships': 900,
+    'changes': 1,
+    'flush': 5,
+}
+# Seconds a pending HubSpot write may wait for more rows in daemon mode
+COALESCE_DELAY = float(os.getenv('HUBSPOT_COALESCE_DELAY', '30'))
+# Take cloud contacts, workspaces and memberships from the changes captured
+# on the cloud DB (see `python main.py install_cdc`) instead of polling them
+CDC_ENABLED = os.getenv('CLOUD_CDC', '0') == '1'
+# Seconds the changes workflow waits for new changes in daemon mode
+CDC_WAIT = float(os.getenv('CDC_NOTIFY_WAIT', '5'))
+# Seconds a captured membership waits for its contact and workspace before
+# it is created without the missing association
+CDC_MEMBERSHIP_WAIT = int(os.getenv('CDC_MEMBERSHIP_WAIT', '86400'))
+
+def send_serial_creates(serials, contacts):
+    """
+    Create coalesced serials in HubSpot and store their HubSpot IDs, skipping
+    the ones stored since they were queued, e.g. by a send that failed on
+    their associations.
+    """
+    stored = db.serial_ids.resolve([serial[0] for serial in serials])
+    serials = [serial for serial in serials if serial[0] not in stored]
+    if len(serials) == 0:
+        return
+    serial_hubspot_ids = hubspot.create_serials((serials, contacts))
+    db.insert_serial_ids(serial_hubspot_ids)
+
+def send_membership_creates(memberships, contacts, workspaces):
+    """
+    Create coalesced memberships in HubSpot, skipping the ones stored since
+    they were queued, e.g. by the successful batches of a failed send.
+    """
+    stored = db.membership_ids.resolve([membership[0] for membership in memberships])
+    memberships = [membership for membership in memberships if membership[0] not in stored]
+    if len(memberships) == 0:
+        return
+    if not hubspot.create_memberships((memberships, contacts, workspaces)):
+        raise Exception("Some memberships were not created in HubSpot")
+
+# Pending HubSpot writes per object type; sent at once unless run_daemon sets a deadline
+# Created marks move once every row read up to them was created
+serial_creates = hubspot.CoalescingBuffer(
+    send_serial_creates, key=lambda serial: serial[0],
+    on_sent=lambda created: db.advance_checkpoint('serials', 'legacy', 'created', created))
+# Update windows are marked as synced only once HubSpot accepted all their rows
+serial_updates = hubspot.CoalescingBuffer(
+    hubspot.update_serials, key=lambda serial: serial[8],
+    on_sent=lambda until: db.advance_checkpoint('serials', 'legacy', 'updated', [until]))
+membership_creates = hubspot.CoalescingBuffer(
+    send_membership_creates, key=lambda membership: membership[0],
+    on_sent=lambda created: db.advance_checkpoint('memberships', 'cloud', 'created', created))
+membership_updates = hubspot.CoalescingBuffer(
+    hubspot.update_memberships, key=lambda membership: membership[8],
+    on_sent=lambda until: db.advance_checkpoint('memberships', 'cloud', 'updated', [until]))
+BUFFERS = [serial_creates, serial_updates, membership_creates, membership_updates]
 
 def add_contacts_workflow():
     """
     Workflow function to add contacts to HubSpot.
 
-    Retrieves contacts from the database, creates contacts in HubSpot,
-    and handles duplicates and invalid emails.
+    Retrieves contacts from the database, upserts contacts in HubSpot
+    keyed on email, and handles invalid emails.
 
     Returns:
         None
     """
-    try:
-        contacts = db.get_contacts()
+    found = False
+    # Cloud and SSO contacts come from the captured changes when enabled
+    sources = ('serial',) if CDC_ENABLED else ('cloud', 'sso', 'serial')
+    # Contacts arrive in chunks so a full sync never holds every row at once
+    for contacts in db.iter_contacts(sources):
         if len(contacts) == 0:
-            print("No new contacts found")
-        else:
-            result = hubspot.create_contacts(contacts)
-            if len(result[0]) > 0:
-                db.insert_contact_ids(result[0])
-            while len(result[1]) > 0 or len(result[2]) > 0:
-                # Handling duplicate contacts and invalid emails
-                result3 = db.duplicate_contacts(result[1]) if len(result[1]) > 0 else []
-                db.invalid_emails(result[2]) if len(result[2]) > 0 else []
-                contacts_batch = result[3]
-                filtered_contacts = [contact for contact in contacts_batch 
-                                     if contact[0] not in result[2]]
-                result = hubspot.create_contacts(result3 + filtered_contacts)
-                if len(result[0]) > 0:
-                    db.insert_contact_ids(result[0])
-    except Exception as e:
-        print(f"An error occurred: {e}")
+            continue
+        found = True
+        add_contacts(contacts)
+    if not found:
+        print("No new contacts found")
+
+def add_contacts(contacts):
+    """
+    Upsert contacts in HubSpot and store the invalid emails.
+    """
+    # Upserting on email means existing contacts no longer fail with 409
+    result = hubspot.upsert_contacts(contacts)
+    # Only the rejected contacts come back, the rest of their batches was resent
+    if len(result[2]) > 0:
+        db.invalid_emails(result[2])
+    # Contacts of failed batches are not invalid, fail the run so they are retried
+    if len(result[1]) > 0:
+        raise Exception(f"{len(result[1])} contacts failed to upsert")
+    # Every contact type has its own mark, moved once all its batches were upserted
+    for contact_type in set(contact[2] for contact in contacts):
+        db.advance_checkpoint('contacts', contact_type, 'created',
+                              [contact[1] for contact in contacts if contact[2] == contact_type])
 
 def update_serials_workflow():
     """
@@ -46,14 +126,11 @@ def update_serials_workflow():
     Returns:
         None
     """
-    try:
-        updated_serials = db.get_updated_serials()
-        if len(updated_serials) == 0:
-            print("No Serials to be updated")
-        else:
-            hubspot.update_serials(updated_serials)
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    updated_serials, until = db.get_updated_serials()
+    if len(updated_serials) == 0:
+        print("No Serials to be updated")
+    # The window is marked as synced once its rows were sent
+    serial_updates.add(updated_serials, mark=until)
 
 def add_serials_workflow():
     """
@@ -65,15 +142,16 @@ def add_serials_workflow():
     Returns:
         None
     """
-    try:
-        new_serials = db.get_serials()
+    found = False
+    # Serials arrive in chunks so a full sync never holds every row at once
+    for new_serials in db.iter_serials():
         if len(new_serials[0]) == 0:
-            print("No new Serials found")
-        else:
-            serial_hubspot_ids = hubspot.create_serials(new_serials)
-            db.insert_serial_ids(serial_hubspot_ids)
-    except Exception as e:
-        print(f"An error occurred: {e}")
+            continue
+        found = True
+        serial_creates.add(new_serials[0], new_serials[1],
+                           mark=[serial[7] for serial in new_serials[0]])
+    if not found:
+        print("No new Serials found")
 
 def add_workspaces_workflow():
     """
@@ -86,19 +164,46 @@ def add_workspaces_workflow():
     Returns:
         None
     """
-    try:
-        new_workspaces = db.get_workspaces()
-        if len(new_workspaces) == 0:
-            print("No new Workspaces found")
-        else:
-            workspaces = stripe.get_subscriptions(new_workspaces)
-            workspaces_hubspot_ids = hubspot.create_workspaces(workspaces)
-            
-            workspaces_complete = db.add_contact_hubspot_id(workspaces_hubspot_ids)
-            db.insert_workspace_ids(workspaces_hubspot_ids)
-            hubspot.workspaces_associate(workspaces_complete)
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    new_workspaces = db.get_workspaces()
+    if len(new_workspaces) == 0:
+        print("No new Workspaces found")
+    else:
+        add_workspaces(new_workspaces)
+
+def add_workspaces(new_workspaces):
+    """
+    Create workspaces with their subscriptions in HubSpot, store their HubSpot IDs
+    and associate them with their contacts.
+    """
+    # Workspaces stored by a run that failed afterwards are read again, skip them
+    stored = db.workspace_ids.resolve([workspace[0] for workspace in new_workspaces])
+    new_workspaces = [workspace for workspace in new_workspaces if workspace[0] not in stored]
+    if len(new_workspaces) == 0:
+        return
+    workspaces = stripe.get_subscriptions(new_workspaces)
+    workspaces_hubspot_ids = hubspot.create_workspaces(workspaces)
+
+    workspaces_complete = db.add_contact_hubspot_id(workspaces_hubspot_ids)
+    if not db.insert_workspace_ids(workspaces_hubspot_ids):
+        raise Exception(f"HubSpot IDs of {len(workspaces_hubspot_ids)} workspaces were not stored")
+    hubspot.workspaces_associate(workspaces_complete)
+    if len(workspaces_hubspot_ids) < len(workspaces):
+        raise Exception(f"{len(workspaces) - len(workspaces_hubspot_ids)} workspaces "
+                        "were not created in HubSpot")
+    db.advance_checkpoint('workspaces', 'cloud', 'created',
+                          [workspace[2] for workspace in workspaces_hubspot_ids])
+
+def sync_subscriptions_workflow():
+    """
+    Workflow function to update existing workspaces in HubSpot.
+
+    Reads the Stripe subscription events since the last run and updates the
+    status, renewal date, auto renewal and seats of the affected workspaces.
+
+    Returns:
+        None
+    """
+    stripe.sync_subscription_events()
 
 def delete_serials_workflow():
     """
@@ -110,14 +215,11 @@ def delete_serials_workflow():
     Returns:
         None
     """
-    try:
-        hubspot_ids = db.delete_serial_ids()
-        if len(hubspot_ids) > 0:
-            hubspot.delete_serials(hubspot_ids)
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    hubspot_ids = db.delete_serial_ids()
+    if len(hubspot_ids) > 0:
+        hubspot.delete_serials(hubspot_ids)
 
-def create_all_workspaces():
+def create_all_workspaces(resume=False):
     """
     Workflow function to create all workspaces in HubSpot.
 
@@ -125,14 +227,14 @@ def create_all_workspaces():
     creates workspaces in HubSpot, associates contacts and workspaces, 
     and stores corresponding HubSpot IDs in the database.
 
+    Args:
+        resume (bool): Continue a failed backfill from its last checkpointed batch.
+
     Returns:
         None
     """
-    try:
-        stripe.get_all_subscriptions()
-        
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    if not stripe.get_all_subscriptions(resume):
+        raise Exception("Workspace backfill stopped before its last batch")
 
 def add_memberships():
     """
@@ -144,14 +246,12 @@ def add_memberships():
     Returns:
         None
     """
-    try:
-        new_memberships = db.get_memberships()
-        if len(new_memberships) == 0:
-            print("No new Memberships found")
-        else:
-            hubspot.create_memberships(new_memberships)
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    new_memberships = db.get_memberships()
+    if len(new_memberships) == 0:
+        print("No new Memberships found")
+    else:
+        membership_creates.add(*new_memberships,
+                               mark=[membership[6] for membership in new_memberships[0]])
 
 def delete_workpaces_and_memberships():
     """
@@ -164,17 +264,13 @@ def delete_workpaces_and_memberships():
     Returns:
         None
     """
-    try:
-        workspaces = db.delete_workspace_ids()
-        print(len(workspaces))
-        if len(workspaces[0]) > 0:
-            hubspot.delete_workspaces(workspaces[0])
-            hubspot.delete_memberships(hubspotids)
-
-            hubspotids = db.delete_memberships(workspaces[1])
+    workspaces = db.delete_workspace_ids()
+    print(len(workspaces))
+    if len(workspaces[0]) > 0:
+        hubspot.delete_workspaces(workspaces[0])
+        hubspot.delete_memberships(hubspotids)
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
+        hubspotids = db.delete_memberships(workspaces[1])
 
 def update_memberships():
     """
@@ -186,14 +282,110 @@ def update_memberships():
     Returns:
         None
     """
-    try:
-        updated_memberships = db.get_updated_memberships()
-        if len(updated_memberships) == 0:
-            print("No Memberships to be updated")
-        else:
-            hubspot.update_memberships(updated_memberships)
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    updated_memberships, until = db.get_updated_memberships()
+    if len(updated_memberships) == 0:
+        print("No Memberships to be updated")
+    # The window is marked as synced once its rows were sent
+    membership_updates.add(updated_memberships, mark=until)
+
+def apply_changes(changes):
+    """
+    Apply a batch of changes captured on the cloud DB to HubSpot.
+
+    Contacts go first, then workspaces, then memberships, so every row finds
+    the HubSpot IDs it is associated with. Everything is written before this
+    returns and any failed write is raised, so cdc.drain keeps the batch for
+    the next run. Stored rows are deleted after their HubSpot objects, so a
+    failed delete is retried too.
+
+    Args:
+        changes (dict): Row ids by table and operation, see cdc.collapse.
+
+    Returns:
+        None
+    """
+    empty = {'insert': [], 'update': [], 'delete': []}
+    users = changes.get('Users', empty)
+    identities = changes.get('ExternalIdentities', empty)
+    organizations = changes.get('Organizations', empty)
+    memberships = changes.get('OrganizationMemberships', empty)
+
+    # Captured user updates are email changes, upserted like new contacts
+    contacts = db.get_contacts_by_ids(users['insert'] + users['update'],
+                                      identities['insert'] + identities['update'])
+    if len(contacts) > 0:
+        add_contacts(contacts)
+
+    # Captured workspace updates set or clear "deletedAt"
+    new_workspaces = db.get_workspaces_by_ids(organizations['insert'] + organizations['update'])
+    if len(new_workspaces) > 0:
+        add_workspaces(new_workspaces)
+    deleted = organizations['delete'] + db.get_soft_deleted_workspaces(organizations['update'])
+    if len(deleted) > 0:
+        remove_memberships(db.get_workspace_members(deleted))
+        workspace_ids = db.get_deleted_workspace_hubspot_ids(deleted)
+        if len(workspace_ids) > 0 and not hubspot.delete_workspaces((workspace_ids,)):
+            raise Exception("Some workspaces were not deleted in HubSpot")
+        db.delete_workspaces_by_ids(deleted)
+
+    # Sent straight away instead of through the daemon's buffers, the cursor
+    # must not move past rows still waiting to be sent
+    add_memberships_by_ids(memberships['insert'])
+    updated_memberships = db.get_updated_memberships_by_ids(memberships['update'])
+    if len(updated_memberships) > 0:
+        hubspot.update_memberships(updated_memberships)
+    remove_memberships(memberships['delete'])
+
+def add_memberships_by_ids(member_ids, overdue_ids=()):
+    """
+    Create captured memberships whose contact and workspace are in HubSpot.
+
+    The others are kept in the waiting_memberships table and tried again by
+    the next changes run, so their associations are not lost once the
+    changes cursor moved on. Memberships in `overdue_ids` are created anyway.
+    """
+    if len(member_ids) == 0:
+        return
+    memberships, contacts, workspaces = db.get_memberships_by_ids(member_ids)
+    overdue_ids = set(str(member) for member in overdue_ids)
+    ready = [membership for membership in memberships
+             if str(membership[0]) in overdue_ids
+             or ((membership[7] is None or membership[7].replace("'", "") in contacts)
+                 and membership[2] in workspaces)]
+    ready_ids = set(membership[0] for membership in ready)
+    waiting = [membership[0] for membership in memberships if membership[0] not in ready_ids]
+    if len(ready) > 0:
+        send_membership_creates(ready, contacts, workspaces)
+    if len(waiting) > 0:
+        print(f"{len(waiting)} memberships wait for their contact or workspace")
+    if not db.hold_memberships(member_ids, waiting):
+        raise Exception("Waiting memberships could not be stored")
+
+def remove_memberships(member_ids):
+    """
+    Delete memberships in HubSpot, then their stored HubSpot IDs.
+    """
+    hubspot_ids = db.get_deleted_membership_hubspot_ids(member_ids)
+    if len(hubspot_ids) > 0 and not hubspot.delete_memberships((hubspot_ids,)):
+        raise Exception("Some memberships were not deleted in HubSpot")
+    db.delete_memberships_by_ids(member_ids)
+
+def changes_workflow(wait=0):
+    """
+    Workflow function to apply the changes captured on the cloud DB to HubSpot.
+
+    Replaces the polling of cloud contacts, workspaces and memberships,
+    and also sees rows deleted without a "deletedAt".
+
+    Args:
+        wait (float): Seconds to wait for new changes once caught up.
+
+    Returns:
+        None
+    """
+    cdc.drain(apply_changes, wait)
+    waiting, overdue = db.get_waiting_memberships(CDC_MEMBERSHIP_WAIT)
+    add_memberships_by_ids(waiting, overdue)
 
 def associate_repair():
     """
@@ -213,30 +405,127 @@ def associate_repair():
     memberships = db.memberships_associations()
     hubspot.memberships_association(memberships)
 
+def workflow_graph(command=None, resume=False, changes_wait=0):
+    """
+    Build the workflows of a run with the workflows each of them depends on.
+
+    Serials and workspaces need contacts, memberships need workspaces. With
+    CDC_ENABLED the changes workflow takes the place of the workspace and
+    membership workflows.
+
+    Args:
+        command (str): Optional command, 'create_all_workspaces' or 'associate'.
+        resume (bool): Resume a failed create_all_workspaces backfill.
+        changes_wait (float): Seconds the changes workflow waits for new changes.
+
+    Returns:
+        list: Tuples (name, function, dependencies) for scheduler.run_workflows.
+    """
+    workflows = [
+        # ('delete_workspaces_and_memberships', delete_workpaces_and_memberships, []),
+        ('contacts', add_contacts_workflow, []),
+        ('update_serials', update_serials_workflow, ['contacts']),
+        ('add_serials', add_serials_workflow, ['update_serials']),
+    ]
+    workspace_dependencies = ['contacts']
+    if command == "create_all_workspaces":
+        workflows.append(('create_all_workspaces',
+                          lambda: create_all_workspaces(resume), ['contacts']))
+        workspace_dependencies.append('create_all_workspaces')
+    elif command == "associate":
+        print("START: Repair associations")
+        workflows.append(('associate', associate_repair, ['contacts']))
+        workspace_dependencies.append('associate')
+    elif command is not None:
+        print("Invalid command. Available commands: create_all_workspaces [--resume], "
+              "associate, install_cdc, daemon")
+    if CDC_ENABLED:
+        workflows.extend([
+            ('changes', lambda: changes_workflow(changes_wait), workspace_dependencies),
+            ('sync_subscriptions', sync_subscriptions_workflow, ['changes']),
+        ])
+        return workflows
+    workflows.extend([
+        ('workspaces', add_workspaces_workflow, workspace_dependencies),
+        ('sync_subscriptions', sync_subscriptions_workflow, ['workspaces']),
+        ('update_memberships', update_memberships, ['workspaces']),
+        ('add_memberships', add_memberships, ['update_memberships']),
+    ])
+    return workflows
+
+def run_daemon():
+    """
+    Keep running the workflows, each on its own interval, until SIGTERM or SIGINT.
+
+    Database pools, HubSpot clients and the rate limiter stay warm between
+    runs. On shutdown the running workflows are allowed to finish.
+
+    Returns:
+        None
+    """
+    stop = threading.Event()
+    def request_stop(signum, frame): # pylint: disable=unused-argument
+        print(f"Received signal {signum}, stopping after the running workflows")
+        stop.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    intervals = {name: int(os.getenv(f"WORKFLOW_INTERVAL_{name.upper()}", default))
+                 for name, default in DAEMON_INTERVALS.items()}
+    # Small deltas wait for more rows instead of costing a batch call each
+    for buffer in BUFFERS:
+        buffer.max_delay = COALESCE_DELAY
+    workflows = workflow_graph(changes_wait=CDC_WAIT) + [('flush', flush_buffers, [])]
+    print(f"START: Daemon with intervals {intervals}")
+    runs = scheduler.run_forever(workflows, intervals, stop, WORKFLOW_WORKERS)
+    flush_buffers(force=True)
+    print(f"SUCCESS: Daemon stopped after {sum(runs.values())} workflow runs")
+
+def flush_buffers(force=False):
+    """
+    Send the pending HubSpot writes that are full or overdue, or all of them when forced.
+
+    Every buffer is flushed even when an earlier one fails; the first error
+    is raised afterwards.
+
+    Returns:
+        None
+    """
+    errors = []
+    for buffer in BUFFERS:
+        try:
+            buffer.flush(force)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            errors.append(e)
+    if len(errors) > 0:
+        raise errors[0]
+
 def main():
     """
     The main function that orchestrates the execution of various workflows.
     """
-    # delete_workspaces_and_memberships()
-    add_contacts_workflow()
-    update_serials_workflow()
-    add_serials_workflow()
-    if len(sys.argv) > 1:
-        command = sys.argv[1]
-        if command == "create_all_workspaces":
-            create_all_workspaces()
-        if command == "associate":
-            print("START: Repair associations")
-            associate_repair()
+    try:
+        command = sys.argv[1] if len(sys.argv) > 1 else None
+        if command == "daemon":
+            run_daemon()
+        elif command == "install_cdc":
+            db.install_change_capture()
         else:
-            print("Invalid command. Available commands: create_all_workspaces")
-    else:
-        # Default behavior when no arguments are provided
-        print("No command specified. Default behavior.")
-
-    add_workspaces_workflow()
-    update_memberships()
-    add_memberships()
+            if command is None:
+                # Default behavior when no arguments are provided
+                print("No command specified. Default behavior.")
+            # Independent workflows run concurrently, dependents wait for them
+            scheduler.run_workflows(workflow_graph(command, "--resume" in sys.argv[2:]),
+                                    WORKFLOW_WORKERS)
+    finally:
+        # Close pooled database connections
+        postgres.close_pools()
+        print(f"HubSpot rate limiting: {hubspot.throttled_seconds():.1f}s spent throttled")
+        print(f"Stripe customer cache: {stripe.customer_cache_stats['hits']} hits, "
+              f"{stripe.customer_cache_stats['misses']} misses")
+        for name, identity_map in db.IDENTITY_MAPS.items():
+            print(f"Identity map {name}: {identity_map.hits} hits, {identity_map.misses} misses "
+                  f"({identity_map.hit_ratio():.0%}), {len(identity_map.ids)} held")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
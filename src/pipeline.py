@@ -0,0 +1,71 @@
+""" This module contains the staged pipeline used by the full syncs """
+import time
+import queue
+import threading
+
+_DONE = object()
+
+
+def run_pipeline(source, stages, maxsize=2):
+    """
+    Pass every item of `source` through `stages`, with every stage on its own thread.
+
+    Stages are connected by bounded queues: a stage that gets ahead blocks once
+    `maxsize` items wait for the next one, so memory stays flat and the total
+    runtime approaches that of the slowest stage.
+
+    Args:
+        source (iterable): Items for the first stage, consumed on its own thread.
+        stages (list): Tuples (name, function). Each function takes an item and
+            returns the item for the next stage, or None to drop it. An item
+            whose stage raises is reported and dropped.
+        maxsize (int): Items allowed to wait between two stages.
+
+    Returns:
+        int: Number of items that went through every stage.
+    """
+    queues = [queue.Queue(maxsize=maxsize) for _ in stages]
+    busy = {name: 0.0 for name, _ in stages}
+    completed = [0]
+
+    def produce():
+        try:
+            for item in source:
+                queues[0].put(item)
+        except Exception as e:
+            print(f"Error in pipeline source: {e}")
+        finally:
+            queues[0].put(_DONE)
+
+    def consume(n, name, function):
+        while True:
+            item = queues[n].get()
+            if item is _DONE:
+                if n + 1 < len(queues):
+                    queues[n + 1].put(_DONE)
+                return
+            started = time.monotonic()
+            try:
+                result = function(item)
+            except Exception as e:
+                print(f"Error in pipeline stage {name}: {e}")
+                result = None
+            busy[name] += time.monotonic() - started
+            if result is None:
+                continue
+            if n + 1 < len(queues):
+                queues[n + 1].put(result)
+            else:
+                completed[0] += 1
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads.extend(threading.Thread(target=consume, args=(n, name, function), daemon=True)
+                   for n, (name, function) in enumerate(stages))
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stage_times = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in busy.items())
+    print(f"Pipeline: {completed[0]} items in {time.monotonic() - started:.1f}s ({stage_times})")
+    return completed[0]
@@ -1,13 +1,185 @@
 """ This module handles all database connections"""
 import os
+import io
+import csv
+import pickle
+import select
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+from psycopg2 import sql
 import mysql.connector
+import mysql.connector.pooling
 from dotenv import load_dotenv, find_dotenv
 
 # Load environment variables from a .env file
 load_dotenv(find_dotenv())
 
+# Connection pool sizes, shared by every database
+POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN', '1'))
+POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX', '5'))
+# Bulk writes at or above this many rows are loaded with COPY
+COPY_THRESHOLD = int(os.getenv('DB_COPY_THRESHOLD', '10000'))
+# Rows fetched per round trip by streaming queries
+STREAM_CHUNK_SIZE = int(os.getenv('DB_STREAM_CHUNK', '5000'))
+# Keys bound per query by lookup
+LOOKUP_CHUNK_SIZE = int(os.getenv('DB_LOOKUP_CHUNK', '10000'))
+
+# One pool per database, created on first use
+_pools = {}
+_pools_lock = threading.Lock()
+# Connections kept open by wait_for_notify, keyed by database and channel
+_listeners = {}
+
+
+def _connection_params(database):
+    """
+    Build the connection parameters for a database from the environment.
+
+    Args:
+        database (str): One of 'analytics', 'cloud', 'payments' or 'legacy'.
+
+    Returns:
+        dict: Keyword arguments for the database driver.
+    """
+    if database == 'legacy':
+        return {
+            'database': os.getenv('LEGACY_NAME'),
+            'user': os.getenv('LEGACY_USER'),
+            'password': os.getenv('LEGACY_PASSWORD'),
+            'host': os.getenv('LEGACY_HOST'),
+            'port': os.getenv('LEGACY_PORT'),
+        }
+    prefix = database.upper()
+    params = {
+        'dbname': os.getenv(f'{prefix}_NAME'),
+        'user': os.getenv(f'{prefix}_USER'),
+        'password': os.getenv(f'{prefix}_PASSWORD'),
+        'host': os.getenv(f'{prefix}_HOST'),
+        'port': os.getenv(f'{prefix}_PORT'),
+    }
+    if database in ('cloud', 'payments'):
+        params['cursor_factory'] = psycopg2.extras.DictCursor
+    return params
+
+def _get_pool(database):
+    """
+    Return the pool for a database, creating it on first use.
+
+    A semaphore sized to the pool's maximum makes checkouts wait for a free
+    connection instead of failing when every connection is in use.
+
+    Args:
+        database (str): One of 'analytics', 'cloud', 'payments' or 'legacy'.
+
+    Returns:
+        tuple: (pool, semaphore)
+    """
+    with _pools_lock:
+        if database not in _pools:
+            params = _connection_params(database)
+            if database == 'legacy':
+                pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name=database, pool_size=POOL_MAX_SIZE, **params)
+            else:
+                pool = psycopg2.pool.ThreadedConnectionPool(
+                    POOL_MIN_SIZE, POOL_MAX_SIZE, **params)
+            _pools[database] = (pool, threading.BoundedSemaphore(POOL_MAX_SIZE))
+        return _pools[database]
+
+def _is_healthy(database, conn):
+    """
+    Check that a pooled connection is still usable.
+
+    Args:
+        database (str): The database the connection belongs to.
+        conn: A pooled psycopg2 or mysql.connector connection.
+
+    Returns:
+        bool: True if the connection answered a ping, False otherwise.
+    """
+    try:
+        if database == 'legacy':
+            conn.ping(reconnect=True, attempts=1)
+            return True
+        if conn.closed:
+            return False
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        cur.close()
+        conn.rollback()
+        return True
+    except (Exception, psycopg2.DatabaseError, mysql.connector.Error):
+        return False
+
+def _release(database, pool, conn, broken=False):
+    """
+    Return a connection to its pool, discarding it if it is broken.
+    """
+    if database == 'legacy':
+        conn.close()
+        return
+    if not broken and not conn.closed:
+        try:
+            conn.rollback()
+        except psycopg2.DatabaseError:
+            broken = True
+    pool.putconn(conn, close=broken or bool(conn.closed))
+
+@contextmanager
+def connection(database):
+    """
+    Check a healthy connection out of the database pool.
+
+    Args:
+        database (str): One of 'analytics', 'cloud', 'payments' or 'legacy'.
+
+    Yields:
+        A psycopg2 or mysql.connector connection, returned to the pool on exit.
+    """
+    pool, semaphore = _get_pool(database)
+    semaphore.acquire()
+    conn = None
+    try:
+        if database == 'legacy':
+            conn = pool.get_connection()
+            if not _is_healthy(database, conn):
+                raise mysql.connector.Error("Unable to reconnect to LEGACY database")
+        else:
+            conn = pool.getconn()
+            if not _is_healthy(database, conn):
+                # Replace a stale connection with a fresh one
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        yield conn
+    finally:
+        if conn is not None:
+            _release(database, pool, conn)
+        semaphore.release()
+
+def close_pools():
+    """
+    Close every open connection pool and listening connection. Call once at the end of a run.
+    """
+    with _pools_lock:
+        for database, (pool, _) in _pools.items():
+            try:
+                if database == 'legacy':
+                    # MySQLConnectionPool has no public close method
+                    pool._remove_connections() # pylint: disable=protected-access
+                else:
+                    pool.closeall()
+            except (Exception, psycopg2.DatabaseError, mysql.connector.Error) as error:
+                print(f"Error closing {database} connection pool: {error}")
+        _pools.clear()
+        for conn in _listeners.values():
+            conn.close()
+        _listeners.clear()
+
 def analytics_db(action, query, values):
     """
     Perform database operations on the analytics database.
@@ -22,38 +194,26 @@ def analytics_db(action, query, values):
         - For UPDATE, ADD, and DELETE, returns "Records updated".
         - For GET, returns the fetched records as a list of tuples.
     """
-    conn = None
     response = None
     if action in ('UPDATE', 'GET', 'ADD', 'DELETE'):
         try:
-            params = {
-                'dbname': os.getenv('ANALYTICS_NAME'),
-                'user': os.getenv('ANALYTICS_USER'),
-                'password': os.getenv('ANALYTICS_PASSWORD'),
-                'host': os.getenv('ANALYTICS_HOST'),
-                'port': os.getenv('ANALYTICS_PORT'),
-
-            }
-            conn = psycopg2.connect(**params)
-            cur = conn.cursor()
+            with connection('analytics') as conn:
+                cur = conn.cursor()
 
-            if values is None:
-                cur.execute(query)
-                conn.commit()
-                response = True
-            else:
-                cur.execute(query, values)
-                conn.commit()
-                response = True
+                if values is None:
+                    cur.execute(query)
+                    conn.commit()
+                    response = True
+                else:
+                    cur.execute(query, values)
+                    conn.commit()
+                    response = True
 
-            if action == 'GET':
-                response = cur.fetchall()
-            cur.close()
+                if action == 'GET':
+                    response = cur.fetchall()
+                cur.close()
         except (Exception, psycopg2.DatabaseError) as error:
             print(f"Error in analytics DB connection: {error}")
-        finally:
-            if conn is not None:
-                conn.close()
     else:
         print("No such database action")
     return response
@@ -69,26 +229,15 @@ def payments_db(query, values):
     Returns:
         The fetched records as a list of tuples.
     """
-    conn = None
     response = None
     try:
-        params = {
-            'dbname': os.getenv('PAYMENTS_NAME'),
-            'user': os.getenv('PAYMENTS_USER'),
-            'password': os.getenv('PAYMENTS_PASSWORD'),
-            'host': os.getenv('PAYMENTS_HOST'),
-            'port': os.getenv('PAYMENTS_PORT'),
-        }
-        conn = psycopg2.connect(**params, cursor_factory=psycopg2.extras.DictCursor)
-        cur = conn.cursor()
-        cur.execute(query, values)
-        conn.commit()
-        response = cur.fetchall()
+        with connection('payments') as conn:
+            cur = conn.cursor()
+            cur.execute(query, values)
+            conn.commit()
+            response = cur.fetchall()
     except (Exception, psycopg2.DatabaseError) as error:
         print(f"Error in CLOUD database connection: {error}")
-    finally:
-        if conn is not None:
-            conn.close()
     return response
 
 def cloud_db(query, values):
@@ -102,27 +251,16 @@ def cloud_db(query, values):
     Returns:
         The fetched records as a list of tuples.
     """
-    conn = None
     response = None
 
     try:
-        params = {
-            'dbname': os.getenv('CLOUD_NAME'),
-            'user': os.getenv('CLOUD_USER'),
-            'password': os.getenv('CLOUD_PASSWORD'),
-            'host': os.getenv('CLOUD_HOST'),
-            'port': os.getenv('CLOUD_PORT'),
-        }
-        conn = psycopg2.connect(**params, cursor_factory=psycopg2.extras.DictCursor)
-        cur = conn.cursor()
-        cur.execute(query, values)
-        conn.commit()
-        response = cur.fetchall()
+        with connection('cloud') as conn:
+            cur = conn.cursor()
+            cur.execute(query, values)
+            conn.commit()
+            response = cur.fetchall()
     except (Exception, psycopg2.DatabaseError) as error:
         print(f"Error in CLOUD database connection: {error}")
-    finally:
-        if conn is not None:
-            conn.close()
     return response
 
 def legacy_db(query, values):
@@ -136,25 +274,322 @@ def legacy_db(query, values):
     Returns:
         The fetched records as a list of tuples.
     """
-    conn = None
     response = None
     try:
-        params = {
-            'database': os.getenv('LEGACY_NAME'),
-            'user': os.getenv('LEGACY_USER'),
-            'password': os.getenv('LEGACY_PASSWORD'),
-            'host': os.getenv('LEGACY_HOST'),
-            'port': os.getenv('LEGACY_PORT'),
-        }
-        conn = mysql.connector.connect(**params)
-        cur = conn.cursor()
-        cur.execute(query, values)
-        response = cur.fetchall()
+        with connection('legacy') as conn:
+            cur = conn.cursor()
+            cur.execute(query, values)
+            response = cur.fetchall()
+            conn.commit()
 
     except (mysql.connector.Error) as error:
         print(f"Error in LEGACY connection: {error}")
-    finally:
-        if conn is not None:
+    return response
+
+def pg_array(keys):
+    """
+    Render keys as an untyped Postgres array literal, e.g. '{"a","b"}'.
+
+    The literal is bound as a single parameter and Postgres casts it to the
+    type of the column it is compared with, so `id = ANY(%s)` works for
+    integer and text columns alike.
+
+    Args:
+        keys (list): The values to put in the array.
+
+    Returns:
+        str: The array literal.
+    """
+    items = []
+    for key in keys:
+        text = str(key).replace('\\', '\\\\').replace('"', '\\"')
+        items.append(f'"{text}"')
+    return '{' + ','.join(items) + '}'
+
+def lookup(database, query, keys, values=(), chunk_size=None):
+    """
+    Run a query for a large set of keys, bound as an array parameter.
+
+    The query's first placeholder receives the keys, and is typically used
+    as `column = ANY(%s)`. Keys are de-duplicated and sent in chunks of
+    LOOKUP_CHUNK_SIZE, so the SQL text no longer grows with the number of keys.
+    A chunk that could not be read is raised, not returned as an empty result.
+
+    Args:
+        database (str): One of 'analytics', 'cloud' or 'payments'.
+        query (str): The SQL query to execute.
+        keys (list): The keys to look up.
+        values (tuple): Values for any placeholders after the keys.
+        chunk_size (int): Keys per query, defaults to LOOKUP_CHUNK_SIZE.
+
+    Returns:
+        list: The fetched records of every chunk as a list of tuples.
+    """
+    chunk_size = chunk_size or LOOKUP_CHUNK_SIZE
+    keys = list(dict.fromkeys(key for key in keys if key is not None))
+    results = []
+    for i in range(0, len(keys), chunk_size):
+        params = (pg_array(keys[i:i + chunk_size]), *values)
+        if database == 'analytics':
+            rows = analytics_db("GET", query, params)
+        elif database == 'cloud':
+            rows = cloud_db(query, params)
+        elif database == 'payments':
+            rows = payments_db(query, params)
+        else:
+            print("No such database for lookup")
+            rows = None
+        if rows is None:
+            raise Exception(f"Lookup on the {database} DB failed")
+        results.extend(rows)
+    return results
+
+def parallel(*calls):
+    """
+    Run independent queries concurrently, each on its own pooled connection.
+
+    Args:
+        *calls: Callables taking no arguments, e.g. a lambda around cloud_db or lookup.
+
+    Returns:
+        list: The result of every call, in the order the calls were given.
+            An exception raised by a call is raised here once all calls finished.
+    """
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = [executor.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+def stream_query(database, query, values, chunk_size=None):
+    """
+    Run a read query and yield its rows in chunks instead of all at once.
+
+    Postgres databases use a named (server-side) cursor; the legacy MySQL
+    database uses an unbuffered cursor. The chunks are spooled to a temporary
+    file as fast as the database sends them, so the pooled connection and its
+    transaction are released once the query is read, not once the caller has
+    processed every chunk, e.g. after hours of HubSpot batches. Only one chunk
+    is held in memory. Query errors are raised before any chunk is yielded.
+
+    Args:
+        database (str): One of 'analytics', 'cloud', 'payments' or 'legacy'.
+        query (str): The SQL query to execute.
+        values (tuple): A tuple of values for the query placeholders.
+        chunk_size (int): Rows per chunk, defaults to STREAM_CHUNK_SIZE.
+
+    Yields:
+        list: The next chunk of fetched records as a list of tuples.
+    """
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    with tempfile.TemporaryFile() as spool:
+        chunks = 0
+        try:
+            with connection(database) as conn:
+                if database == 'legacy':
+                    cur = conn.cursor(buffered=False)
+                else:
+                    cur = conn.cursor(name=f"{database}_stream")
+                    cur.itersize = chunk_size
+                try:
+                    cur.execute(query, values)
+                    while True:
+                        rows = cur.fetchmany(chunk_size)
+                        if len(rows) == 0:
+                            break
+                        pickle.dump([tuple(row) for row in rows], spool)
+                        chunks += 1
+                finally:
+                    if database == 'legacy':
+                        # Unread rows must be drained before the connection is reused
+                        conn.consume_results()
+                    cur.close()
+        except (Exception, psycopg2.DatabaseError, mysql.connector.Error) as error:
+            # A partial stream must not look like the end of the rows
+            print(f"Error in {database} DB stream: {error}")
+            raise
+        spool.seek(0)
+        for _ in range(chunks):
+            yield pickle.load(spool)
+
+def _conflict_clause(columns, conflict):
+    """
+    Build the ON CONFLICT clause for a bulk write.
+
+    Args:
+        columns (list): Columns being written.
+        conflict (list): Conflict target columns, or None to skip conflicting rows.
+
+    Returns:
+        sql.Composed: The ON CONFLICT clause.
+    """
+    if conflict is None:
+        return sql.SQL("ON CONFLICT DO NOTHING")
+    updates = [column for column in columns if column not in conflict]
+    if len(updates) == 0:
+        return sql.SQL("ON CONFLICT ({}) DO NOTHING").format(
+            sql.SQL(', ').join(map(sql.Identifier, conflict)))
+    return sql.SQL("ON CONFLICT ({}) DO UPDATE SET {}").format(
+        sql.SQL(', ').join(map(sql.Identifier, conflict)),
+        sql.SQL(', ').join(sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column))
+                           for column in updates))
+
+def _insert_values(cur, table, columns, rows, conflict, page_size):
+    """
+    Write rows with multi-row INSERT statements.
+    """
+    query = sql.SQL("INSERT INTO {} ({}) VALUES %s {}").format(
+        sql.Identifier(table),
+        sql.SQL(', ').join(map(sql.Identifier, columns)),
+        _conflict_clause(columns, conflict))
+    psycopg2.extras.execute_values(cur, query.as_string(cur), rows, page_size=page_size)
+
+def _copy_upsert(cur, table, columns, rows, conflict):
+    """
+    Write rows by COPYing them into a temporary staging table and
+    upserting from there in a single statement.
+    """
+    stage = f"{table}_stage"
+    column_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+    cur.execute(sql.SQL(
+        "CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP").format(
+            sql.Identifier(stage), sql.Identifier(table)))
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['\\N' if value is None else value for value in row])
+    buffer.seek(0)
+    cur.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')").format(
+        sql.Identifier(stage), column_list).as_string(cur), buffer)
+
+    cur.execute(sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} {}").format(
+        sql.Identifier(table), column_list, column_list, sql.Identifier(stage),
+        _conflict_clause(columns, conflict)))
+
+def transaction(database, statements):
+    """
+    Run several statements on a Postgres database in a single transaction.
+
+    Args:
+        database (str): One of 'analytics', 'cloud' or 'payments'.
+        statements (list): Tuples (query, values), run in order.
+
+    Returns:
+        bool: True if every statement was committed, None otherwise.
+    """
+    response = None
+    try:
+        with connection(database) as conn:
+            cur = conn.cursor()
+            for query, values in statements:
+                cur.execute(query, values)
             conn.commit()
-            conn.close()
-    return response
\ No newline at end of file
+            cur.close()
+            response = True
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f"Error in {database} DB transaction: {error}")
+    return response
+
+def analytics_transaction(statements):
+    """
+    Run several statements on the analytics database in a single transaction.
+
+    Args:
+        statements (list): Tuples (query, values), run in order.
+
+    Returns:
+        bool: True if every statement was committed, None otherwise.
+    """
+    return transaction('analytics', statements)
+
+def wait_for_notify(database, channel, timeout):
+    """
+    Wait until a NOTIFY arrives on a channel, or `timeout` seconds have passed.
+
+    The listening connection is kept open between calls, outside the pool,
+    so notifications sent in between are picked up by the next call.
+
+    Args:
+        database (str): One of 'analytics', 'cloud' or 'payments'.
+        channel (str): The channel to LISTEN on.
+        timeout (float): Seconds to wait at most.
+
+    Returns:
+        bool: True if at least one notification arrived, False otherwise.
+    """
+    with _pools_lock:
+        conn = _listeners.get((database, channel))
+    if conn is None or conn.closed:
+        # Connect without the lock, other threads keep using the pools meanwhile
+        try:
+            conn = psycopg2.connect(**_connection_params(database))
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+            cur.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f"Error listening on {database} channel {channel}: {error}")
+            if conn is not None:
+                conn.close()
+            return False
+        with _pools_lock:
+            registered = _listeners.get((database, channel))
+            if registered is not None and not registered.closed:
+                # Another thread connected first, keep its connection
+                conn.close()
+                conn = registered
+            else:
+                _listeners[(database, channel)] = conn
+    try:
+        conn.poll()
+        if len(conn.notifies) == 0 and len(select.select([conn], [], [], timeout)[0]) > 0:
+            conn.poll()
+        notified = len(conn.notifies) > 0
+        conn.notifies.clear()
+        return notified
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f"Error listening on {database} channel {channel}: {error}")
+        conn.close()
+        return False
+
+def analytics_bulk_write(table, columns, rows, conflict=None, page_size=1000, statements=None):
+    """
+    Write many rows to an analytics table in a single transaction.
+
+    Small batches use multi-row INSERTs (execute_values); batches of
+    COPY_THRESHOLD rows or more are streamed in with COPY.
+
+    Args:
+        table (str): The table to write to.
+        columns (list): Column names, in the order of each row's values.
+        rows (list): A list of tuples to write.
+        conflict (list): Conflict target columns. Rows clashing on these columns
+            update the remaining columns. With None, clashing rows are skipped.
+        page_size (int): Rows per INSERT statement.
+        statements (list): Tuples (query, values) committed together with the
+            rows, e.g. to advance a sync checkpoint.
+
+    Returns:
+        bool: True if the rows were written, None otherwise.
+    """
+    response = None
+    if conflict is not None:
+        # A row may only be upserted once per statement, keep the last one
+        positions = [columns.index(column) for column in conflict]
+        rows = list({tuple(row[p] for p in positions): row for row in rows}.values())
+    if len(rows) == 0:
+        return True
+    try:
+        with connection('analytics') as conn:
+            cur = conn.cursor()
+            if len(rows) >= COPY_THRESHOLD:
+                _copy_upsert(cur, table, columns, rows, conflict)
+            else:
+                _insert_values(cur, table, columns, rows, conflict, page_size)
+            for query, values in statements or []:
+                cur.execute(query, values)
+            conn.commit()
+            cur.close()
+            response = True
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(f"Error in analytics DB bulk write ({table}): {error}")
+    return response
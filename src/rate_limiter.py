@@ -0,0 +1,67 @@
+""" This module contains the rate limiter shared by all HubSpot API calls """
+import time
+import threading
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Tokens refill continuously at `limit` per `interval` seconds, and at most
+    `burst` tokens can be saved up. Every API request takes one token.
+    The bucket can also be paused for everyone, e.g. after a 429 response or
+    when the server reports that fewer than `headroom` requests are left.
+    """
+
+    def __init__(self, limit, interval, burst, headroom=0):
+        self.rate = limit / interval
+        self.capacity = burst
+        self.tokens = burst
+        self.headroom = headroom
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        # Seconds callers spent waiting in acquire, summed over all threads
+        self.throttled = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Take one token, waiting until one is available.
+        """
+        started = time.monotonic()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    self._refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.throttled += now - started
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Stop handing out tokens to every caller for the given number of seconds.
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def observe(self, remaining, interval):
+        """
+        Slow down as the server-reported budget for the current interval runs out.
+
+        Args:
+            remaining (int): Requests left in the current rate-limit interval.
+            interval (float): Length of the rate-limit interval in seconds.
+        """
+        if remaining < self.headroom:
+            self.pause(interval * (1 - remaining / self.headroom))
@@ -0,0 +1,125 @@
+""" This module contains the scheduler running the main.py workflows """
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def _timed(name, function):
+    started = time.monotonic()
+    try:
+        function()
+        status = 'ok'
+    except Exception as e:
+        print(f"An error occurred in workflow {name}: {e}")
+        status = 'failed'
+    return (status, time.monotonic() - started)
+
+def run_workflows(workflows, max_workers=4):
+    """
+    Run every workflow as soon as the workflows it depends on have succeeded.
+
+    Workflows without a dependency between them run concurrently. A workflow
+    that raises is reported as failed and the workflows depending on it,
+    directly or not, are skipped; the others carry on.
+
+    Args:
+        workflows (list): Tuples (name, function, dependencies), where function
+            takes no arguments and dependencies lists workflow names.
+        max_workers (int): Workflows allowed to run at the same time.
+
+    Returns:
+        dict: (status, seconds) keyed by workflow name, where status is one of
+            'ok', 'failed' or 'skipped'.
+    """
+    pending = {name: (function, set(dependencies))
+               for name, function, dependencies in workflows}
+    for name, (_, dependencies) in pending.items():
+        unknown = dependencies - set(pending)
+        if len(unknown) > 0:
+            raise ValueError(f"Workflow {name} depends on unknown workflows: {sorted(unknown)}")
+    results = {}
+    running = {}
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            changed = True
+            while changed:
+                changed = False
+                for name in list(pending):
+                    function, dependencies = pending[name]
+                    states = [results.get(dependency, (None,))[0] for dependency in dependencies]
+                    if 'failed' in states or 'skipped' in states:
+                        print(f"Skipping workflow {name}, a dependency did not complete")
+                        results[name] = ('skipped', 0.0)
+                    elif all(state == 'ok' for state in states):
+                        running[executor.submit(_timed, name, function)] = name
+                    else:
+                        continue
+                    del pending[name]
+                    changed = True
+            if len(running) == 0:
+                # Whatever is left waits on itself
+                for name in pending:
+                    print(f"Skipping workflow {name}, its dependencies form a cycle")
+                    results[name] = ('skipped', 0.0)
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    for name, (status, seconds) in results.items():
+        print(f"Workflow {name}: {status} in {seconds:.1f}s")
+    print(f"Workflows completed in {time.monotonic() - started:.1f}s")
+    return results
+
+def run_forever(workflows, intervals, stop, max_workers=4, tick=1.0):
+    """
+    Run every workflow repeatedly on its own interval until `stop` is set.
+
+    A workflow is started when its interval has elapsed since its last start.
+    It waits while it is still running, while one of its dependencies is
+    running, and until each dependency that runs at all has completed once.
+    Dependents are started before their dependencies within a tick, so a
+    dependency on a short interval cannot starve them. Once `stop` is set no
+    new workflow starts and the running ones are waited for.
+
+    Args:
+        workflows (list): Tuples (name, function, dependencies), as for run_workflows.
+        intervals (dict): Seconds between two starts keyed by workflow name;
+            workflows with no interval, or an interval of 0, never run.
+        stop (threading.Event): Set to shut down.
+        max_workers (int): Workflows allowed to run at the same time.
+        tick (float): Seconds between two checks for due workflows.
+
+    Returns:
+        dict: Number of runs keyed by workflow name and status.
+    """
+    next_run = {name: time.monotonic() for name, _, _ in workflows}
+    running = {}
+    completed = set()
+    runs = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            for name, future in list(running.items()):
+                if future.done():
+                    status, seconds = future.result()
+                    print(f"Workflow {name}: {status} in {seconds:.1f}s")
+                    runs[(name, status)] = runs.get((name, status), 0) + 1
+                    completed.add(name)
+                    del running[name]
+            if stop.is_set():
+                if len(running) == 0:
+                    break
+                wait(list(running.values()), return_when=FIRST_COMPLETED)
+                continue
+            now = time.monotonic()
+            for name, function, dependencies in reversed(workflows):
+                interval = intervals.get(name) or 0
+                if interval <= 0 or name in running or now < next_run[name]:
+                    continue
+                if any(dependency in running or ((intervals.get(dependency) or 0) > 0
+                                                 and dependency not in completed)
+                       for dependency in dependencies):
+                    continue
+                running[name] = executor.submit(_timed, name, function)
+                next_run[name] = now + interval
+            stop.wait(tick)
+    return runs
@@ -1,12 +1,16 @@
 """ This module contains all API funtions to Hubspot """
 import os
-import time
 import re
+import time
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import stripe
 from dotenv import load_dotenv, find_dotenv
 from ratelimit import limits, sleep_and_retry
 import database as db # Import your database functions module
 import hubspot_api as hubspot # Import your HubSpot functions module
+import pipeline # Import the staged pipeline runner
 
 # Load environment variable from a .env file
 load_dotenv(find_dotenv())
@@ -14,31 +18,236 @@ api_key = os.getenv('STRIPE_KEY')
 
 stripe.api_key = api_key
 stripe.max_network_retries = 2
-REQUEST_DELAY = 0.01  # Specify the delay between API requests in seconds 
+# Point the client at another Stripe host, e.g. the local fake in fake_stripe.py
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE')
+if STRIPE_API_BASE:
+    stripe.api_base = STRIPE_API_BASE
+SUBSCRIPTION_BATCH_SIZE = 500  # Subscriptions written to the database per batch
+STRIPE_WORKERS = int(os.getenv('STRIPE_WORKERS', '4'))  # Concurrent customer prefetches
+# Customer sets up to this size are looked up one by one instead of paging all subscriptions
+STRIPE_CUSTOMER_LOOKUP_MAX = int(os.getenv('STRIPE_CUSTOMER_LOOKUP_MAX', '20'))
+# Seconds before the oldest new workspace from which subscriptions are paged
+STRIPE_INDEX_MARGIN = int(os.getenv('STRIPE_INDEX_MARGIN', '86400'))
+# Batches allowed to wait between two stages of the full sync pipeline
+PIPELINE_DEPTH = int(os.getenv('STRIPE_PIPELINE_DEPTH', '2'))
+# Seconds a cached customer is used before it is retrieved from Stripe again
+CUSTOMER_CACHE_TTL = int(os.getenv('STRIPE_CUSTOMER_CACHE_TTL', '604800'))
+# Customers kept in the cache, the least recently used ones are evicted
+CUSTOMER_CACHE_SIZE = int(os.getenv('STRIPE_CUSTOMER_CACHE_SIZE', '200000'))
+BACKFILL_CHECKPOINT = 'stripe_backfill'  # Name of the backfill checkpoint in sync_cursors
+EVENTS_CURSOR = 'stripe_events'  # Name of the Stripe events cursor in the sync_cursors table
+EVENTS_RETENTION = 30 * 86400  # Stripe only lists events from the last 30 days
+# Customer cache hits and misses over the run, shared by all threads
+customer_cache_stats = {"hits": 0, "misses": 0}
+customer_cache_lock = threading.Lock()
 
 # Define the rate limit: 50 requests per minute (adjust this based on Stripe's rate limits)
 @sleep_and_retry
 @limits(calls=30, period=60)  # 50 requests per 60 seconds
 
-def get_all_subscriptions():
+def get_all_subscriptions(resume=False):
     """
     Retrieve all active and trialing subscriptions from the Stripe API.
 
+    Each batch is checkpointed in the analytics DB once its workspaces are
+    created and associated, so a failed backfill can be resumed.
+
+    Args:
+        resume (bool): Continue after the last checkpointed batch instead of
+            starting from the first Stripe page, skipping customers whose
+            workspace is already stored.
+
     Returns:
         list: List of tuples containing subscription information.
             Each tuple format: (id, created, customer, ended_at, plan_id, 
             interval, quantity, status, trial_start, trial_end, current_period_end, email)
     """
     print("START: Get all active and trialing subscriptions from Stripe API")
+    checkpoint = db.get_sync_checkpoint(BACKFILL_CHECKPOINT)
+    if resume and checkpoint is not None:
+        print(f"Resuming backfill after batch {checkpoint[0]} (subscription {checkpoint[1]})")
+        first_batch, starting_after = checkpoint
+    else:
+        first_batch, starting_after = 0, None
+    progress = {"next": first_batch + 1, "produced": first_batch,
+                "exhausted": False, "broken": False}
+
+    def batches():
+        for batch in subscription_batches(first_batch, starting_after):
+            progress["produced"] = batch[0][0]
+            yield batch
+        progress["exhausted"] = True
+
+    def save_checkpoint(item):
+        number, last_subscription = item[0]
+        if number != progress["next"]:
+            # An earlier batch failed, keep the checkpoint before it so a resume retries it
+            progress["broken"] = True
+        if progress["broken"]:
+            return None
+        # Later batches go on after a failed one, so the created mark only
+        # moves past consecutive batches, like the backfill cursor
+        db.advance_checkpoint('workspaces', 'cloud', 'created',
+                              [workspace[2] for workspace in item[1]])
+        db.set_sync_cursor(BACKFILL_CHECKPOINT, number, last_subscription)
+        progress["next"] = number + 1
+        return True
+
+    stages = [('customers', subscription_rows)]
+    if resume:
+        stages.append(('stored', skip_stored_workspaces))
+    stages.extend([
+        ('workspaces', workspace_records),
+        ('create', create_workspace_records),
+        ('associate', associate_workspace_records),
+    ])
+    # Stripe paging, DB enrichment, HubSpot creation and association overlap
+    pipeline.run_pipeline(batches(), [(name, _with_batch(function)) for name, function in stages]
+                          + [('checkpoint', save_checkpoint)], maxsize=PIPELINE_DEPTH)
+    if not progress["exhausted"] or progress["next"] <= progress["produced"]:
+        print(f"Backfill stopped after batch {progress['next'] - 1}, run -- "
+              "`python main.py create_all_workspaces --resume` -- TO CONTINUE")
+        return False
+    db.clear_sync_cursor(BACKFILL_CHECKPOINT)
+    print("Success: All active and trialing subscriptions retrieved")
+    return True
+
+def _with_batch(function):
+    """
+    Turn a stage function into a pipeline stage for (batch, payload) items,
+    so the batch number and Stripe cursor travel along with the data.
+    """
+    def stage(item):
+        batch, payload = item
+        result = function(payload)
+        if result is None:
+            return None
+        return (batch, result)
+    return stage
+
+def subscription_batches(first_batch=0, starting_after=None):
+    """
+    Page through all trialing subscriptions, with their customers inlined.
+
+    Args:
+        first_batch (int): Number of the batch `starting_after` belongs to.
+        starting_after (str): Subscription ID to continue the listing after.
+
+    Yields:
+        tuple: ((batch number, last subscription ID), subscriptions), with up to
+            SUBSCRIPTION_BATCH_SIZE Stripe subscription objects per batch.
+    """
     page_size = 100  # Specify the desired page size
-    # Retrieve all subscriptions from the Stripe API
-    i = 0
-    n = 0
+    params = {'status': 'trialing', 'limit': page_size, 'expand': ['data.customer']}
+    if starting_after is not None:
+        params['starting_after'] = starting_after
+    n = first_batch
+    subscriptions = []
+    for subscription in stripe.Subscription.auto_paging_iter(**params):
+        subscriptions.append(subscription)
+        if len(subscriptions) == SUBSCRIPTION_BATCH_SIZE:
+            n=n+1
+            print(f"Batch: {n}")
+            yield ((n, subscriptions[-1].id), subscriptions)
+            subscriptions = []
+    if len(subscriptions) > 0:
+        n=n+1
+        print(f"Batch: {n}")
+        yield ((n, subscriptions[-1].id), subscriptions)
+
+def prefetch_customers(customer_ids, expanded=None):
+    """
+    Retrieve customers concurrently, for subscriptions listed without their customer expanded.
+
+    Customers cached in the analytics DB for less than STRIPE_CUSTOMER_CACHE_TTL
+    seconds are served from there. Of the rest, the ones Stripe already
+    expanded are taken as they are and only the others are retrieved; both
+    are then cached.
+
+    Args:
+        customer_ids (list): Stripe customer IDs, duplicates are fetched once.
+        expanded (dict): Customer objects already expanded by Stripe, keyed by ID.
+
+    Returns:
+        dict: Stripe customer objects keyed by customer ID. Customers that
+            could not be retrieved are left out.
+    """
+    customers = {}
+    expanded = expanded or {}
+    unique_ids = list(dict.fromkeys([*customer_ids, *expanded]))
+    if len(unique_ids) == 0:
+        return customers
+    try:
+        for customer_id, email in db.get_cached_customers(unique_ids, CUSTOMER_CACHE_TTL):
+            customers[customer_id] = stripe.Customer.construct_from(
+                {"id": customer_id, "email": email}, api_key)
+    except Exception as e:
+        print(f"An error occurred reading the customer cache: {e}")
+    missing_ids = [customer_id for customer_id in unique_ids if customer_id not in customers]
+    with customer_cache_lock:
+        customer_cache_stats["hits"] += len(customers)
+        customer_cache_stats["misses"] += len(missing_ids)
+    if len(missing_ids) == 0:
+        return customers
+    fetched = {customer_id: expanded[customer_id] for customer_id in missing_ids
+               if customer_id in expanded}
+    missing_ids = [customer_id for customer_id in missing_ids if customer_id not in fetched]
+    def retrieve(customer_id):
+        try:
+            return stripe.Customer.retrieve(customer_id)
+        except Exception as e:
+            print(f"An error occurred retrieving customer {customer_id}: {e}")
+            return None
+    with ThreadPoolExecutor(max_workers=STRIPE_WORKERS) as executor:
+        for customer_id, customer in zip(missing_ids, executor.map(retrieve, missing_ids)):
+            if customer is not None:
+                fetched[customer_id] = customer
+    try:
+        db.cache_customers([(customer_id, customer.email) for customer_id, customer
+                            in fetched.items()], CUSTOMER_CACHE_SIZE)
+    except Exception as e:
+        print(f"An error occurred writing the customer cache: {e}")
+    customers.update(fetched)
+    return customers
+
+def split_customers(subscriptions):
+    """
+    Split the customers of subscriptions into bare IDs and expanded objects.
+
+    Returns:
+        tuple: (customer IDs, expanded customer objects keyed by ID), the
+            arguments of prefetch_customers.
+    """
+    ids = []
+    expanded = {}
+    for subscription in subscriptions:
+        if isinstance(subscription.customer, str):
+            ids.append(subscription.customer)
+        else:
+            expanded[subscription.customer.id] = subscription.customer
+    return (ids, expanded)
+
+def subscription_rows(subscriptions):
+    """
+    Build the subscription tuples and customer list for a batch of subscriptions.
+
+    Customers are read from the customer cache first, then from the expanded
+    `customer` field; the ones Stripe returned as bare IDs are prefetched in
+    one concurrent batch.
+
+    Args:
+        subscriptions (list): Stripe subscription objects.
+
+    Returns:
+        list: [subscription tuples, customer IDs], as expected by workspace_records.
+    """
+    customers = prefetch_customers(*split_customers(subscriptions))
     active_subscriptions = []
     customer_list = []
-    for subscription in stripe.Subscription.auto_paging_iter(status='trialing', limit=page_size):
-        i=i+1
-        customer = stripe.Customer.retrieve(subscription.customer)
+    for subscription in subscriptions:
+        customer = subscription.customer
+        customer_id = customer if isinstance(customer, str) else customer.id
+        customer = customers.get(customer_id)
         cancel_at_period_end = subscription.cancel_at_period_end
         if cancel_at_period_end is True:
             auto_renew =  False
@@ -55,37 +264,147 @@ def get_all_subscriptions():
             priority = 'yes'
         else:
             priority = 'no'
-        subscription_tuple = (subscription.id, subscription.created, subscription.customer,
+        subscription_tuple = (subscription.id, subscription.created, customer_id,
             subscription.ended_at,subscription.plan.id, subscription.plan.interval,
             subscription.quantity,subscription.status,subscription.trial_start, 
-            subscription.trial_end,subscription.current_period_end, customer.email,
+            subscription.trial_end,subscription.current_period_end,
+            customer.email if customer is not None else None,
             priority,subscription.collection_method,auto_renew)
         active_subscriptions.append(subscription_tuple)
-        customer_list.append(subscription.customer)
-        if i == 500:
-            n=n+1
-            print(f"Batch: {n}")
-            add_to_database([active_subscriptions, customer_list])
-            i=0
-            active_subscriptions = []
-            customer_list = [] 
-    print("Success: All active and trialing subscriptions retrieved")
-    return True
+        customer_list.append(customer_id)
+    return [active_subscriptions, customer_list]
 
-def add_to_database(all_subscriptions):
+def workspace_records(all_subscriptions):
+    """
+    Join a batch of subscriptions with their workspaces in the database.
+
+    Args:
+        all_subscriptions (list): [subscription tuples, customer IDs] from subscription_rows.
+
+    Returns:
+        list: Workspace tuples as expected by hubspot_api.create_workspaces.
+    """
+    if len(all_subscriptions[1]) == 0:
+        return []
     all_workspaces = db.get_workspaces(all_subscriptions[0], all_subscriptions[1])
+    if len(all_workspaces) == 0:
+        return []
     # Convert the DataFrame to a NumPy array of records
     workspaces_records = all_workspaces.to_records(index=False)
 
     # Convert the NumPy array of records to a list of tuples
-    final_workspaces_list = list(workspaces_records)
-    # Print the final_workspaces_list
+    return list(workspaces_records)
+
+def create_workspace_records(final_workspaces_list):
+    """
+    Create a batch of workspaces in HubSpot and store their HubSpot IDs.
+
+    Args:
+        final_workspaces_list (list): Workspace tuples from workspace_records.
+
+    Returns:
+        tuple: (HubSpot IDs of the created workspaces, workspaces with their
+            contact HubSpot IDs for workspaces_associate). Workspaces that
+            were not created or stored are raised.
+    """
+    if len(final_workspaces_list) == 0:
+        return ([], [])
     workspaces_hubspotids = hubspot.create_workspaces(final_workspaces_list)
     workspaces_complete = db.add_contact_hubspot_id(workspaces_hubspotids)
-    db.insert_workspace_ids(workspaces_hubspotids)
-    hubspot.workspaces_associate(workspaces_complete)
+    if not db.insert_workspace_ids(workspaces_hubspotids):
+        raise Exception(f"HubSpot IDs of {len(workspaces_hubspotids)} workspaces were not stored")
+    # Drop the batch so the checkpoint stays before it and a resume retries it
+    if len(workspaces_hubspotids) < len(final_workspaces_list):
+        raise Exception(f"{len(final_workspaces_list) - len(workspaces_hubspotids)} workspaces "
+                        "were not created in HubSpot")
+    return (workspaces_hubspotids, workspaces_complete)
+
+def associate_workspace_records(created):
+    """
+    Associate a batch of created workspaces with their contacts in HubSpot.
+
+    Args:
+        created (tuple): HubSpot IDs and workspaces from create_workspace_records.
+
+    Returns:
+        list: HubSpot IDs of the batch's workspaces once the associations were sent.
+    """
+    workspaces_hubspotids, workspaces_complete = created
+    if len(workspaces_complete) > 0:
+        hubspot.workspaces_associate(workspaces_complete)
+    return workspaces_hubspotids
+
+def skip_stored_workspaces(all_subscriptions):
+    """
+    Drop the subscriptions of customers whose workspace is already stored,
+    so resuming a backfill does not create their workspaces twice.
+
+    Args:
+        all_subscriptions (list): [subscription tuples, customer IDs] from subscription_rows.
+
+    Returns:
+        list: The same structure, without already stored customers.
+    """
+    stored = {customer for customer, _ in db.get_workspace_hubspot_ids(all_subscriptions[1])}
+    if len(stored) > 0:
+        print(f"Skipping {len(stored)} customers with stored workspaces")
+    return [[row for row in all_subscriptions[0] if row[2] not in stored],
+            [customer for customer in all_subscriptions[1] if customer not in stored]]
+
+def add_to_database(all_subscriptions):
+    final_workspaces_list = workspace_records(all_subscriptions)
+    workspaces_hubspotids = associate_workspace_records(
+        create_workspace_records(final_workspaces_list))
+    db.advance_checkpoint('workspaces', 'cloud', 'created',
+                          [workspace[2] for workspace in workspaces_hubspotids])
     return True
 
+def subscription_index(customer_ids, created_after=None):
+    """
+    Map Stripe customers to their most recent non-canceled subscription.
+
+    Customer sets of up to STRIPE_CUSTOMER_LOOKUP_MAX are listed customer by
+    customer. Larger sets are served by paging once through every subscription
+    created since `created_after`, so the number of requests depends on the
+    page count rather than on the number of customers. Customers whose
+    subscription predates the window are then listed one by one.
+
+    Args:
+        customer_ids (list): Stripe customer IDs to index.
+        created_after (int): Unix timestamp of the oldest subscription to page through.
+
+    Returns:
+        dict: Stripe subscription objects, with the customer expanded, keyed by customer ID.
+    """
+    customer_ids = set(customer_ids)
+    index = {}
+    def lookup(customer_ids):
+        for customer_id in customer_ids:
+            subscriptions = stripe.Subscription.list(customer=customer_id, limit=1,
+                                                     expand=['data.customer'])
+            if len(subscriptions["data"]) > 0:
+                index[customer_id] = subscriptions["data"][0]
+    if len(customer_ids) <= STRIPE_CUSTOMER_LOOKUP_MAX:
+        lookup(customer_ids)
+        return index
+    params = {'limit': 100, 'expand': ['data.customer']}
+    if created_after is not None:
+        params['created'] = {'gte': created_after}
+    scanned = 0
+    # Subscriptions are listed newest first, keep the first one seen per customer
+    for subscription in stripe.Subscription.auto_paging_iter(**params):
+        scanned += 1
+        customer = subscription.customer
+        customer_id = customer if isinstance(customer, str) else customer.id
+        if customer_id in customer_ids and customer_id not in index:
+            index[customer_id] = subscription
+    print(f"Subscription index: {len(index)} of {len(customer_ids)} customers "
+          f"matched in {scanned} subscriptions")
+    if created_after is not None:
+        # The window follows the workspace dates, older subscriptions are not in it
+        lookup([customer_id for customer_id in customer_ids if customer_id not in index])
+    return index
+
 def get_subscriptions(workspaces):
     """
     Retrieve subscriptions from Stripe for the given workspaces.
@@ -96,24 +415,35 @@ def get_subscriptions(workspaces):
                      domain, timestamp).
 
     Returns:
-        list: A list of subscription data retrieved from Stripe.
+        list: A list of subscription data retrieved from Stripe. Workspaces
+            without a subscription or whose customer could not be retrieved
+            are left out and logged.
     """
     print("START: retrieving workspaces from Stripe")
     stripe.api_key = api_key
     data = []
     missing = []
+    created_after = None
+    try:
+        created_after = int(min(workspace[3] for workspace in workspaces).timestamp()
+                            - STRIPE_INDEX_MARGIN)
+    except Exception as e:
+        print(f"Paging all subscriptions, no workspace creation window: {e}")
+    index = subscription_index([workspace[5] for workspace in workspaces], created_after)
+    customers = prefetch_customers(*split_customers(index.values()))
     for workspace in workspaces:
         try:
-            customer = stripe.Customer.retrieve(workspace[5])
-            subscription = stripe.Subscription.list(customer=workspace[5])
-            time.sleep(REQUEST_DELAY)
-
-            if len(subscription["data"]) > 0:
-                subscription = subscription["data"][0]
+            subscription = index.get(workspace[5])
+            if subscription is not None:
+                customer = subscription.customer
+                customer = customers.get(customer if isinstance(customer, str) else customer.id)
+                if customer is None:
+                    missing.append(workspace[0])
+                    continue
                 customer_data = [customer.id, customer.email]
                 id = subscription["id"],
                 created = subscription["created"],
-                customer = subscription["customer"],
+                customer = customer.id,
                 ended_at = subscription["ended_at"],
                 plan = subscription["plan"]["nickname"],
                 interval = subscription["plan"]["interval"],
@@ -149,8 +479,76 @@ def get_subscriptions(workspaces):
                               ended_at[0], interval[0], quantity[0], trial_start[0], trial_end[0],
                               current_period_end[0], workspace[3],priority,payment_menthod[0],auto_renew])
             else:
+                missing.append(workspace[0])
                 continue
         except Exception as e:
             print(f"An error occurred: {e}")
+            missing.append(workspace[0])
             continue
-    return data
\ No newline at end of file
+    if len(missing) > 0:
+        print(f"Skipped {len(missing)} workspaces without a usable Stripe subscription: {missing}")
+    return data
+
+def workspace_properties(subscription):
+    """
+    Build the HubSpot workspace properties that follow a subscription's state.
+
+    Args:
+        subscription (dict): Stripe subscription object.
+
+    Returns:
+        dict: Workspace properties, formatted as in hubspot_api.create_workspaces.
+    """
+    properties = {
+        "team_status": subscription["status"],
+        "number_of_assigned_seats": int(subscription["quantity"] or 0),
+        "auto_renew": str(subscription["cancel_at_period_end"] is not True),
+    }
+    if subscription["current_period_end"] is not None:
+        properties["renewal_date"] = datetime.datetime.utcfromtimestamp(
+            int(subscription["current_period_end"])).strftime('%Y-%m-%d')
+    return properties
+
+def sync_subscription_events():
+    """
+    Push subscription changes to HubSpot workspaces from the Stripe Events API.
+
+    Reads the customer.subscription.* events created since the cursor stored in
+    the analytics DB, keeps the latest subscription state per customer and
+    updates the matching workspaces in batches. The cursor only moves forward
+    once HubSpot accepted every update; events from the cursor's second are
+    read again on the next run, which is harmless as updates are idempotent.
+
+    Returns:
+        bool: True if the workspaces are up to date with the events read, False otherwise.
+    """
+    print("START: Syncing subscription changes from Stripe events")
+    cursor = db.get_sync_cursor(EVENTS_CURSOR)
+    if cursor is None:
+        db.set_sync_cursor(EVENTS_CURSOR, int(time.time()))
+        print("""NO STRIPE EVENTS CURSOR: starting from now, run --
+                `python main.py create_all_workspaces` -- TO TRIGGER A FULL SYNC""")
+        return True
+    if time.time() - cursor > EVENTS_RETENTION:
+        print("Stripe events cursor is older than 30 days, some changes may be missing. "
+              "Run `python main.py create_all_workspaces` to resync")
+    newest = cursor
+    latest = {}
+    for event in stripe.Event.auto_paging_iter(type='customer.subscription.*',
+                                               created={'gte': cursor}, limit=100):
+        newest = max(newest, event.created)
+        subscription = event.data.object
+        # Events are listed newest first, so the first one seen per customer is current
+        latest.setdefault(subscription["customer"], subscription)
+    if len(latest) == 0:
+        print("No subscription changes found")
+        return True
+    hubspot_ids = db.get_workspace_hubspot_ids(list(latest))
+    updates = [(hubspot_id, workspace_properties(latest[customer]))
+               for customer, hubspot_id in hubspot_ids]
+    print(f"Subscription changes: {len(latest)} customers, {len(updates)} workspaces")
+    if len(updates) > 0 and not hubspot.update_workspaces(updates):
+        return False
+    db.set_sync_cursor(EVENTS_CURSOR, newest)
+    print("SUCCESS: Subscription changes synced to HubSpot")
+    return True
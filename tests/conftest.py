@@ -0,0 +1,5 @@
+""" Makes the modules in src importable by their bare names, as main.py imports them """
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
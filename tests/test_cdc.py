@@ -0,0 +1,98 @@
+""" Tests for the consumer of the changes captured on the cloud database """
+import pytest
+import cdc
+
+
+class ChangeLog:
+    """
+    The hubspot_changes table as database.get_changes sees it: ids are taken
+    when a change is written, rows only show up once their transaction
+    committed, and only rows older than every running transaction are read.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.running = set()
+        self.cursors = {}
+        self.cleared = []
+
+    def write(self, txid, table, op, row_id):
+        self.running.add(txid)
+        change_id = len(self.rows) + 1
+        self.rows.append((change_id, table, op, row_id, txid))
+        return change_id
+
+    def commit(self, txid):
+        self.running.discard(txid)
+
+    def get_changes(self, after, limit):
+        xmin = min(self.running, default=float('inf'))
+        visible = sorted((row for row in self.rows
+                          if row[4] not in self.running and row[4] < xmin
+                          and (row[4], row[0]) > tuple(after)),
+                         key=lambda row: (row[4], row[0]))
+        return sorted(visible[:limit])
+
+    def clear_changes(self, change_ids):
+        self.cleared.extend(change_ids)
+        self.rows = [row for row in self.rows if row[0] not in change_ids]
+        return True
+
+    def get_sync_checkpoint(self, name):
+        return self.cursors.get(name)
+
+    def set_sync_cursor(self, name, position, token=None):
+        self.cursors[name] = (position, token)
+        return True
+
+
+@pytest.fixture
+def log(monkeypatch):
+    log = ChangeLog()
+    for name in ('get_changes', 'clear_changes', 'get_sync_checkpoint', 'set_sync_cursor'):
+        monkeypatch.setattr(cdc.db, name, getattr(log, name))
+    return log
+
+
+def drain(log):
+    batches = []
+    cdc.drain(batches.append)
+    return batches
+
+
+def test_interleaved_transactions_are_applied_once_both_committed(log, monkeypatch):
+    monkeypatch.setattr(cdc, 'CHANGES_BATCH_SIZE', 1)
+    # The older transaction writes the lower id but commits last
+    log.write(100, 'Users', 'INSERT', '1')
+    log.write(101, 'Users', 'INSERT', '2')
+    log.commit(101)
+    assert drain(log) == []
+    log.commit(100)
+    assert [batch['Users']['insert'] for batch in drain(log)] == [['1'], ['2']]
+    assert log.rows == [] and log.cleared == [1, 2]
+
+
+def test_change_with_lower_id_committed_late_is_not_skipped(log):
+    # The newer transaction takes the lower id, the older one commits first
+    log.write(101, 'Organizations', 'INSERT', 'a')
+    log.write(100, 'Organizations', 'INSERT', 'b')
+    log.commit(100)
+    assert [batch['Organizations']['insert'] for batch in drain(log)] == [['b']]
+    assert [row[0] for row in log.rows] == [1]
+    log.commit(101)
+    assert [batch['Organizations']['insert'] for batch in drain(log)] == [['a']]
+    assert log.rows == [] and log.cleared == [2, 1]
+
+
+def test_failed_batch_keeps_its_changes_and_the_cursor(log):
+    log.write(100, 'OrganizationMemberships', 'DELETE', '7')
+    log.commit(100)
+
+    def fail(changes):
+        raise Exception("HubSpot is down")
+
+    with pytest.raises(Exception):
+        cdc.drain(fail)
+    assert len(log.rows) == 1 and log.cursors == {}
+    assert drain(log)[0]['OrganizationMemberships']['delete'] == ['7']
+    assert log.cursors[cdc.CHANGES_CURSOR] == (100, '1')
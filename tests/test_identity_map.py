@@ -0,0 +1,70 @@
+""" Tests for the in-process map of synced objects to their HubSpot IDs """
+from identity_map import IdentityMap
+
+
+def loader(stored, loads):
+    def load(keys):
+        loads.append(list(keys))
+        return [(key, stored[key]) for key in keys if key in stored]
+    return load
+
+
+def test_resolve_loads_only_missing_keys_and_counts_hits():
+    loads = []
+    ids = IdentityMap(loader({'a': 1, 'b': 2}, loads))
+    assert ids.resolve(['a', None, 'a']) == {'a': 1}
+    assert ids.resolve(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+    assert loads == [['a'], ['b', 'c']]
+    assert (ids.hits, ids.misses) == (1, 3)
+    assert ids.hit_ratio() == 0.25
+    # Keys without a HubSpot ID are not remembered
+    ids.resolve(['c'])
+    assert loads[-1] == ['c']
+
+
+def test_keys_compare_as_strings():
+    ids = IdentityMap(loader({}, []))
+    ids.update([(7, 70)])
+    assert ids.resolve(['7']) == {'7': 70}
+    assert ids.resolve([7]) == {7: 70}
+
+
+def test_least_recently_used_keys_are_evicted():
+    loads = []
+    ids = IdentityMap(loader({'a': 1, 'b': 2, 'c': 3}, loads), max_size=2)
+    ids.resolve(['a', 'b'])
+    ids.resolve(['a'])
+    ids.resolve(['c'])
+    assert list(ids.ids) == ['a', 'c']
+    assert ids.resolve(['b']) == {'b': 2}
+    assert loads[-1] == ['b']
+    assert len(ids.ids) == 2
+
+
+def test_update_replaces_a_mapping():
+    ids = IdentityMap(loader({}, []))
+    ids.update([('a', 1)])
+    ids.update([('a', 2)])
+    assert ids.resolve(['a']) == {'a': 2}
+    # The old HubSpot ID no longer points at the key
+    ids.forget_ids([1])
+    assert ids.resolve(['a']) == {'a': 2}
+
+
+def test_forget_and_forget_ids_drop_mappings():
+    loads = []
+    ids = IdentityMap(loader({}, loads))
+    ids.update([('a', 1), ('b', 2), ('c', 3)])
+    ids.forget(['a'])
+    ids.forget_ids(['2'])
+    assert ids.resolve(['a', 'b', 'c']) == {'c': 3}
+    assert loads == [['a', 'b']]
+    assert ids.keys == {'3': {'c'}}
+
+
+def test_forget_ids_drops_the_previous_key_of_a_reassigned_id():
+    ids = IdentityMap(loader({}, []))
+    ids.update([('old@example.com', 1)])
+    ids.forget_ids([1])
+    ids.update([('new@example.com', 1)])
+    assert list(ids.ids) == ['new@example.com']
@@ -0,0 +1,31 @@
+""" Tests for the workflow scheduler and the workflow graph it runs """
+import main
+import scheduler
+
+
+def test_failed_workflow_skips_its_dependents():
+    ran = []
+    results = scheduler.run_workflows([
+        ('first', lambda: 1 / 0, []),
+        ('second', lambda: ran.append('second'), ['first']),
+        ('third', lambda: ran.append('third'), ['second']),
+        ('other', lambda: ran.append('other'), []),
+    ])
+    assert results['first'][0] == 'failed'
+    assert results['second'][0] == 'skipped'
+    assert results['third'][0] == 'skipped'
+    assert results['other'][0] == 'ok'
+    assert ran == ['other']
+
+
+def test_failed_contacts_skips_the_workflows_needing_contacts(monkeypatch):
+    def iter_contacts(sources):
+        raise RuntimeError("cloud DB unavailable")
+        yield # pylint: disable=unreachable
+    monkeypatch.setattr(main.db, 'iter_contacts', iter_contacts)
+    monkeypatch.setattr(main, 'CDC_ENABLED', False)
+    results = scheduler.run_workflows(main.workflow_graph())
+    assert results['contacts'][0] == 'failed'
+    for name in ('update_serials', 'add_serials', 'workspaces',
+                 'sync_subscriptions', 'update_memberships', 'add_memberships'):
+        assert results[name][0] == 'skipped'